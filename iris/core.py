@@ -1,13 +1,93 @@
 """Core optimization routines for wavefront sensing."""
+import pickle
 from functools import partial
+from collections import OrderedDict, namedtuple
 
 import numpy as np
 
-from prysm import FringeZernike, MTF
-from prysm.mtf_utils import mtf_ts_extractor
+from prysm import FringeZernike
 from prysm.thinlens import image_displacement_to_defocus
 from prysm.mathops import sqrt
 
+from iris.engine import (
+    ZernikeBasis,
+    install_basis,
+    clear_installed_bases,
+    thrufocus_ts_mtf,
+    thrufocus_ts_mtf_vjp,
+    thrufocus_ts_mtf_probes,
+    zernike_basis,
+    defocus_basis,
+    basis_phase_2d,
+)
+from iris.shared import SharedArrays, attach_shared_arrays
+
+# defaults for globals which are overridden by prepare_globals
+pool = None
+nworkers = 1
+otf_backend = 'fft'
+backend = 'processes'
+shared_handle = None
+t_true = None
+s_true = None
+defocus = None
+diffraction = None
+
+# the read-only state of one optimization; pass one as ctx to the functions of this module
+# to use it in place of the module globals.  If pool is not None, its workers must have been
+# initialized by prepare_globals with the same state, or shared is the iris.shared.SharedArrays
+# holding the state; tasks sent to the workers carry only the parameter vector, which planes
+# to realize, and the handle of shared so that each worker attaches to the state of the
+# current optimization.  If backend is 'threads', pool is a thread pool of this process and
+# its tasks are given the context itself.
+OptimizationContext = namedtuple('OptimizationContext', [
+    'setup_parameters',
+    'decoder_ring',
+    't_true',
+    's_true',
+    'defocus',
+    'diffraction',
+    'pool',
+    'nworkers',
+    'otf_backend',
+    'shared',
+    'backend',
+])
+
+
+def global_context():
+    """Get the context held in the module globals set by prepare_globals.
+
+    Returns
+    -------
+    `OptimizationContext`
+        context built from the module globals
+
+    """
+    g = globals()
+    return OptimizationContext(**{field: g.get(field) for field in OptimizationContext._fields})
+
+
+def worker_context(handle=None):
+    """Get the context of the optimization a pool worker is attached to.
+
+    Parameters
+    ----------
+    handle : `iris.shared.SharedArraysHandle` or None, optional
+        handle of the block of shared memory holding the context; if the worker
+        is not attached to it, it attaches first, see `prepare_shared_globals`.
+        If None, the globals set by prepare_globals are used as they are
+
+    Returns
+    -------
+    `OptimizationContext`
+        context built from the module globals
+
+    """
+    if handle is not None and handle != shared_handle:
+        prepare_shared_globals(handle)
+    return global_context()
+
 
 def config_codex_params_to_pupil(config, codex, params, defocus=0):
     """Convert a config dictionary, codex dictionary, and parameter vector to a pupil.
@@ -28,31 +108,61 @@ def config_codex_params_to_pupil(config, codex, params, defocus=0):
     `prysm.Pupil`
         a pupil object
 
+    Notes
+    -----
+    The phase is computed as a matrix-vector product with a cached basis (see
+    `iris.engine.zernike_basis`) instead of evaluating each polynomial.
+    FringeZernike normalizes the terms whenever rms_norm is passed, so the
+    basis is always normalized.
+
     """
     s = config
-    pupil_pass_zernikes = {key: value for (key, value) in zip(codex.values(), params)}
-    pupil_pass_zernikes['Z4'] += defocus
-    return FringeZernike(**pupil_pass_zernikes,
-                         base=1,
-                         epd=s.efl / s.fno,
-                         wavelength=s.wvl,
-                         samples=s.samples,
-                         rms_norm=s.focus_normed,
-                         mask=s.mask)
+    basis = zernike_basis(codex, s.samples, s.mask)
+    phase = basis_phase_2d(basis, params)
+    if defocus != 0:
+        z4 = defocus_basis(s)
+        phase.ravel()[z4.inside] += defocus * z4.matrix[:, 0]
+
+    # an empty FringeZernike is nearly free to build; give it the phase from the basis
+    pupil = FringeZernike(base=1,
+                          epd=s.efl / s.fno,
+                          wavelength=s.wvl,
+                          samples=s.samples,
+                          rms_norm=s.focus_normed,
+                          mask=s.mask)
+    for name, value in zip(codex.values(), params):
+        pupil.coefs[int(name[1:]) - 1] = value
+    pupil.coefs[3] += defocus
+    pupil.phase = phase
+    pupil._phase_to_wavefunction()
+    pupil.mask(pupil._mask, pupil.mask_target)
+    return pupil
 
 
 def config_codex_params_to_imgs(cfg, codex, params, defocuses):
+    """Compute the through-focus T/S MTF for a config, codex, and parameter vector.
+
+    Parameters
+    ----------
+    cfg : `prysm.macros.SimulationConfig`
+        a simulation config
+    codex : `dict`
+        dict with integer, string key value pairs, e.g. {0: 'Z1', 1: 'Z9'}
+    params : iterable
+        sequence of optimization parameters
+    defocuses : iterable
+        focus positions, microns
+
+    Returns
+    -------
+    t : `numpy.ndarray`
+        array of shape (planes, freqs) of tangential MTF
+    s : `numpy.ndarray`
+        array of shape (planes, freqs) of sagittal MTF
+
+    """
     wv_defocuses = image_displacement_to_defocus(defocuses, cfg.fno, cfg.wvl, cfg.focus_zernike, cfg.focus_normed)
-    tan, sag = [], []
-    for defocus in wv_defocuses:
-        p = config_codex_params_to_pupil(cfg, codex, params, defocus)
-        m = MTF.from_pupil(p, cfg.efl)
-        t, s = mtf_ts_extractor(m, cfg.freqs)
-        tan.append(t)
-        sag.append(s)
-
-    t, s = np.asarray(tan), np.asarray(sag)
-    return t, s
+    return thrufocus_ts_mtf(cfg, codex, params, wv_defocuses)
 
 
 def mtf_cost_core_main(true_tan, true_sag, sim_tan, sim_sag):
@@ -86,7 +196,7 @@ def mtf_cost_core_main(true_tan, true_sag, sim_tan, sim_sag):
     return difference_t, difference_s
 
 
-def _mtf_cost_core_diffractiondiv(difference_t, difference_s):
+def _mtf_cost_core_diffractiondiv(difference_t, difference_s, ctx=None):
     """Adjust the MTF differences by the diffraction limit.
 
     Parameters
@@ -95,6 +205,8 @@ def _mtf_cost_core_diffractiondiv(difference_t, difference_s):
         raw difference of measured and modeled tangential MTF data
     difference_s : `numpy.ndarray`
         raw difference of measured and modeled tangential MTF data
+    ctx : `OptimizationContext` or None, optional
+        context holding the diffraction limited MTF; if None, use the module globals
 
     Returns
     -------
@@ -104,7 +216,7 @@ def _mtf_cost_core_diffractiondiv(difference_t, difference_s):
         adjusted difference of measured and modeled sagittal MTF data
 
     """
-    global diffraction
+    diffraction = _diffraction(ctx)
     return difference_t / diffraction, difference_s / diffraction
 
 
@@ -204,13 +316,130 @@ def _mtf_cost_core_addreduce(difference_t, difference_s):
     return difference_t + difference_s
 
 
-def average_mse_focusplanes(costfcns):
+def _mtf_cost_core_diffractiondiv_deriv(difference_t, difference_s, ctx=None):
+    """Elementwise derivative of `_mtf_cost_core_diffractiondiv`."""
+    diffraction = _diffraction(ctx)
+    return np.broadcast_to(1 / diffraction, np.shape(difference_t)), \
+        np.broadcast_to(1 / diffraction, np.shape(difference_s))
+
+
+def _mtf_cost_core_manhattan_deriv(difference_t, difference_s):
+    """Elementwise derivative of `_mtf_cost_core_manhattan`."""
+    return np.sign(difference_t), np.sign(difference_s)
+
+
+def _mtf_cost_core_sumsquarediff_deriv(difference_t, difference_s):
+    """Elementwise derivative of `_mtf_cost_core_sumsquarediff`."""
+    return 2 * difference_t, 2 * difference_s
+
+
+def _mtf_cost_core_addreduce_deriv(difference_t, difference_s):
+    """Derivative of `_mtf_cost_core_addreduce`."""
+    return 1, 1
+
+
+def _diffraction(ctx):
+    """Get the diffraction limited MTF from a context, or the module globals if ctx is None."""
+    if ctx is None:
+        return diffraction
+    return ctx.diffraction
+
+
+# absolute finite difference step for each precision of the cost function.  1e-8 is the default eps
+# of L-BFGS-B, and is lost in the rounding error of a single precision cost function
+FD_EPS = {
+    'double': 1e-8,
+    'single': float(np.finfo(np.float32).eps ** 0.5),
+}
+
+# cost cores, and their derivatives, which take the optimization context as a keyword argument
+CONTEXT_COST_CORES = {
+    _mtf_cost_core_diffractiondiv,
+    _mtf_cost_core_diffractiondiv_deriv,
+}
+
+
+def _call_core(core, difference_t, difference_s, ctx):
+    """Call a cost core, passing the context to those in CONTEXT_COST_CORES."""
+    if core in CONTEXT_COST_CORES:
+        return core(difference_t, difference_s, ctx=ctx)
+    return core(difference_t, difference_s)
+
+
+# maps each cost core to a function returning its derivative with respect to each element
+# of its inputs; for cores which reduce to a scalar this is the derivative of the sum
+COST_CORE_DERIVATIVES = {
+    _mtf_cost_core_diffractiondiv: _mtf_cost_core_diffractiondiv_deriv,
+    _mtf_cost_core_manhattan: _mtf_cost_core_manhattan_deriv,
+    _mtf_cost_core_euclidian: _mtf_cost_core_manhattan_deriv,
+    _mtf_cost_core_sumsquarediff: _mtf_cost_core_sumsquarediff_deriv,
+    _mtf_cost_core_addreduce: _mtf_cost_core_addreduce_deriv,
+}
+
+
+def _cost_and_sensitivity(t_true, s_true, t, s, cost_chain, cost_final, ctx=None):
+    """Compute the cost of a focus plane and its derivative with respect to the simulated T/S MTF.
+
+    Parameters
+    ----------
+    t_true : `numpy.ndarray`
+        array of true MTF values
+    s_true : `numpy.ndarray`
+        array of true MTF values
+    t : `numpy.ndarray`
+        array of simulated MTF values
+    s : `numpy.ndarray`
+        array of simulated MTF values
+    cost_chain : iterable
+        set of actions to take to adjust the cost function.
+    cost_final : callable
+        a function which takes two array_likes as inputs and returns a float
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
+
+    Returns
+    -------
+    cost : `float`
+        value of the cost function for this focus plane
+    grad_t : `numpy.ndarray`
+        derivative of the cost with respect to t
+    grad_s : `numpy.ndarray`
+        derivative of the cost with respect to s
+
+    Raises
+    ------
+    ValueError
+        if an element of the cost chain has no known derivative
+
+    Notes
+    -----
+    Each element of the chain must act elementwise, or be a sum of an elementwise function.
+
+    """
+    dt, ds = mtf_cost_core_main(t_true, s_true, t, s)
+    grad_t, grad_s = -np.ones_like(dt), -np.ones_like(ds)
+    for callable_ in (*cost_chain, cost_final):
+        try:
+            deriv = COST_CORE_DERIVATIVES[callable_]
+        except KeyError:
+            raise ValueError(f'no analytic derivative is known for cost core {callable_}')
+        ft, fs = _call_core(deriv, dt, ds, ctx)
+        grad_t, grad_s = grad_t * ft, grad_s * fs
+        if callable_ is not cost_final:
+            dt, ds = _call_core(callable_, dt, ds, ctx)
+
+    return _call_core(cost_final, dt, ds, ctx), grad_t, grad_s
+
+
+def average_mse_focusplanes(costfcns, ctx=None):
     """Reduces a vector cost function to a single scalar value.
 
     Parameters
     ----------
     costfcns : `iterable`
         an iterable containing cost functions for different focal planes
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
 
     Returns
     -------
@@ -223,30 +452,34 @@ def average_mse_focusplanes(costfcns):
     average over focus planes.
 
     """
-    global setup_parameters
+    if ctx is None:
+        ctx = global_context()
+    setup_parameters = ctx.setup_parameters
     delta_nu = setup_parameters.freqs[1] - setup_parameters.freqs[0]
     nu_max, N = setup_parameters.freqs[-1], len(costfcns)
     coef = (delta_nu) / (N * nu_max)
     return coef * sum(costfcns)
 
 
-def realize_focus_plane(params, t_true, s_true, defocus, cost_chain, cost_final):
+def realize_focus_plane(params, t_true, s_true, defocus, cost_chain, cost_final, ctx=None):
     """Compute the cost function for a single focal plane.
 
     Parameters
     ----------
-    base_wavefront : `prysm.Pupil`
-        a prysm Pupil object
+    params : iterable
+        a vector of wavefront coefficients
     t_true : `numpy.ndarray`
         array of true MTF values
     s_true : `numpy.ndarray`
         array of true MTF values
-    defocus_wavefront : `float`
+    defocus : `float`
         amount of defocus, in same units as params
     cost_chain : iterable
         set of actions to take to adjust the cost function.
     cost_final : callable
         a function which takes two array_likes as inputs and returns a float
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
 
     Returns
     -------
@@ -260,21 +493,223 @@ def realize_focus_plane(params, t_true, s_true, defocus, cost_chain, cost_final)
     difference.
 
     """
-    global setup_parameters, decoder_ring
-    prop_wvfront = config_codex_params_to_pupil(setup_parameters, decoder_ring, params, defocus)
-    mtf = MTF.from_pupil(prop_wvfront, setup_parameters.efl)
-    t, s = mtf_ts_extractor(mtf, setup_parameters.freqs)
-    dt, ds = mtf_cost_core_main(t_true, s_true, t, s)  # "raw" and signed difference
-    for callable_ in cost_chain:  # loop over modifications and apply them in sequence
-        dt, ds = callable_(dt, ds)
-    return cost_final(dt, ds)     # finally, reduce the value to a scalar / float
+    return realize_focus_planes(params, (t_true,), (s_true,), (defocus,), cost_chain, cost_final, ctx=ctx)[0]
+
+
+def realize_focus_planes(params, t_true, s_true, defocus, cost_chain, cost_final, precision='double', ctx=None):
+    """Compute the cost function for a set of focal planes with one batched propagation.
+
+    Parameters
+    ----------
+    params : iterable
+        a vector of wavefront coefficients
+    t_true : iterable of `numpy.ndarray`
+        true tangential MTF values for each plane
+    s_true : iterable of `numpy.ndarray`
+        true sagittal MTF values for each plane
+    defocus : iterable of `float`
+        amount of defocus for each plane, in same units as params
+    cost_chain : iterable
+        set of actions to take to adjust the cost function.
+    cost_final : callable
+        a function which takes two array_likes as inputs and returns a float
+    precision : `str`, optional, {'double', 'single'}
+        precision of the propagation, see `iris.engine.thrufocus_ts_mtf`
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
+
+    Returns
+    -------
+    `list`
+        value of the cost function for each focus plane realization
+
+    """
+    if ctx is None:
+        ctx = global_context()
+    t, s = thrufocus_ts_mtf(ctx.setup_parameters, ctx.decoder_ring, params, defocus, ctx.otf_backend, precision)
+    return _apply_cost(t_true, s_true, t, s, cost_chain, cost_final, ctx)
+
+
+def _apply_cost(t_true, s_true, t, s, cost_chain, cost_final, ctx):
+    """Reduce the simulated MTF of each plane to a cost with the cost chain and final reduction."""
+    costs = []
+    for tt, st, tm, sm in zip(t_true, s_true, t, s):
+        dt, ds = mtf_cost_core_main(tt, st, tm, sm)  # "raw" and signed difference
+        for callable_ in cost_chain:  # loop over modifications and apply them in sequence
+            dt, ds = _call_core(callable_, dt, ds, ctx)
+        costs.append(_call_core(cost_final, dt, ds, ctx))  # finally, reduce the value to a scalar / float
+    return costs
+
+
+def realize_focus_planes_and_grad(params, t_true, s_true, defocus, cost_chain, cost_final,
+                                  precision='double', ctx=None):
+    """Compute the cost function and its gradient for a set of focal planes.
+
+    Parameters
+    ----------
+    params : iterable
+        a vector of wavefront coefficients
+    t_true : iterable of `numpy.ndarray`
+        true tangential MTF values for each plane
+    s_true : iterable of `numpy.ndarray`
+        true sagittal MTF values for each plane
+    defocus : iterable of `float`
+        amount of defocus for each plane, in same units as params
+    cost_chain : iterable
+        set of actions to take to adjust the cost function.
+    cost_final : callable
+        a function which takes two array_likes as inputs and returns a float
+    precision : `str`, optional, {'double', 'single'}
+        precision of the propagation, see `iris.engine.thrufocus_ts_mtf`
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
+
+    Returns
+    -------
+    costs : `list`
+        value of the cost function for each focus plane realization
+    grads : `list`
+        gradient of the cost function with respect to params for each focus plane realization
+
+    """
+    if ctx is None:
+        ctx = global_context()
+    t, s, vjp = thrufocus_ts_mtf_vjp(ctx.setup_parameters, ctx.decoder_ring, params, defocus,
+                                     ctx.otf_backend, precision)
+    costs, grad_t, grad_s = [], [], []
+    for tt, st, tm, sm in zip(t_true, s_true, t, s):
+        cost, gt, gs = _cost_and_sensitivity(tt, st, tm, sm, cost_chain, cost_final, ctx)
+        costs.append(cost)
+        grad_t.append(gt)
+        grad_s.append(gs)
+
+    return costs, list(vjp(np.asarray(grad_t), np.asarray(grad_s)))
+
+
+def realize_focus_planes_and_fd_grad(params, t_true, s_true, defocus, cost_chain, cost_final,
+                                     precision='double', ctx=None):
+    """Compute the cost function and its forward difference gradient for a set of focal planes.
+
+    Parameters
+    ----------
+    params : iterable
+        a vector of wavefront coefficients
+    t_true : iterable of `numpy.ndarray`
+        true tangential MTF values for each plane
+    s_true : iterable of `numpy.ndarray`
+        true sagittal MTF values for each plane
+    defocus : iterable of `float`
+        amount of defocus for each plane, in same units as params
+    cost_chain : iterable
+        set of actions to take to adjust the cost function.
+    cost_final : callable
+        a function which takes two array_likes as inputs and returns a float
+    precision : `str`, optional, {'double', 'single'}
+        precision of the propagation, see `iris.engine.thrufocus_ts_mtf`
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
+
+    Returns
+    -------
+    costs : `list`
+        value of the cost function for each focus plane realization
+    grads : `list`
+        gradient of the cost function with respect to params for each focus plane realization
+
+    Notes
+    -----
+    Each probe perturbs one coefficient and reuses the pupil at params, see
+    `iris.engine.thrufocus_ts_mtf_probes`.  The steps are those L-BFGS-B uses
+    for its own finite differences, see `fd_steps`; the pupils of the probes
+    round differently from rebuilt ones, so the gradients agree to rounding.
+
+    """
+    params = np.asarray(params, dtype=np.float64)
+    steps = fd_steps(params, precision)
+    costs = realize_probes(params, steps, None, t_true, s_true, defocus, cost_chain, cost_final, precision, ctx)
+    grads = (costs[1:] - costs[0]) / steps[:, np.newaxis]
+    return list(costs[0]), list(grads.T)
+
+
+def realize_probes(params, steps, probes, t_true, s_true, defocus, cost_chain, cost_final,
+                   precision='double', ctx=None):
+    """Compute the cost function for a set of focal planes at some of the finite difference probes.
+
+    Parameters
+    ----------
+    params : `numpy.ndarray`
+        a vector of wavefront coefficients
+    steps : `numpy.ndarray`
+        forward difference step for each parameter, see `fd_steps`
+    probes : iterable of `int` or None
+        which probes to realize, 0 for params and j + 1 for params[j] perturbed;
+        if None, all len(params) + 1 probes
+    t_true : iterable of `numpy.ndarray`
+        true tangential MTF values for each plane
+    s_true : iterable of `numpy.ndarray`
+        true sagittal MTF values for each plane
+    defocus : iterable of `float`
+        amount of defocus for each plane, in same units as params
+    cost_chain : iterable
+        set of actions to take to adjust the cost function.
+    cost_final : callable
+        a function which takes two array_likes as inputs and returns a float
+    precision : `str`, optional, {'double', 'single'}
+        precision of the propagation, see `iris.engine.thrufocus_ts_mtf`
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
+
+    Returns
+    -------
+    `numpy.ndarray`
+        array of shape (len(probes), planes) of the value of the cost function
+
+    """
+    if ctx is None:
+        ctx = global_context()
+    t, s = thrufocus_ts_mtf_probes(ctx.setup_parameters, ctx.decoder_ring, params, steps, defocus,
+                                   ctx.otf_backend, precision, probes)
+    return np.asarray([_apply_cost(t_true, s_true, tp, sp, cost_chain, cost_final, ctx) for tp, sp in zip(t, s)])
+
+
+def fd_steps(params, precision='double'):
+    """Compute the forward difference step for each parameter.
+
+    Parameters
+    ----------
+    params : `numpy.ndarray`
+        a vector of wavefront coefficients
+    precision : `str`, optional, {'double', 'single'}
+        precision the cost function is evaluated in
+
+    Returns
+    -------
+    `numpy.ndarray`
+        step for each parameter, the same as L-BFGS-B takes when it estimates
+        the gradient itself: scipy.optimize.approx_derivative with method='2-point'
+        and abs_step of FD_EPS[precision], the eps option of `iris.recipes.main.lbfgsb_options`
+
+    Notes
+    -----
+    The steps are the same, not the gradient: the probes update the pupil
+    instead of rebuilding it, so the costs at the probes, and the iterates of
+    an optimization, agree with those of jac=None to rounding only.
+
+    """
+    steps = np.full(params.shape, FD_EPS[precision])
+    dx = (params + steps) - params
+    # as scipy, fall back to a relative step where the absolute one is lost in the rounding of params
+    sign = np.where(params >= 0, 1, -1)
+    relative = np.finfo(np.float64).eps ** 0.5 * sign * np.maximum(1, abs(params))
+    steps = np.where(dx == 0, relative, steps)
+    return (params + steps) - params
 
 
 COST_CHAIN_DEFAULT = (_mtf_cost_core_sumsquarediff,)
 COST_FINAL_DEFAULT = _mtf_cost_core_addreduce
 
 
-def optfcn(wavefrontcoefs, cost_chain=None, cost_final=None):
+def optfcn(wavefrontcoefs, cost_chain=None, cost_final=None, precision='double', ctx=None):
     """Optimization routine used to compare simulation data to measurement data.
 
     Parameters
@@ -285,6 +720,10 @@ def optfcn(wavefrontcoefs, cost_chain=None, cost_final=None):
         set of actions to take to adjust the cost function.
     cost_final : callable or None, optional
         a function which takes two array_likes as inputs and returns a float
+    precision : `str`, optional, {'double', 'single'}
+        precision of the propagation, see `iris.engine.thrufocus_ts_mtf`
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
 
     Returns
     -------
@@ -297,23 +736,382 @@ def optfcn(wavefrontcoefs, cost_chain=None, cost_final=None):
     tangential and sagittal difference and return another modified tangential and sagittal
     difference.
 
+    All focal planes are realized in one batched propagation; if a pool is
+    present, the planes are split into one batch per worker.
+
+    """
+    if cost_chain is None:
+        cost_chain = COST_CHAIN_DEFAULT
+    if cost_final is None:
+        cost_final = COST_FINAL_DEFAULT
+
+    if ctx is None:
+        ctx = global_context()
+    mapped = _map_focus_planes(realize_focus_planes, wavefrontcoefs, cost_chain, cost_final, precision, ctx)
+    costfcn = [cost for costs in mapped for cost in costs]
+    return average_mse_focusplanes(costfcn, ctx)
+
+
+def optfcn_and_grad(wavefrontcoefs, cost_chain=None, cost_final=None, precision='double', ctx=None):
+    """Optimization routine which returns the cost function and its exact gradient.
+
+    Parameters
+    ----------
+    wavefrontcoefs : iterable
+        a vector of wavefront coefficients
+    cost_chain : iterable or None, optional
+        set of actions to take to adjust the cost function.
+    cost_final : callable or None, optional
+        a function which takes two array_likes as inputs and returns a float
+    precision : `str`, optional, {'double', 'single'}
+        precision of the propagation, see `iris.engine.thrufocus_ts_mtf`
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
+
+    Returns
+    -------
+    cost : `float`
+        cost function value
+    grad : `numpy.ndarray`
+        gradient of the cost function with respect to wavefrontcoefs
+
+    Notes
+    -----
+    Same as `optfcn`, but the gradient is computed analytically, see
+    `iris.engine.thrufocus_ts_mtf_vjp`.  The elements of the cost chain must
+    be in COST_CORE_DERIVATIVES.
+
+    """
+    if cost_chain is None:
+        cost_chain = COST_CHAIN_DEFAULT
+    if cost_final is None:
+        cost_final = COST_FINAL_DEFAULT
+
+    costfcn, grads = [], []
+    if ctx is None:
+        ctx = global_context()
+    mapped = _map_focus_planes(realize_focus_planes_and_grad, wavefrontcoefs, cost_chain, cost_final, precision, ctx)
+    for costs, grad in mapped:
+        costfcn += costs
+        grads += grad
+
+    return average_mse_focusplanes(costfcn, ctx), average_mse_focusplanes(grads, ctx)
+
+
+def optfcn_and_fd_grad(wavefrontcoefs, cost_chain=None, cost_final=None, precision='double', ctx=None):
+    """Optimization routine which returns the cost function and its finite difference gradient.
+
+    Parameters
+    ----------
+    wavefrontcoefs : iterable
+        a vector of wavefront coefficients
+    cost_chain : iterable or None, optional
+        set of actions to take to adjust the cost function.
+    cost_final : callable or None, optional
+        a function which takes two array_likes as inputs and returns a float
+    precision : `str`, optional, {'double', 'single'}
+        precision of the propagation, see `iris.engine.thrufocus_ts_mtf`
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
+
+    Returns
+    -------
+    cost : `float`
+        cost function value
+    grad : `numpy.ndarray`
+        forward difference gradient of the cost function with respect to wavefrontcoefs
+
+    Notes
+    -----
+    Same as `optfcn`, but also returns the forward difference gradient, with
+    the same finite difference steps L-BFGS-B takes when it estimates the
+    gradient itself, see `fd_steps`.  The probes update the pupil at
+    wavefrontcoefs incrementally instead of rebuilding it, see
+    `realize_focus_planes_and_fd_grad`, so the results agree with those of
+    L-BFGS-B's own finite differences to rounding, not bit for bit.  Any
+    cost chain may be used.
+
     """
-    # generate a "base pupil" with some aberration content
-    global setup_parameters, decoder_ring, pool, t_true, s_true, defocus
     if cost_chain is None:
         cost_chain = COST_CHAIN_DEFAULT
     if cost_final is None:
         cost_final = COST_FINAL_DEFAULT
 
-    if pool is not None:
-        rfp_mp = partial(realize_focus_plane, wavefrontcoefs, cost_chain=cost_chain, cost_final=cost_final)
-        costfcn = pool.starmap(rfp_mp, zip(t_true, s_true, defocus))
+    costfcn, grads = [], []
+    if ctx is None:
+        ctx = global_context()
+    mapped = _map_focus_planes(realize_focus_planes_and_fd_grad, wavefrontcoefs, cost_chain, cost_final, precision, ctx)
+    for costs, grad in mapped:
+        costfcn += costs
+        grads += grad
+
+    return average_mse_focusplanes(costfcn, ctx), average_mse_focusplanes(grads, ctx)
+
+
+def optfcn_and_parallel_fd_grad(wavefrontcoefs, cost_chain=None, cost_final=None, precision='double', ctx=None):
+    """Optimization routine which returns the cost function and its finite difference gradient, split by probe.
+
+    Parameters
+    ----------
+    wavefrontcoefs : iterable
+        a vector of wavefront coefficients
+    cost_chain : iterable or None, optional
+        set of actions to take to adjust the cost function.
+    cost_final : callable or None, optional
+        a function which takes two array_likes as inputs and returns a float
+    precision : `str`, optional, {'double', 'single'}
+        precision of the propagation, see `iris.engine.thrufocus_ts_mtf`
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
+
+    Returns
+    -------
+    cost : `float`
+        cost function value
+    grad : `numpy.ndarray`
+        forward difference gradient of the cost function with respect to wavefrontcoefs
+
+    Notes
+    -----
+    Same as `optfcn_and_fd_grad`, but if a pool is present the len(wavefrontcoefs) + 1
+    probes are split into one batch per worker, each realizing every focal plane.
+    This uses up to len(wavefrontcoefs) + 1 workers instead of one per plane.
+
+    """
+    return _fd_grad_over_pool(wavefrontcoefs, cost_chain, cost_final, precision, ctx, split_planes=False)
+
+
+def optfcn_and_hybrid_fd_grad(wavefrontcoefs, cost_chain=None, cost_final=None, precision='double', ctx=None):
+    """Optimization routine returning the cost function and its finite difference gradient, split by probe and plane.
+
+    Parameters
+    ----------
+    wavefrontcoefs : iterable
+        a vector of wavefront coefficients
+    cost_chain : iterable or None, optional
+        set of actions to take to adjust the cost function.
+    cost_final : callable or None, optional
+        a function which takes two array_likes as inputs and returns a float
+    precision : `str`, optional, {'double', 'single'}
+        precision of the propagation, see `iris.engine.thrufocus_ts_mtf`
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
+
+    Returns
+    -------
+    cost : `float`
+        cost function value
+    grad : `numpy.ndarray`
+        forward difference gradient of the cost function with respect to wavefrontcoefs
+
+    Notes
+    -----
+    Same as `optfcn_and_fd_grad`, but if a pool is present every (probe, plane)
+    pair is sent to the pool as its own task, in one batch.  This keeps
+    (len(wavefrontcoefs) + 1) * planes workers busy.
+
+    """
+    return _fd_grad_over_pool(wavefrontcoefs, cost_chain, cost_final, precision, ctx, split_planes=True)
+
+
+def _fd_grad_over_pool(wavefrontcoefs, cost_chain, cost_final, precision, ctx, split_planes):
+    """Compute the cost and forward difference gradient with the probes, and optionally planes, split over the pool."""
+    if cost_chain is None:
+        cost_chain = COST_CHAIN_DEFAULT
+    if cost_final is None:
+        cost_final = COST_FINAL_DEFAULT
+    if ctx is None:
+        ctx = global_context()
+
+    params = np.asarray(wavefrontcoefs, dtype=np.float64)
+    steps = fd_steps(params, precision)
+    nprobes, nplanes = len(params) + 1, len(ctx.defocus)
+    if ctx.pool is None:
+        costs = realize_probes(params, steps, None, ctx.t_true, ctx.s_true, ctx.defocus,
+                               cost_chain, cost_final, precision, ctx)
     else:
-        costfcn = []
-        for t, s, defocus_ in zip(t_true, s_true, defocus):
-            costfcn.append(realize_focus_plane(wavefrontcoefs, t, s, defocus_, cost_chain, cost_final))
+        if split_planes:
+            tasks = [((probe,), plane, plane + 1) for probe in range(nprobes) for plane in range(nplanes)]
+        else:
+            chunks = np.array_split(np.arange(nprobes), min(ctx.nworkers, nprobes))
+            tasks = [(tuple(int(probe) for probe in c), 0, nplanes) for c in chunks]
+
+        if ctx.backend == 'threads':
+            results = ctx.pool.starmap(realize_probes, [
+                (params, steps, probes, ctx.t_true[start:stop], ctx.s_true[start:stop], ctx.defocus[start:stop],
+                 cost_chain, cost_final, precision, ctx) for probes, start, stop in tasks])
+        else:
+            # as in _map_focus_planes, the workers hold the context and are sent only what to realize
+            handle = None if ctx.shared is None else ctx.shared.handle
+            rp_mp = partial(_realize_probes_from_globals, handle, params, steps,
+                            cost_chain=cost_chain, cost_final=cost_final, precision=precision)
+            results = ctx.pool.starmap(rp_mp, tasks)
+
+        costs = np.empty((nprobes, nplanes))
+        for (probes, start, stop), result in zip(tasks, results):
+            costs[list(probes), start:stop] = result
+
+    grads = (costs[1:] - costs[0]) / steps[:, np.newaxis]
+    return average_mse_focusplanes(list(costs[0]), ctx), average_mse_focusplanes(list(grads.T), ctx)
+
+
+def precision_error(wavefrontcoefs, cost_chain=None, cost_final=None, ctx=None):
+    """Measure the error of the single precision forward model against double precision.
+
+    Parameters
+    ----------
+    wavefrontcoefs : iterable
+        a vector of wavefront coefficients
+    cost_chain : iterable or None, optional
+        set of actions to take to adjust the cost function.
+    cost_final : callable or None, optional
+        a function which takes two array_likes as inputs and returns a float
+    ctx : `OptimizationContext` or None, optional
+        context of the optimization; if None, use the module globals
+
+    Returns
+    -------
+    `dict`
+        dictionary with keys, types:
+            - mtf, float, largest absolute difference of the T and S MTF over all planes and frequencies
+            - cost, float, absolute difference of the cost function
+
+    """
+    if ctx is None:
+        ctx = global_context()
+    if cost_chain is None:
+        cost_chain = COST_CHAIN_DEFAULT
+    if cost_final is None:
+        cost_final = COST_FINAL_DEFAULT
+
+    mtfs, costs = [], []
+    for precision in ('double', 'single'):
+        t, s = thrufocus_ts_mtf(ctx.setup_parameters, ctx.decoder_ring, wavefrontcoefs, ctx.defocus,
+                                ctx.otf_backend, precision)
+        mtfs.append(np.stack((t, s)))
+        costs.append(average_mse_focusplanes(_apply_cost(ctx.t_true, ctx.s_true, t, s, cost_chain, cost_final, ctx),
+                                             ctx))
+
+    return {
+        'mtf': float(abs(mtfs[1] - mtfs[0]).max()),
+        'cost': float(abs(costs[1] - costs[0])),
+    }
+
+
+def _map_focus_planes(realize, wavefrontcoefs, cost_chain, cost_final, precision, ctx):
+    """Apply a realize_focus_planes-like function to the focal planes, split over the pool if present.
+
+    Returns a list of the results for each batch of planes, in plane order.
+    """
+    t_true, s_true, defocus = ctx.t_true, ctx.s_true, ctx.defocus
+    if ctx.pool is None:
+        return [realize(wavefrontcoefs, t_true, s_true, defocus, cost_chain, cost_final, precision, ctx)]
+
+    chunks = np.array_split(np.arange(len(defocus)), min(ctx.nworkers, len(defocus)))
+    bounds = [(c[0], c[-1] + 1) for c in chunks]
+    if ctx.backend == 'threads':
+        # the threads share the memory of this process, so each batch is a slice of the context
+        return ctx.pool.starmap(realize, [
+            (wavefrontcoefs, t_true[start:stop], s_true[start:stop], defocus[start:stop],
+             cost_chain, cost_final, precision, ctx) for start, stop in bounds])
+
+    # the workers hold the context in their globals, so only the bounds of each batch are sent
+    handle = None if ctx.shared is None else ctx.shared.handle
+    rfp_mp = partial(_realize_planes_from_globals, handle, realize, wavefrontcoefs,
+                     cost_chain=cost_chain, cost_final=cost_final, precision=precision)
+    return ctx.pool.starmap(rfp_mp, bounds)
+
+
+def _realize_planes_from_globals(handle, realize, wavefrontcoefs, start, stop, cost_chain, cost_final, precision):
+    """Realize planes [start, stop) with the truth held in the module globals; runs in pool workers.
+
+    If handle is not None and the worker is not attached to it, the worker first
+    attaches to the state of the new optimization, see `prepare_shared_globals`.
+    """
+    if handle is not None and handle != shared_handle:
+        prepare_shared_globals(handle)
+    return realize(wavefrontcoefs, t_true[start:stop], s_true[start:stop], defocus[start:stop],
+                   cost_chain, cost_final, precision)
+
+
+def _realize_probes_from_globals(handle, params, steps, probes, start, stop, cost_chain, cost_final, precision):
+    """Realize some probes at planes [start, stop) with the truth held in the module globals; runs in pool workers."""
+    if handle is not None and handle != shared_handle:
+        prepare_shared_globals(handle)
+    return realize_probes(params, steps, probes, t_true[start:stop], s_true[start:stop], defocus[start:stop],
+                          cost_chain, cost_final, precision)
+
+
+class MemoizedObjective(object):
+    """A bounded least-recently-used memo in front of an objective function.
+
+    The key is the exact bytes of the parameter vector and the extra
+    arguments, i.e. the cost chain, final reduction, and precision.  Two
+    vectors that differ in the last bit are different points.
+
+    Attributes
+    ----------
+    fun : callable
+        the objective, called as fun(x, *args)
+    maxsize : `int`
+        most evaluations held; if 0, nothing is memoized
+    hits : `int`
+        number of calls answered from the memo
+    misses : `int`
+        number of calls which evaluated fun
+
+    """
 
-    return average_mse_focusplanes(costfcn)
+    def __init__(self, fun, maxsize=1024):
+        """Create a new MemoizedObjective.
+
+        Parameters
+        ----------
+        fun : callable
+            the objective, called as fun(x, *args)
+        maxsize : `int`, optional
+            most evaluations held; if 0, nothing is memoized
+
+        """
+        self.fun = fun
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.memo = OrderedDict()
+
+    def __call__(self, x, *args):
+        """Evaluate the objective, or look up a previous evaluation at the same point."""
+        x = np.asarray(x)
+        key = (x.dtype.str, x.shape, x.tobytes(), *(tuple(a) if isinstance(a, list) else a for a in args))
+        try:
+            value = self.memo[key]
+            self.memo.move_to_end(key)
+            self.hits += 1
+            return _copy_value(value)
+        except KeyError:
+            pass
+
+        value = self.fun(x, *args)
+        self.misses += 1
+        if self.maxsize > 0:
+            self.memo[key] = _copy_value(value)
+            if len(self.memo) > self.maxsize:
+                self.memo.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        """Empty the memo and reset the counts."""
+        self.memo.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def _copy_value(value):
+    """Copy an objective value so callers cannot modify a memoized gradient."""
+    if isinstance(value, tuple):
+        return tuple(v.copy() if isinstance(v, np.ndarray) else v for v in value)
+    return value
 
 
 def prepare_globals(arg_dict):
@@ -332,3 +1130,80 @@ def prepare_globals(arg_dict):
 
     """
     globals().update(arg_dict)
+
+
+def prepare_shared_globals(handle):
+    """Initialize global variables inside process pool from a context in shared memory.
+
+    Parameters
+    ----------
+    handle : `iris.shared.SharedArraysHandle`
+        handle of the block of shared memory holding the context, see `share_context_arrays`
+
+    Notes
+    -----
+    The arrays are read-only views of the shared block, so nothing but the
+    handle is copied into the worker.  Bases in the block are installed in
+    iris.engine so the worker does not compile its own.
+
+    A worker may be attached to the context of one optimization after
+    another; the globals and bases of the previous one are replaced.
+
+    """
+    block, arrays = attach_shared_arrays(handle)
+    scalars = pickle.loads(arrays.pop('scalars').tobytes())
+    cfg = scalars['setup_parameters']
+    clear_installed_bases()
+    for prefix, terms in (('basis', tuple(scalars['decoder_ring'].values())), ('z4', ('Z4',))):
+        install_basis(ZernikeBasis(
+            terms=terms,
+            samples=cfg.samples,
+            inside=arrays.pop(f'{prefix}_inside'),
+            amplitude=arrays.pop(f'{prefix}_amplitude'),
+            matrix=arrays.pop(f'{prefix}_matrix')), cfg.mask)
+
+    previous = globals().get('shared_block')
+    prepare_globals({**scalars, **arrays, 'shared_block': block, 'shared_handle': handle})
+    if previous is not None:
+        try:
+            previous.close()
+        except BufferError:
+            pass  # views of the previous block are still referenced; it is unmapped when they are freed
+
+
+def share_context_arrays(ctx):
+    """Copy the arrays of a context into shared memory.
+
+    Parameters
+    ----------
+    ctx : `OptimizationContext`
+        context of the optimization
+
+    Returns
+    -------
+    `iris.shared.SharedArrays`
+        block holding t_true, s_true, defocus, diffraction, the compiled
+        bases of the codex and defocus, and the pickled setup parameters,
+        codex, and OTF backend
+
+    """
+    cfg = ctx.setup_parameters
+    scalars = {
+        'setup_parameters': cfg,
+        'decoder_ring': ctx.decoder_ring,
+        'otf_backend': ctx.otf_backend,
+    }
+    arrays = {
+        'scalars': np.frombuffer(pickle.dumps(scalars), dtype=np.uint8),
+        't_true': np.asarray(ctx.t_true),
+        's_true': np.asarray(ctx.s_true),
+        'defocus': np.asarray(ctx.defocus),
+        'diffraction': np.asarray(ctx.diffraction),
+    }
+    for prefix, basis in (('basis', zernike_basis(ctx.decoder_ring, cfg.samples, cfg.mask)),
+                          ('z4', defocus_basis(cfg))):
+        arrays[f'{prefix}_inside'] = basis.inside
+        arrays[f'{prefix}_amplitude'] = basis.amplitude
+        arrays[f'{prefix}_matrix'] = basis.matrix
+
+    return SharedArrays(arrays)
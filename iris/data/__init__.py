@@ -1,8 +1,19 @@
 """Data shuffling utilities."""
 from iris.data.persistent_queue import PersistentQueue
-from iris.data.database import Database
+from iris.data.database import Database, DatabaseView, job_fingerprint
+from iris.data.shared_database import SharedDatabase
+from iris.data.segments import SegmentStore
+from iris.data.vectors import VectorIndex
+from iris.data.truth_cache import TruthCache, truth_key
 
 __all__ = [
     'PersistentQueue',
     'Database',
+    'DatabaseView',
+    'SharedDatabase',
+    'job_fingerprint',
+    'SegmentStore',
+    'VectorIndex',
+    'TruthCache',
+    'truth_key',
 ]
@@ -1,17 +1,247 @@
 """A rudimentary database object."""
+import io
 import os
+import sys
 import shutil
 import uuid
 import pickle
+import sqlite3
+import hashlib
+import threading
 from pathlib import Path
+from functools import partial
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+import numpy as np
 import pandas as pd
 
+from iris.data.segments import SegmentStore
+from iris.data.vectors import VectorIndex
+
+# ioctl which clones a file, sharing its blocks, on linux filesystems which support it, e.g. btrfs and xfs
+_FICLONE = 0x40049409
+
+# statistics of a DocumentCache, see `DocumentCache.info`
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'size', 'nbytes', 'max_size', 'max_bytes'])
+
+
+def job_fingerprint(*parts):
+    """Compute a fingerprint which identifies a job by its inputs.
+
+    Parameters
+    ----------
+    *parts
+        everything that determines the result of the job, e.g. the truth,
+        solver, and options.  dicts, sequences, ndarrays, namedtuples,
+        numbers, strings, and functions are hashed by content; anything else
+        by its repr
+
+    Returns
+    -------
+    `str`
+        hex digest
+
+    """
+    h = hashlib.sha1()
+    _hash_canonical(h, parts)
+    return h.hexdigest()
+
+
+def _hash_canonical(h, obj):
+    """Feed a canonical form of obj to a hash."""
+    if isinstance(obj, dict):
+        h.update(b'{')
+        for key in sorted(obj, key=repr):
+            _hash_canonical(h, key)
+            _hash_canonical(h, obj[key])
+        h.update(b'}')
+    elif isinstance(obj, tuple) and hasattr(obj, '_fields'):  # namedtuple, e.g. a SimulationConfig
+        _hash_canonical(h, dict(zip(obj._fields, obj)))
+    elif isinstance(obj, (list, tuple, np.ndarray)) and not (isinstance(obj, np.ndarray) and obj.dtype == object):
+        # sequences of numbers hash the same whether list, tuple, or array
+        try:
+            array = np.asarray(obj, dtype=np.float64)
+        except (TypeError, ValueError):
+            array = None
+        if array is not None:
+            h.update(str(array.shape).encode())
+            h.update(array.tobytes())
+        else:
+            h.update(b'[')
+            for item in obj:
+                _hash_canonical(h, item)
+            h.update(b']')
+    elif callable(obj) and hasattr(obj, '__qualname__'):
+        h.update(f'{obj.__module__}.{obj.__qualname__}'.encode())
+    else:
+        h.update(repr(obj).encode())
+
+
+class DocumentCache(object):
+    """A bounded least-recently-used cache of documents, safe to use from several threads.
+
+    Attributes
+    ----------
+    max_size : `int`
+        most documents held; if 0, nothing is cached
+    max_bytes : `int` or None
+        most bytes held, estimated from the arrays and objects in the documents;
+        if None, only max_size bounds the cache
+    hits : `int`
+        number of lookups which found a document
+    misses : `int`
+        number of lookups which did not find a document
+    nbytes : `int`
+        estimated size of the documents held, bytes; only tracked when max_bytes is not None
+
+    """
+
+    def __init__(self, max_size=1024, max_bytes=None):
+        """Create a new DocumentCache.
+
+        Parameters
+        ----------
+        max_size : `int`, optional
+            most documents held; if 0, nothing is cached
+        max_bytes : `int`, optional
+            most bytes held; if None, only max_size bounds the cache
+
+        """
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self.docs = OrderedDict()  # id: (document, nbytes)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        """Number of documents held."""
+        return len(self.docs)
+
+    def __contains__(self, id_):
+        """Check if a document is held, without counting a hit or miss."""
+        return id_ in self.docs
+
+    def get(self, id_):
+        """Look up a document.
+
+        Parameters
+        ----------
+        id_ : `str`
+            string document id
+
+        Returns
+        -------
+        `dict` or None
+            the document, or None if it is not held
+
+        """
+        with self.lock:
+            try:
+                doc, _ = self.docs[id_]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.docs.move_to_end(id_)
+            self.hits += 1
+            return doc
+
+    def put(self, id_, document):
+        """Hold a document, evicting the least recently used until the cache is within its bounds.
+
+        Parameters
+        ----------
+        id_ : `str`
+            string document id
+        document : `dict`
+            the document
+
+        """
+        if self.max_size <= 0:
+            return
+
+        nbytes = 0 if self.max_bytes is None else _nbytes(document)  # estimating costs about as much as a read
+        with self.lock:
+            self._discard(id_)
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                return
+            self.docs[id_] = (document, nbytes)
+            self.nbytes += nbytes
+            while len(self.docs) > self.max_size or (self.max_bytes is not None and self.nbytes > self.max_bytes):
+                _, (_, size) = self.docs.popitem(last=False)
+                self.nbytes -= size
+
+    def pop(self, id_):
+        """Drop a document from the cache, if it is held."""
+        with self.lock:
+            self._discard(id_)
+
+    def _discard(self, id_):
+        """Drop a document; the lock must be held."""
+        try:
+            _, size = self.docs.pop(id_)
+        except KeyError:
+            return
+        self.nbytes -= size
+
+    def clear(self):
+        """Empty the cache and reset the counts."""
+        with self.lock:
+            self.docs.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Statistics of the cache.
+
+        Returns
+        -------
+        `CacheInfo`
+            hits, misses, size, nbytes, max_size, and max_bytes
+
+        """
+        return CacheInfo(self.hits, self.misses, len(self.docs), self.nbytes, self.max_size, self.max_bytes)
+
+
+def _nbytes(obj):
+    """Estimate the memory held by a document."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(_nbytes(key) + _nbytes(value) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(_nbytes(value) for value in obj)
+    return sys.getsizeof(obj)
+
 
 class Database(object):
-    """A database."""
+    """A database.
+
+    Documents are pickled to one file each in the db folder, or with
+    store='segments', packed into the segment files of a `SegmentStore` in the
+    segments folder.  Their truth_params and result_final are held in the
+    arrays of a `VectorIndex` in the vectors folder, for `Database.find`.
+    Their fields are held in an index, which is either index.csv, to which a
+    row is appended for each document, or index.sqlite, an SQLite database in
+    WAL mode which has indexes on the fields for filtering with
+    `Database.select`.
+
+    A database has one writer.  Other processes may open it with
+    readonly=True while it is written, and see the documents which were
+    complete when they opened it; see `iris.data.SharedDatabase` for many writers.
 
-    def __init__(self, path, fields=None, overwrite=False):
+    """
+
+    def __init__(self, path, fields=None, overwrite=False, backend=None, indexes=None, store=None,
+                 cache_size=1024, cache_bytes=None, readonly=False):
         """Initialize a database.
 
         Parameters
@@ -22,55 +252,256 @@ class Database(object):
             set of fields to use if creating a new database, else ignored
         overwrite: `bool`, optional
             whether to overwrite an existing database at path
+        backend : `str`, optional, {'csv', 'sqlite'}
+            index backend; if None, 'csv' for a new database, or whichever
+            index is on disk for an existing one
+        indexes : iterable, optional
+            fields to index for filtering, sqlite backend only; if None, all fields
+        store : `str`, optional, {'pickle', 'segments'}
+            how new documents are stored; if None, 'segments' if the database
+            has a segments folder, else 'pickle'.  Documents are read from
+            wherever they are.
+        cache_size : `int`, optional
+            most documents held in memory after they are read; if 0, none are
+        cache_bytes : `int`, optional
+            most bytes of documents held in memory; if None, only cache_size bounds the cache
+        readonly : `bool`, optional
+            if True, open an existing database without changing anything on
+            disk, e.g. while another process writes it
 
         Notes
         -----
         if fields is provided and a db exists at the given path already, an exception will be raised
 
+        opening a csv database with backend='sqlite' imports its index.csv
+        into index.sqlite, which is used from then on; index.csv is left as it was
+
+        documents already pickled stay readable when store='segments', see
+        `Database.pack_documents` to move them into the segments
+
         """
+        if backend not in (None, 'csv', 'sqlite'):
+            raise ValueError('backend must be one of csv, sqlite')
+        if store not in (None, 'pickle', 'segments'):
+            raise ValueError('store must be one of pickle, segments')
+        if readonly and fields is not None:
+            raise ValueError('cannot create a read-only database')
+
         self.path = Path(path).resolve()
         self.data_root = self.path / 'db'
         self.csvpath = self.path / 'index.csv'
-        self.cache = {}
+        self.sqlitepath = self.path / 'index.sqlite'
+        self.segments_root = self.path / 'segments'
+        self.vectors_root = self.path / 'vectors'
+        self.fingerprint_path = self.path / 'fingerprints.txt'
+        self.cache = DocumentCache(cache_size, cache_bytes)
+        self.readonly = readonly
+        self.conn = None
+        self._df = None
+        if readonly:
+            # read in the reverse of the order they are written, so that each is a subset of the index
+            self.fingerprints = self._load_fingerprints()
+            self.vectors = VectorIndex(self.vectors_root, readonly=True)
 
         if fields is None:  # initialize the db from the path
-            self.df = None
             self.fields = None
-            self._load_from_disk()
+            if self.sqlitepath.is_file():
+                self.backend = 'sqlite'
+            elif readonly:
+                self.backend = 'csv'
+            else:
+                self.backend = backend or 'csv'
+            self._load_from_disk(indexes)
         else:  # if not, create from scratch or raise if there is a db at the path and overwrite=False
-            if self.csvpath.is_file():
+            if self.csvpath.is_file() or self.sqlitepath.is_file():
                 if not overwrite:
                     raise IOError('There is an existing database at this location.  Delete it, or use overwrite=True.')
                 else:
-                    shutil.rmtree(self.data_root)
-                    os.remove(self.csvpath)
+                    shutil.rmtree(self.data_root, ignore_errors=True)
+                    shutil.rmtree(self.segments_root, ignore_errors=True)
+                    shutil.rmtree(self.vectors_root, ignore_errors=True)
+                    for file in (self.csvpath, self.fingerprint_path, *_sqlite_files(self.sqlitepath)):
+                        if file.is_file():
+                            os.remove(file)
             if 'id' in fields:
                 raise ValueError('cannot use id as a field')
             self.fields = tuple(fields)
-            self.df = pd.DataFrame(columns=(*fields, 'id'))
-        self.data_root.mkdir(parents=True, exist_ok=True)  # ensure database folders exist
+            self.backend = backend or 'csv'
+            if self.backend == 'sqlite':
+                self.path.mkdir(parents=True, exist_ok=True)
+                self._connect()
+                self._create_table(indexes)
+            else:
+                self._df = pd.DataFrame(columns=(*fields, 'id'))
+        if not readonly:
+            self.data_root.mkdir(parents=True, exist_ok=True)  # ensure database folders exist
+        if store is None:
+            store = 'segments' if self.segments_root.is_dir() else 'pickle'
+        self.store = store
+        if self.segments_root.is_dir() or (store == 'segments' and not readonly):
+            self.segments = SegmentStore(self.segments_root, readonly=readonly)
+        else:
+            self.segments = None
+        if not readonly:
+            self.vectors = VectorIndex(self.vectors_root)
+            self.fingerprints = self._load_fingerprints()
+        self._vectors_synced = False
 
+    @property
+    def df(self):
+        """Index of the database as a DataFrame; for the sqlite backend, read on first access after a change."""
+        if self._df is None:
+            columns = ', '.join(_quote(column) for column in (*self.fields, 'id'))
+            self._df = pd.read_sql_query(f'SELECT {columns} FROM documents ORDER BY rowid', self.conn)
+        return self._df
 
     @property
     def doc_ids(self):
+        if self.backend == 'sqlite':
+            return np.asarray([id_ for id_, in self.conn.execute('SELECT id FROM documents ORDER BY rowid')],
+                              dtype=object)
         return self.df.id.values
 
     def init_csv(self):
         """Initialize the database index to disk."""
-        if self.df.empty:
+        if self.backend == 'sqlite':  # the table is made with the database
+            if self.conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]:
+                raise UserWarning('Database is not empty.')
+        elif self.df.empty:
             self._write_to_disk()
         else:
             raise UserWarning('Database is not empty.')
 
-    def _load_from_disk(self):
+    def _load_from_disk(self, indexes=None):
         """Load a database from disk."""
-        self.df = pd.read_csv(self.csvpath)
-        fields = self.df.columns.tolist()
-        self.fields = [f for f in fields if f != 'id']
+        if self.backend == 'sqlite':
+            importing = not self.sqlitepath.is_file()
+            self._connect()
+            if self.readonly:
+                columns = [row[1] for row in self.conn.execute('PRAGMA table_info(documents)')]
+                self.fields = [f for f in columns if f != 'id']
+            elif importing:
+                self._import_csv(indexes)
+            else:
+                columns = [row[1] for row in self.conn.execute('PRAGMA table_info(documents)')]
+                self.fields = [f for f in columns if f != 'id']
+                if indexes is not None:
+                    self._create_indexes(indexes)
+        else:
+            self._df = _read_complete_csv(self.csvpath)
+            fields = self._df.columns.tolist()
+            self.fields = [f for f in fields if f != 'id']
 
     def _write_to_disk(self):
         """Write the dataframe to disk."""
-        self.df.to_csv(self.csvpath, index=False)
+        # replaced rather than rewritten, so a reader never sees part of the index
+        tmp = self.path / f'index.{uuid.uuid4().hex}.tmp'
+        self.df.to_csv(tmp, index=False)
+        os.replace(tmp, self.csvpath)
+
+    def _append_to_disk(self, row_item):
+        """Append a row to the index on disk."""
+        if not self.csvpath.is_file():
+            self._write_to_disk()
+        else:
+            pd.DataFrame([row_item], columns=self.df.columns).to_csv(self.csvpath, mode='a', header=False, index=False)
+
+    def _check_writable(self):
+        """Raise if the database was opened read-only."""
+        if self.readonly:
+            raise IOError('the database is read-only')
+
+    def _connect(self):
+        """Open the sqlite index in WAL mode, so readers do not block the writer."""
+        if self.readonly:
+            self.conn = sqlite3.connect(f'{self.sqlitepath.as_uri()}?mode=ro', uri=True, check_same_thread=False)
+            return
+        self.conn = sqlite3.connect(str(self.sqlitepath), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+    def _create_table(self, indexes=None):
+        """Create the sqlite table of the index and the indexes on its fields."""
+        columns = ', '.join(_quote(field) for field in self.fields)
+        with self.conn:
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS documents ({columns}, id TEXT PRIMARY KEY)')
+        self._create_indexes(self.fields if indexes is None else indexes)
+
+    def _create_indexes(self, fields):
+        """Create indexes on fields of the sqlite index which do not have one."""
+        with self.conn:
+            for field in fields:
+                if field not in self.fields:
+                    raise ValueError(f'cannot index {field}, it is not a field of the database')
+                self.conn.execute(f'CREATE INDEX IF NOT EXISTS {_quote("idx_" + field)} ON documents ({_quote(field)})')
+
+    def _import_csv(self, indexes=None):
+        """Fill a new sqlite index from index.csv."""
+        df = pd.read_csv(self.csvpath)
+        self.fields = [f for f in df.columns.tolist() if f != 'id']
+        self._create_table(indexes)
+        rows = df[[*self.fields, 'id']].itertuples(index=False, name=None)
+        with self.conn:
+            self.conn.executemany(self._insert_statement(), (tuple(_sql_value(v) for v in row) for row in rows))
+
+    def _insert_statement(self):
+        """SQL statement which inserts one row, fields then id."""
+        columns = ', '.join(_quote(column) for column in (*self.fields, 'id'))
+        return f'INSERT INTO documents ({columns}) VALUES ({", ".join("?" * (len(self.fields) + 1))})'
+
+    def close(self):
+        """Close the sqlite index, if any."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _load_fingerprints(self):
+        """Load the fingerprints of the jobs in the database from disk."""
+        try:
+            with open(self.fingerprint_path, 'r') as fid:
+                return set(line.strip() for line in fid if line.strip())
+        except FileNotFoundError:
+            return set()
+
+    def has_job(self, fingerprint):
+        """Check if the database holds the result of a job.
+
+        Parameters
+        ----------
+        fingerprint : `str`
+            fingerprint of the job, see `job_fingerprint`
+
+        Returns
+        -------
+        `bool`
+            True if a document with this fingerprint has been appended
+
+        """
+        return fingerprint in self.fingerprints
+
+    def dedupe_queue(self, queue, fingerprint):
+        """Remove the jobs from a queue whose results are already in the database.
+
+        Parameters
+        ----------
+        queue : `iris.data.PersistentQueue`
+            a persistent queue
+        fingerprint : callable
+            function of a queue item which returns its fingerprint, e.g.
+            `iris.worker.Worker.fingerprint`
+
+        Returns
+        -------
+        `int`
+            number of items removed
+
+        """
+        before = len(queue.q)
+        queue.q = type(queue.q)(item for item in queue.q if not self.has_job(fingerprint(item)))
+        removed = before - len(queue.q)
+        if removed:
+            queue.persist()
+        return removed
 
     def make_row(self, document):
         """Create a dictionary representing the row of corresponding to a document.
@@ -93,22 +524,38 @@ class Database(object):
 
         return row_item
 
-    def append(self, document):
+    def append(self, document, fingerprint=None):
         """Append a document to the database.
 
         Parameters
         ----------
         document : `dict`
             a dictionary with several fields
+        fingerprint : `str`, optional
+            fingerprint of the job which produced the document, see `job_fingerprint`
 
         """
+        self._check_writable()
+        self.vectors.check(document)
         row_item = self.make_row(document)
         id_ = row_item['id']
-        self.df = self.df.append(row_item, ignore_index=True)  # assign to df, does not modifiy in-place
-        with open(self.data_root / f'{id_}.pkl', 'wb') as fid:  # write the file to disk
-            pickle.dump(document, fid)
+        self._store(id_, document)
 
-        self._write_to_disk()
+        # indexed after the file is written, so a row in the index always has its document
+        if self.backend == 'sqlite':
+            row = [_sql_value(row_item[field]) for field in self.fields]
+            with self.conn:
+                self.conn.execute(self._insert_statement(), (*row, id_))
+            self._df = None
+        else:
+            self._df = self.df.append(row_item, ignore_index=True)  # assign to df, does not modifiy in-place
+            self._append_to_disk(row_item)
+        self.vectors.append(id_, document)
+        if fingerprint is not None:
+            # written last, so a fingerprint on disk always has its document
+            with open(self.fingerprint_path, 'a') as fid:
+                fid.write(fingerprint + '\n')
+            self.fingerprints.add(fingerprint)
 
     def get_document(self, id_):
         """Return a document from the database.
@@ -123,14 +570,136 @@ class Database(object):
         object
             object keyed by this id
 
+        Notes
+        -----
+        documents are cached, so the same object is returned by each call
+        until it is evicted; modify a copy, not the document
+
         """
-        try:
-            doc = self.cache[id_]
-        except KeyError:
-            with open(self.data_root / f'{id_}.pkl', 'rb') as fid:
-                doc = pickle.load(fid)
+        doc = self.cache.get(id_)
+        if doc is None:
+            doc = self._load(id_)
+            self.cache.put(id_, doc)
         return doc
 
+    def get_documents(self, ids, nthreads=None):
+        """Return several documents from the database, reading those not cached on a pool of threads.
+
+        Parameters
+        ----------
+        ids : iterable of `str`
+            string document ids
+        nthreads : `int`, optional
+            number of threads reading documents; if None, chosen by `concurrent.futures.ThreadPoolExecutor`
+
+        Returns
+        -------
+        `list`
+            the documents, in the order of ids
+
+        """
+        ids = list(ids)
+        docs, missing = {}, []
+        for id_ in dict.fromkeys(ids):
+            doc = self.cache.get(id_)
+            if doc is None:
+                missing.append(id_)
+            else:
+                docs[id_] = doc
+
+        if len(missing) == 1:
+            loaded = [self._load(missing[0])]
+        elif missing:
+            with ThreadPoolExecutor(nthreads) as executor:
+                loaded = list(executor.map(self._load, missing))
+        else:
+            loaded = []
+
+        for id_, doc in zip(missing, loaded):
+            self.cache.put(id_, doc)
+            docs[id_] = doc
+        return [docs[id_] for id_ in ids]
+
+    def cache_info(self):
+        """Statistics of the document cache.
+
+        Returns
+        -------
+        `CacheInfo`
+            hits, misses, size, nbytes, max_size, and max_bytes
+
+        """
+        return self.cache.info()
+
+    def _load(self, id_):
+        """Read a document from disk."""
+        if self.segments is not None and id_ in self.segments:
+            return self.segments.get(id_)
+        with open(self.data_root / f'{id_}.pkl', 'rb') as fid:
+            return pickle.load(fid)
+
+    def get_history(self, id_, key):
+        """Return a history of a document, e.g. its cost at each iteration.
+
+        Parameters
+        ----------
+        id_ : `str`
+            string document id
+        key : `str`
+            key of the history, one of result_iter, cost_iter, rrmswfe_iter
+
+        Returns
+        -------
+        `list` of `numpy.ndarray`
+            each run of the history, of shape (iterations,) or (iterations, parameters);
+            read-only views of the segment file with store='segments'
+
+        """
+        if self.segments is not None and id_ in self.segments:
+            return self.segments.history(id_, key)
+
+        history = self.get_document(id_)[key]
+        if len(history) > 0 and isinstance(history[0], list):
+            return [np.asarray(run, dtype=np.float64) for run in history]
+        return [np.asarray(history, dtype=np.float64)]
+
+    def _store(self, id_, document):
+        """Write a document to disk."""
+        if self.store == 'segments':
+            self.segments.append(id_, document)
+        else:
+            # replaced rather than rewritten, so a file hardlinked by merge_databases is not changed in both
+            tmp = self.data_root / f'{id_}.{uuid.uuid4().hex}.tmp'
+            with open(tmp, 'wb') as fid:
+                pickle.dump(document, fid)
+            os.replace(tmp, self.data_root / f'{id_}.pkl')
+
+    def pack_documents(self):
+        """Move the pickled documents of the database into its segments.
+
+        New documents are stored in the segments from then on.
+
+        Returns
+        -------
+        `int`
+            number of documents moved
+
+        """
+        self._check_writable()
+        if self.segments is None:
+            self.segments = SegmentStore(self.segments_root)
+        self.store = 'segments'
+
+        moved = 0
+        for id_ in self.doc_ids:
+            file = self.data_root / f'{id_}.pkl'
+            if id_ not in self.segments and file.is_file():
+                with open(file, 'rb') as fid:
+                    self.segments.append(id_, pickle.load(fid))
+                file.unlink()  # after the append, so the document is always on disk
+                moved += 1
+        return moved
+
     def update_document(self, id_, document):
         """Replace a document in the database.
 
@@ -142,56 +711,383 @@ class Database(object):
             document sans id
 
         """
-        idx = self.df.loc[self.df.id == id_].index.values[0]
+        self._check_writable()
         d = self.make_row(document)
         d['id'] = id_
-        insertion_list = []
-        for key in self.fields:
-            insertion_list.append(d[key])
-        insertion_list.append(id_)
-        self.df.iloc[idx, :] = insertion_list
-        with open(self.data_root / f'{id_}.pkl', 'wb') as fid:
-            pickle.dump(document, fid)
+        if self.backend == 'sqlite':
+            assignments = ', '.join(f'{_quote(field)} = ?' for field in self.fields)
+            with self.conn:
+                cursor = self.conn.execute(f'UPDATE documents SET {assignments} WHERE id = ?',
+                                           (*(_sql_value(d[field]) for field in self.fields), id_))
+            if cursor.rowcount == 0:
+                raise KeyError(id_)
+            self._df = None
+        else:
+            idx = self.df.loc[self.df.id == id_].index.values[0]
+            insertion_list = []
+            for key in self.fields:
+                insertion_list.append(d[key])
+            insertion_list.append(id_)
+            self.df.iloc[idx, :] = insertion_list
+            self._write_to_disk()
+        self._store(id_, document)
+        if id_ in self.vectors:
+            self.vectors.update(id_, document)
+        else:
+            self.vectors.append(id_, document)
+        self.cache.pop(id_)
+
+    def _sync_vectors(self):
+        """Add the documents missing from the vector index, e.g. those of a database made before it existed."""
+        if not self._vectors_synced:
+            missing = [id_ for id_ in self.doc_ids if id_ not in self.vectors]
+            for id_, doc in zip(missing, self.get_documents(missing)):
+                self.vectors.append(id_, doc)
+            self._vectors_synced = True
+
+    def get_vectors(self, key):
+        """Return the materialized array of a vector field of the documents.
+
+        Parameters
+        ----------
+        key : `str`
+            'truth_params' or 'result_final'
+
+        Returns
+        -------
+        ids : `numpy.ndarray`
+            id of the document of each row
+        values : `numpy.ndarray`
+            array of shape (documents, coefficients); shorter vectors are padded with NaN
+
+        """
+        self._sync_vectors()
+        return self.vectors.values(key)
+
+    def find(self, key='truth_params', ranges=None, norms=None, radius=None):
+        """Find documents by their truth or result vectors, without reading any document.
+
+        Parameters
+        ----------
+        key : `str`, optional
+            'truth_params' or 'result_final'
+        ranges : `dict`, optional
+            index, (low, high) pairs; low <= vector[index] <= high.  Either
+            bound may be None.
+        norms : `dict`, optional
+            indices, (low, high) pairs; low <= norm(vector[indices]) <= high,
+            e.g. {(3, 4): (0.04, 0.06)} for the magnitude of a pair of terms.
+            Either bound may be None.
+        radius : `tuple`, optional
+            (indices, center, radius); norm(vector[indices] - center) <= radius
+
+        Returns
+        -------
+        `numpy.ndarray`
+            ids of the documents which satisfy every condition
+
+        """
+        self._sync_vectors()
+        return self.vectors.find(key, ranges, norms, radius)
+
+    def select(self, where=None, params=(), columns=None):
+        """Select the rows of the index which satisfy a condition.
+
+        Parameters
+        ----------
+        where : `str`, optional
+            SQL condition on the fields, e.g. 'truth_rmswfe > ? AND nit < ?';
+            if None, all rows are selected
+        params : iterable, optional
+            values of the ? placeholders in where
+        columns : iterable of `str`, optional
+            columns to select; if None, the fields and id
+
+        Returns
+        -------
+        `pandas.DataFrame`
+            the selected rows, in the order they were appended
+
+        Notes
+        -----
+        with the sqlite backend, conditions on indexed fields do not scan the
+        index.  With the csv backend, the index is copied into an in-memory
+        SQLite database for every query.
+
+        """
+        if columns is None:
+            columns = (*self.fields, 'id')
+        query = f'SELECT {", ".join(_quote(column) for column in columns)} FROM documents'
+        if where is not None:
+            query += f' WHERE {where}'
+        query += ' ORDER BY rowid'
+
+        if self.backend == 'sqlite':
+            return pd.read_sql_query(query, self.conn, params=tuple(params))
 
+        conn = sqlite3.connect(':memory:')
         try:
-            del self.cache[id_]
-        except KeyError:
-            pass
+            self.df.to_sql('documents', conn, index=False)
+            return pd.read_sql_query(query, conn, params=tuple(params))
+        finally:
+            conn.close()
+
+
+def _read_complete_csv(path):
+    """Read a csv file up to its last complete line, so that a row being appended is not read."""
+    with open(path, 'rb') as fid:
+        data = fid.read()
+    return pd.read_csv(io.BytesIO(data[:data.rfind(b'\n') + 1]))
+
+
+def _quote(name):
+    """Quote an SQL identifier."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _sql_value(value):
+    """Convert a field of a document to a value sqlite can store."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+    return str(value)  # as it would be written to index.csv
+
+
+def _sqlite_files(path):
+    """The sqlite index at path and its write-ahead log files."""
+    return path, path.with_name(path.name + '-wal'), path.with_name(path.name + '-shm')
+
+
+class DatabaseView(object):
+    """A read-only view of several databases as one, which copies nothing.
+
+    Attributes
+    ----------
+    databases : `list` of `Database`
+        the databases in the view
+
+    """
+
+    def __init__(self, databases):
+        """Create a new DatabaseView.
+
+        Parameters
+        ----------
+        databases : iterable of `Database`
+            the databases to view as one
+
+        """
+        self.databases = list(databases)
+        self._frames = None
+        self._df = None
+        self._owners = {}
+
+    @property
+    def fields(self):
+        """Fields of the databases, in order of first appearance."""
+        return list(dict.fromkeys(field for db in self.databases for field in db.fields))
+
+    @property
+    def df(self):
+        """Indexes of the databases, concatenated; remade when one of them changes."""
+        frames = [db.df for db in self.databases]
+        if not frames:
+            return pd.DataFrame(columns=['id'])
+        if self._frames is None or len(frames) != len(self._frames) or \
+                any(a is not b for a, b in zip(frames, self._frames)):
+            self._df = pd.concat(frames, ignore_index=True)
+            self._frames = frames
+        return self._df
+
+    @property
+    def doc_ids(self):
+        return np.concatenate([db.doc_ids for db in self.databases] or [np.empty(0, dtype=object)])
+
+    @property
+    def fingerprints(self):
+        """Fingerprints of the jobs in every database."""
+        return set().union(*(db.fingerprints for db in self.databases))
 
+    def has_job(self, fingerprint):
+        """Check if any database holds the result of a job, see `Database.has_job`."""
+        return any(db.has_job(fingerprint) for db in self.databases)
 
-def merge_databases(dbs, to):
+    def _owner(self, id_):
+        """Position of the database which holds a document."""
+        try:
+            return self._owners[id_]
+        except KeyError:  # appended since the map was made
+            self._owners = {doc_id: i for i, db in enumerate(self.databases) for doc_id in db.doc_ids}
+            return self._owners[id_]
+
+    def get_document(self, id_):
+        """Return a document from the database which holds it, see `Database.get_document`."""
+        return self.databases[self._owner(id_)].get_document(id_)
+
+    def get_documents(self, ids, nthreads=None):
+        """Return several documents, see `Database.get_documents`."""
+        ids = list(ids)
+        groups = {}
+        for id_ in dict.fromkeys(ids):
+            groups.setdefault(self._owner(id_), []).append(id_)
+
+        docs = {}
+        for owner, group in groups.items():
+            docs.update(zip(group, self.databases[owner].get_documents(group, nthreads)))
+        return [docs[id_] for id_ in ids]
+
+    def get_history(self, id_, key):
+        """Return a history of a document, see `Database.get_history`."""
+        return self.databases[self._owner(id_)].get_history(id_, key)
+
+    def get_vectors(self, key):
+        """Return the materialized arrays of the databases, concatenated, see `Database.get_vectors`."""
+        if not self.databases:
+            return np.empty(0, dtype=object), np.empty((0, 0))
+        ids, values = zip(*(db.get_vectors(key) for db in self.databases))
+        width = max(value.shape[1] for value in values)
+        padded = np.full((sum(len(value) for value in values), width), np.nan)
+        row = 0
+        for value in values:
+            padded[row:row + len(value), :value.shape[1]] = value
+            row += len(value)
+        return np.concatenate(ids), padded
+
+    def find(self, key='truth_params', ranges=None, norms=None, radius=None):
+        """Find documents in every database by their vectors, see `Database.find`."""
+        return np.concatenate([db.find(key, ranges, norms, radius) for db in self.databases]
+                              or [np.empty(0, dtype=object)])
+
+    def select(self, where=None, params=(), columns=None):
+        """Select rows of the index of every database, see `Database.select`."""
+        if not self.databases:
+            return pd.DataFrame(columns=columns or ['id'])
+        return pd.concat([db.select(where, params, columns) for db in self.databases], ignore_index=True)
+
+
+def merge_databases(dbs, to=None, backend='csv', link='copy', nthreads=None):
     """Merge the databases in dbs to the output path, to.
 
     Parameters
     ----------
     dbs: iterable of `Database`s
         set of databases to merge into the output db
-    to: path_like
-        where to put the output database
+    to: path_like, optional
+        where to put the output database; if None, nothing is written and a
+        read-only view of the databases is returned
+    backend : `str`, optional, {'csv', 'sqlite'}
+        index backend of the output database
+    link : `str`, optional, {'copy', 'hardlink', 'reflink'}
+        how documents are put in the output database; hardlinks and reflinks
+        take no space, and fall back to copies where the filesystem does not
+        support them
+    nthreads : `int`, optional
+        number of threads copying files; if None, chosen by `concurrent.futures.ThreadPoolExecutor`
 
     Returns
     -------
-    `Database`
+    `Database` or `DatabaseView`
         new database object that contains all elements from the component dbs
 
+    Notes
+    -----
+    documents are written to new files when they are updated, so updating a
+    hardlinked document in the output database does not change the input.
+    The last segment of each input is still open for appends, so it is
+    always copied; only segments which can no longer change are linked
+
     """
+    if to is None:
+        return DatabaseView(dbs)
+    if link not in ('copy', 'hardlink', 'reflink'):
+        raise ValueError('link must be one of copy, hardlink, reflink')
+
     out_root = Path(to)
     out_cproot = out_root / 'db'
-    try:
-        shutil.rmtree(out_cproot)
-    except FileNotFoundError:
-        pass
+    out_segments = out_root / 'segments'
+    for folder in (out_cproot, out_segments, out_root / 'vectors'):
+        try:
+            shutil.rmtree(folder)
+        except FileNotFoundError:
+            pass
     out_cproot.mkdir(parents=True, exist_ok=True)
 
-    dfs = []
+    dbs = list(dbs)
+    dfs, fingerprints, transfers, live, segment = [], set(), [], [], 0
     for db in dbs:
         dfs.append(db.df)
+        fingerprints |= db.fingerprints
         ids = db.df['id']
         for id_ in ids:
-            str_ = f'{id_}.pkl'
-            in_path = db.path / 'db' / str_
-            shutil.copy2(in_path, out_cproot)
+            if db.segments is None or id_ not in db.segments:
+                str_ = f'{id_}.pkl'
+                in_path = db.path / 'db' / str_
+                transfers.append((in_path, out_cproot / str_))
+        if db.segments is not None:
+            # the records of a segment only refer to offsets in its own files, so the segments
+            # of each database are carried over whole, renumbered after those of the last
+            out_segments.mkdir(parents=True, exist_ok=True)
+            for file in db.segments.files():
+                dst = out_segments / f'{segment + int(file.stem):05d}{file.suffix}'
+                if int(file.stem) < db.segments.segment:
+                    transfers.append((file, dst))
+                else:  # the last segment may still be appended to, so it is never linked
+                    live.append((file, dst))
+            segment += db.segments.segment + 1
+
+    if segment:  # new documents go to a new segment, never to a file linked to an input
+        (out_segments / f'{segment:05d}.meta').touch()
+
+    # records are appended to the .meta file after their data is in the .bin file, so
+    # copying the .meta file first never yields a record whose data was not copied
+    for src, dst in sorted(live, key=lambda pair: pair[0].suffix != '.meta'):
+        shutil.copy2(src, dst)
+
+    if transfers:
+        with ThreadPoolExecutor(nthreads) as executor:
+            list(executor.map(partial(_transfer, link=link), *zip(*transfers)))
+
+    vectors = VectorIndex(out_root / 'vectors')
+    for db in dbs:
+        db._sync_vectors()
+        vectors.extend(list(db.vectors.ids), {key: db.vectors.values(key)[1] for key in db.vectors.widths})
 
     out_df = pd.concat(dfs)
     out_df.to_csv(out_root / 'index.csv', index=False)
-    return Database(to)
+    for file in _sqlite_files(out_root / 'index.sqlite'):  # a stale index would shadow index.csv
+        if file.is_file():
+            os.remove(file)
+    with open(out_root / 'fingerprints.txt', 'w') as fid:
+        fid.writelines(fingerprint + '\n' for fingerprint in sorted(fingerprints))
+    return Database(to, backend=backend)
+
+
+def _transfer(src, dst, link='copy'):
+    """Copy a file, or link it if the filesystem supports it."""
+    if link == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:  # across filesystems, or not supported
+            pass
+    elif link == 'reflink' and _reflink(src, dst):
+        return
+    shutil.copy2(src, dst)
+
+
+def _reflink(src, dst):
+    """Clone a file sharing its blocks; returns False if the filesystem cannot."""
+    if fcntl is None:
+        return False
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    except OSError:
+        try:
+            os.remove(dst)
+        except FileNotFoundError:
+            pass
+        return False
+    shutil.copystat(src, dst)
+    return True
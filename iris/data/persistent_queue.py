@@ -1,7 +1,8 @@
 """A queue object that persists to disk as a pickle with each operation."""
 import pickle
 from pathlib import Path
-from collections import deque
+from itertools import count
+from collections import deque, Counter
 
 
 class PersistentQueue(deque):
@@ -22,6 +23,11 @@ class PersistentQueue(deque):
             persists it to disk.  Use this where the consuming code of that
             object will not fail.
 
+        - several consumers in one process use lease() to take the first item
+            no other consumer holds, and complete() or release() when done with
+            it.  Leases are not persisted, so items leased by a process which
+            dies are still on the queue when it is next loaded.
+
     Attributes
     ----------
     path : `pathlib.Path`
@@ -53,6 +59,9 @@ class PersistentQueue(deque):
         else:
             self.q = deque()
 
+        self._leases = {}
+        self._tokens = count()
+
     def persist(self):
         """Persist the queue to disk."""
         with open(self.path, mode='wb') as file:
@@ -111,3 +120,71 @@ class PersistentQueue(deque):
         """Remove the leftmost item from the queue."""
         self.q.popleft()
         self.persist()
+
+    def lease(self):
+        """Lease the leftmost item on the queue which is not leased.
+
+        Returns
+        -------
+        token : `int`
+            token of the lease, passed to complete() or release()
+        item : object
+            leased item
+
+        Raises
+        ------
+        IndexError
+            every item on the queue is leased
+
+        """
+        # items are matched by identity; an object on the queue n times may be leased n times
+        leased = Counter(id(item) for item in self._leases.values())
+        for item in self.q:
+            if leased[id(item)]:
+                leased[id(item)] -= 1
+                continue
+
+            token = next(self._tokens)
+            self._leases[token] = item
+            return token, item
+
+        raise IndexError('no unleased items on the queue')
+
+    def release(self, token):
+        """Return a leased item to the queue, without removing it.
+
+        Parameters
+        ----------
+        token : `int`
+            token of the lease
+
+        """
+        del self._leases[token]
+
+    def complete(self, token):
+        """Remove a leased item from the queue.
+
+        Parameters
+        ----------
+        token : `int`
+            token of the lease
+
+        """
+        item = self._leases.pop(token)
+        for idx, queued in enumerate(self.q):
+            if queued is item:
+                del self.q[idx]
+                break
+
+        self.persist()
+
+    def available(self):
+        """Number of items on the queue which are not leased.
+
+        Returns
+        -------
+        `int`
+            number of items
+
+        """
+        return len(self.q) - len(self._leases)
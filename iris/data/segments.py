@@ -0,0 +1,272 @@
+"""An append-only document store which packs optimization histories into memory-mapped segment files."""
+import os
+import mmap
+import pickle
+import struct
+from pathlib import Path
+from collections import namedtuple
+
+import numpy as np
+
+# keys of the documents whose values are packed into the .bin files
+HISTORY_KEYS = ('result_iter', 'cost_iter', 'rrmswfe_iter')
+
+# header of a record in a .meta file; the lengths of the id and of the pickled record, bytes
+_FRAME = struct.Struct('<HI')
+
+# where a history is in the .bin file of its segment.  lengths holds the number of iterations
+# of each run, shape the shape of one iteration, and nested if the history is a list of runs.
+PackedHistory = namedtuple('PackedHistory', ['offset', 'lengths', 'shape', 'nested'])
+
+
+class SegmentStore(object):
+    """A store of documents in a few large files instead of one pickle each.
+
+    Documents are appended to the current segment, a pair of files.  The
+    histories of a document are written to the .bin file as flat float64
+    arrays; everything else, and where the histories are, is pickled into a
+    record in the .meta file.  When the .bin file grows past segment_bytes,
+    the next segment is started.  Both files are memory-mapped for reading,
+    so reading a document opens no files and its histories are views of the
+    map.  Appending a document with an id already in the store replaces it.
+
+    Attributes
+    ----------
+    path : `pathlib.Path`
+        folder holding the segments
+    segment_bytes : `int`
+        size of a .bin file after which a new segment is started, bytes
+    locations : `dict`
+        id, (segment, offset of the record in the .meta file) pairs
+
+    """
+
+    def __init__(self, path, segment_bytes=64 * 2 ** 20, readonly=False):
+        """Create a new SegmentStore.
+
+        Parameters
+        ----------
+        path : `str` or `pathlib.Path`
+            folder holding the segments; it is created if it does not exist
+        segment_bytes : `int`, optional
+            size of a .bin file after which a new segment is started, bytes
+        readonly : `bool`, optional
+            if True, the store is being written by another process; nothing
+            is changed on disk, and a record cut short is one not finished yet
+
+        """
+        self.path = Path(path).resolve()
+        if not readonly:
+            self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.readonly = readonly
+        self.locations = {}
+        self.segment = 0
+        self._maps = {}
+        for file in sorted(self.path.glob('*.meta')):
+            self.segment = int(file.stem)
+            self._scan(self.segment)
+
+    def __len__(self):
+        """Number of documents in the store."""
+        return len(self.locations)
+
+    def __contains__(self, id_):
+        """Check if a document is in the store."""
+        return id_ in self.locations
+
+    def _file(self, segment, suffix):
+        """Path to a file of a segment."""
+        return self.path / f'{segment:05d}{suffix}'
+
+    def files(self):
+        """Paths of the files of the segments, in order.
+
+        Returns
+        -------
+        `list` of `pathlib.Path`
+            the .bin and .meta file of each segment which has them
+
+        """
+        files = []
+        for segment in range(self.segment + 1):
+            files.extend(file for file in (self._file(segment, '.bin'), self._file(segment, '.meta')) if file.is_file())
+        return files
+
+    def _scan(self, segment):
+        """Find the records in a .meta file."""
+        file = self._file(segment, '.meta')
+        with open(file, 'rb') as fid:
+            buf = fid.read()
+
+        offset = 0
+        while offset + _FRAME.size <= len(buf):
+            idlen, size = _FRAME.unpack_from(buf, offset)
+            end = offset + _FRAME.size + idlen + size
+            if end > len(buf):
+                break
+            id_ = buf[offset + _FRAME.size:offset + _FRAME.size + idlen].decode()
+            self.locations[id_] = (segment, offset)
+            offset = end
+
+        if offset < len(buf) and not self.readonly:  # a record cut short while it was written
+            os.truncate(file, offset)
+
+    def _map(self, segment, suffix, end):
+        """Memory-map a file of a segment, remapping it if it is shorter than end."""
+        key = (segment, suffix)
+        map_ = self._maps.get(key)
+        if map_ is None or len(map_) < end:
+            # the old map stays alive for as long as views into it do
+            with open(self._file(segment, suffix), 'rb') as fid:
+                map_ = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[key] = map_
+        return map_
+
+    def append(self, id_, document):
+        """Append a document to the store.
+
+        Parameters
+        ----------
+        id_ : `str`
+            string document id
+        document : `dict`
+            the document
+
+        """
+        if self.readonly:
+            raise IOError('the store is read-only')
+
+        data_file = self._file(self.segment, '.bin')
+        offset = data_file.stat().st_size if data_file.is_file() else 0
+        if offset >= self.segment_bytes:
+            self.segment += 1
+            data_file, offset = self._file(self.segment, '.bin'), 0
+
+        fields, histories, chunks = dict(document), {}, []
+        for key in HISTORY_KEYS:
+            packed = _pack(fields.get(key))
+            if packed is not None:
+                flat, lengths, shape, nested = packed
+                histories[key] = PackedHistory(offset, lengths, shape, nested)
+                chunks.append(flat)
+                offset += flat.nbytes
+                del fields[key]
+
+        # the histories are written first, so a record always has its data
+        with open(data_file, 'ab') as fid:
+            for chunk in chunks:
+                fid.write(chunk.tobytes())
+
+        id_bytes = id_.encode()
+        payload = pickle.dumps({'fields': fields, 'histories': histories}, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(self._file(self.segment, '.meta'), 'ab') as fid:
+            fid.seek(0, os.SEEK_END)
+            meta_offset = fid.tell()
+            fid.write(_FRAME.pack(len(id_bytes), len(payload)) + id_bytes + payload)
+
+        self.locations[id_] = (self.segment, meta_offset)
+
+    def _record(self, id_):
+        """Segment and unpickled record of a document."""
+        segment, offset = self.locations[id_]
+        meta = self._map(segment, '.meta', offset + _FRAME.size)
+        idlen, size = _FRAME.unpack_from(meta, offset)
+        start = offset + _FRAME.size + idlen
+        meta = self._map(segment, '.meta', start + size)
+        return segment, pickle.loads(meta[start:start + size])
+
+    def _runs(self, segment, packed):
+        """Views of the runs of a packed history, each of shape (iterations, *shape)."""
+        width = 1
+        for n in packed.shape:
+            width *= n
+        count = sum(packed.lengths) * width
+        if count == 0:
+            flat = np.empty(0, dtype=np.float64)
+        else:
+            data = self._map(segment, '.bin', packed.offset + count * 8)
+            flat = np.frombuffer(data, dtype=np.float64, count=count, offset=packed.offset)
+
+        runs, start = [], 0
+        for length in packed.lengths:
+            runs.append(flat[start:start + length * width].reshape((length, *packed.shape)))
+            start += length * width
+        return runs
+
+    def get(self, id_):
+        """Return a document from the store.
+
+        Parameters
+        ----------
+        id_ : `str`
+            string document id
+
+        Returns
+        -------
+        `dict`
+            the document, shaped as it was appended; the rows of result_iter are
+            read-only views of the segment file
+
+        """
+        segment, record = self._record(id_)
+        document = record['fields']
+        for key, packed in record['histories'].items():
+            runs = [run.tolist() if not packed.shape else list(run) for run in self._runs(segment, packed)]
+            document[key] = runs if packed.nested else runs[0]
+        return document
+
+    def history(self, id_, key):
+        """Return a history of a document without copying it.
+
+        Parameters
+        ----------
+        id_ : `str`
+            string document id
+        key : `str`
+            key of the history, e.g. 'cost_iter'
+
+        Returns
+        -------
+        `list` of `numpy.ndarray`
+            read-only view of each run of the history, of shape (iterations, *shape of one iteration)
+
+        """
+        segment, record = self._record(id_)
+        return self._runs(segment, record['histories'][key])
+
+
+def _pack(history):
+    """Pack a history into a flat array.
+
+    Returns
+    -------
+    flat : `numpy.ndarray`
+        float64 values of every iteration of every run
+    lengths : `tuple`
+        number of iterations of each run
+    shape : `tuple`
+        shape of one iteration
+    nested : `bool`
+        True if the history is a list of runs
+
+    or None if the history cannot be packed, and is kept in the record as it is
+
+    """
+    if not isinstance(history, list):
+        return None
+
+    nested = len(history) > 0 and isinstance(history[0], list)
+    runs = history if nested else [history]
+    try:
+        arrays = [np.asarray(run, dtype=np.float64) for run in runs]
+    except (TypeError, ValueError):  # ragged or not numbers
+        return None
+
+    shapes = set(array.shape[1:] for array in arrays if array.size)
+    if len(shapes) > 1 or any(array.ndim == 0 for array in arrays):
+        return None
+
+    shape = shapes.pop() if shapes else ()
+    flat = np.concatenate([array.ravel() for array in arrays]) if arrays else np.empty(0)
+    return flat, tuple(len(run) for run in runs), shape, nested
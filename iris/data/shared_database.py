@@ -0,0 +1,234 @@
+"""A database which many processes, on one machine or several, append to at once."""
+import os
+import json
+import uuid
+import socket
+from pathlib import Path
+
+from pandas.errors import EmptyDataError
+
+from iris.data.database import Database, DatabaseView
+
+
+class SharedDatabase(object):
+    """A database which many processes append to at once.
+
+    Each process which appends writes its own `Database` in the writers
+    folder.  No file is written by two processes and no lock is taken, so
+    this holds on filesystems shared by several machines, too.  The
+    databases of the other writers are opened read-only and seen through a
+    `DatabaseView`.  The view is a snapshot of the documents which were
+    complete when the SharedDatabase was opened or last refreshed; the
+    appends of this process are seen at once.  has_job reads the new
+    fingerprints of every writer when a fingerprint is not known, so jobs
+    finished by other writers are found without a refresh.
+
+    Attributes
+    ----------
+    path : `pathlib.Path`
+        folder holding the database
+    fields : `tuple` of `str`
+        fields of the index
+    store : `str`
+        how this process stores documents, see `Database`
+    writer_id : `str`
+        name of the folder this process writes
+    writer : `Database` or None
+        the database this process writes; made on its first append
+    view : `DatabaseView`
+        the databases of every writer
+
+    """
+
+    def __init__(self, path, fields=None, store='pickle', writer_id=None, cache_size=1024, cache_bytes=None):
+        """Create a new SharedDatabase.
+
+        Parameters
+        ----------
+        path : `pathlib.Path` or `str`
+            path to the folder containing the database
+        fields : iterable, optional
+            fields of the index; if there is no database at path, one is made
+            with them, else they must be its fields
+        store : `str`, optional, {'pickle', 'segments'}
+            how this process stores documents
+        writer_id : `str`, optional
+            name of the folder this process writes, to continue one written
+            before; if None, a new name unique to this process.  Two
+            processes must never write the same folder.
+        cache_size : `int`, optional
+            most documents held in memory per writer, see `Database`
+        cache_bytes : `int`, optional
+            most bytes of documents held in memory per writer, see `Database`
+
+        Raises
+        ------
+        IOError
+            if fields is None and there is no database at path
+        ValueError
+            if fields are not the fields of the database at path
+
+        """
+        self.path = Path(path).resolve()
+        self.writers_root = self.path / 'writers'
+        manifest = self.path / 'shared.json'
+        if fields is not None:
+            if 'id' in fields:
+                raise ValueError('cannot use id as a field')
+            self.path.mkdir(parents=True, exist_ok=True)
+            tmp = self.path / f'shared.{uuid.uuid4().hex}.tmp'
+            with open(tmp, 'w') as fid:
+                json.dump({'fields': list(fields)}, fid)
+            try:
+                os.link(tmp, manifest)  # atomic, and fails if another process made the database first
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp)
+
+        try:
+            with open(manifest, 'r') as fid:
+                self.fields = tuple(json.load(fid)['fields'])
+        except FileNotFoundError:
+            raise IOError('There is no shared database at this location.  Create it by passing fields.')
+        if fields is not None and tuple(fields) != self.fields:
+            raise ValueError(f'the database at this location has fields {self.fields}')
+
+        if writer_id is None:
+            writer_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.writer_id = writer_id
+        self.store = store
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.writer = None
+        self.view = DatabaseView([])
+        self._fingerprints = set()
+        self._offsets = {}  # writer id: bytes of its fingerprints.txt read
+        self.refresh()
+
+    def _folders(self):
+        """Folders of the writers, sorted by name."""
+        try:
+            return sorted(folder for folder in self.writers_root.iterdir() if folder.is_dir())
+        except FileNotFoundError:
+            return []
+
+    def refresh(self):
+        """Take a new snapshot of the documents of the other writers."""
+        databases = []
+        for folder in self._folders():
+            if folder.name == self.writer_id:
+                if self.writer is None and (folder / 'index.csv').is_file():  # continuing a folder written before
+                    self.writer = Database(folder, store=self.store, cache_size=self.cache_size,
+                                           cache_bytes=self.cache_bytes)
+                if self.writer is not None:
+                    databases.append(self.writer)
+                continue
+            try:
+                databases.append(Database(folder, readonly=True, cache_size=self.cache_size,
+                                          cache_bytes=self.cache_bytes))
+            except (FileNotFoundError, EmptyDataError):  # no document yet, or the first is being written
+                continue
+
+        self.view = DatabaseView(databases)
+        self._poll_fingerprints()
+
+    def _writer(self):
+        """The database this process writes, made if it does not exist."""
+        if self.writer is None:
+            self.writer = Database(self.writers_root / self.writer_id, fields=self.fields, store=self.store,
+                                   cache_size=self.cache_size, cache_bytes=self.cache_bytes)
+            self.view = DatabaseView([*self.view.databases, self.writer])
+        return self.writer
+
+    def _poll_fingerprints(self):
+        """Read the fingerprints appended by every writer since they were last read."""
+        for folder in self._folders():
+            offset = self._offsets.get(folder.name, 0)
+            try:
+                with open(folder / 'fingerprints.txt', 'rb') as fid:
+                    fid.seek(offset)
+                    data = fid.read()
+            except FileNotFoundError:
+                continue
+            complete = data[:data.rfind(b'\n') + 1]  # a line being written is read next time
+            self._offsets[folder.name] = offset + len(complete)
+            self._fingerprints.update(complete.decode().split())
+
+    @property
+    def databases(self):
+        """Databases of the writers in the snapshot, e.g. to compact them with `iris.data.database.merge_databases`."""
+        return self.view.databases
+
+    @property
+    def df(self):
+        return self.view.df
+
+    @property
+    def doc_ids(self):
+        return self.view.doc_ids
+
+    @property
+    def fingerprints(self):
+        """Fingerprints of the jobs in the database."""
+        self._poll_fingerprints()
+        return self._fingerprints
+
+    def has_job(self, fingerprint):
+        """Check if any writer has appended the result of a job, see `Database.has_job`."""
+        if fingerprint not in self._fingerprints:
+            self._poll_fingerprints()
+        return fingerprint in self._fingerprints
+
+    def dedupe_queue(self, queue, fingerprint):
+        """Remove the jobs from a queue whose results are already in the database, see `Database.dedupe_queue`."""
+        self._poll_fingerprints()
+        before = len(queue.q)
+        queue.q = type(queue.q)(item for item in queue.q if fingerprint(item) not in self._fingerprints)
+        removed = before - len(queue.q)
+        if removed:
+            queue.persist()
+        return removed
+
+    def append(self, document, fingerprint=None):
+        """Append a document to the database of this process, see `Database.append`."""
+        self._writer().append(document, fingerprint)
+        if fingerprint is not None:
+            self._fingerprints.add(fingerprint)
+
+    def update_document(self, id_, document):
+        """Replace a document appended by this process, see `Database.update_document`.
+
+        Raises
+        ------
+        IOError
+            if the document was appended by another process
+
+        """
+        if self.writer is None or id_ not in set(self.writer.doc_ids):
+            raise IOError('only the documents appended by this process can be updated')
+        self.writer.update_document(id_, document)
+
+    def get_document(self, id_):
+        """Return a document, see `Database.get_document`."""
+        return self.view.get_document(id_)
+
+    def get_documents(self, ids, nthreads=None):
+        """Return several documents, see `Database.get_documents`."""
+        return self.view.get_documents(ids, nthreads)
+
+    def get_history(self, id_, key):
+        """Return a history of a document, see `Database.get_history`."""
+        return self.view.get_history(id_, key)
+
+    def get_vectors(self, key):
+        """Return the materialized array of a vector field of the documents, see `Database.get_vectors`."""
+        return self.view.get_vectors(key)
+
+    def find(self, key='truth_params', ranges=None, norms=None, radius=None):
+        """Find documents by their truth or result vectors, see `Database.find`."""
+        return self.view.find(key, ranges, norms, radius)
+
+    def select(self, where=None, params=(), columns=None):
+        """Select rows of the index, see `Database.select`."""
+        return self.view.select(where, params, columns)
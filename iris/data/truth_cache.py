@@ -0,0 +1,161 @@
+"""A size-bounded on-disk cache of truth through-focus MTF data."""
+import os
+import uuid
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+
+def truth_key(config, codex, truth):
+    """Compute the key of a truth in the cache.
+
+    Parameters
+    ----------
+    config : `prysm.macros.SimulationConfig`
+        simulation configuration
+    codex : `dict`
+        dict with integer, string key value pairs, e.g. {0: 'Z1', 1: 'Z9'}
+    truth : iterable
+        truth coefficients
+
+    Returns
+    -------
+    `str`
+        hex digest of the config, codex, and truth
+
+    """
+    h = hashlib.sha1()
+    for field, value in zip(config._fields, config):
+        h.update(field.encode())
+        if type(value) is np.ndarray:
+            h.update(str(value.shape).encode())
+            h.update(np.ascontiguousarray(value).tobytes())
+        else:
+            h.update(repr(value).encode())
+
+    h.update(repr(sorted(codex.items())).encode())
+    h.update(np.asarray(truth, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class TruthCache(object):
+    """A content-addressed cache of axial truth MTF data on disk.
+
+    Each entry is one .npy file named by its key, holding the focus
+    diversity, tangential and sagittal MTF of a truth as the columns of a
+    single float64 array.  Entries are written atomically, so several
+    processes may share a cache.  When the entries exceed max_bytes, the
+    least recently used are deleted.
+
+    Attributes
+    ----------
+    path : `pathlib.Path`
+        folder holding the cache
+    max_bytes : `int`
+        maximum total size of the entries, bytes
+    hits : `int`
+        number of lookups which found an entry
+    misses : `int`
+        number of lookups which did not find an entry
+
+    """
+
+    def __init__(self, path, max_bytes=256 * 2 ** 20):
+        """Create a new TruthCache.
+
+        Parameters
+        ----------
+        path : `str` or `pathlib.Path`
+            folder to hold the cache; it is created if it does not exist
+        max_bytes : `int`, optional
+            maximum total size of the entries, bytes
+
+        """
+        self.path = Path(path).resolve()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Look up a truth in the cache.
+
+        Parameters
+        ----------
+        key : `str`
+            key of the truth, see `truth_key`
+
+        Returns
+        -------
+        `tuple` or None
+            (focus diversity, tangential MTF, sagittal MTF) as returned by
+            `iris.recipes.grab_axial_data`, or None if the truth is not cached
+
+        """
+        file = self.path / f'{key}.npy'
+        try:
+            packed = np.load(file)
+            os.utime(file)  # mark as recently used
+        except (OSError, ValueError):  # missing, evicted by another process, or unreadable
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        nfreqs = (packed.shape[1] - 1) // 2
+        return packed[:, 0], packed[:, 1:1 + nfreqs], packed[:, 1 + nfreqs:]
+
+    def put(self, key, focus, tan, sag):
+        """Store a truth in the cache.
+
+        Parameters
+        ----------
+        key : `str`
+            key of the truth, see `truth_key`
+        focus : `numpy.ndarray`
+            focus diversity, shape (planes,)
+        tan : `numpy.ndarray`
+            tangential MTF, shape (planes, freqs)
+        sag : `numpy.ndarray`
+            sagittal MTF, shape (planes, freqs)
+
+        """
+        packed = np.column_stack((focus, tan, sag)).astype(np.float64)
+        tmp = self.path / f'{key}.{uuid.uuid4().hex}.tmp'
+        with open(tmp, 'wb') as fid:
+            np.save(fid, packed)
+        os.replace(tmp, self.path / f'{key}.npy')
+        self._evict()
+
+    def _evict(self):
+        """Delete the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for file in self.path.glob('*.npy'):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, file in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    @property
+    def nbytes(self):
+        """Total size of the entries, bytes."""
+        return sum(file.stat().st_size for file in self.path.glob('*.npy'))
+
+    def clear(self):
+        """Delete every entry."""
+        for file in self.path.glob('*.npy'):
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,312 @@
+"""Materialized arrays of the truth and result vectors of the documents in a database."""
+import os
+import json
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+# keys of the documents whose values are materialized
+VECTOR_KEYS = ('truth_params', 'result_final')
+
+
+class VectorIndex(object):
+    """Arrays of (documents, coefficients) of vector fields of documents.
+
+    For each key, the vector of each document is appended to a raw float64
+    file as one row; the id of the document is appended to ids.txt after its
+    rows are written.  The arrays are held in memory, so they are queried
+    without reading any document.  The length of the rows of a key is set by
+    the first document which has it; shorter vectors are padded with NaN, as
+    are documents without the key.
+
+    Attributes
+    ----------
+    path : `pathlib.Path`
+        folder holding the arrays
+    keys : `tuple` of `str`
+        keys of the documents which are materialized
+    widths : `dict`
+        key, number of coefficients pairs
+    ids : `list` of `str`
+        id of the document of each row
+
+    """
+
+    def __init__(self, path, keys=VECTOR_KEYS, readonly=False):
+        """Create a new VectorIndex.
+
+        Parameters
+        ----------
+        path : `str` or `pathlib.Path`
+            folder holding the arrays; it is created if it does not exist
+        keys : iterable of `str`, optional
+            keys of the documents to materialize
+        readonly : `bool`, optional
+            if True, the arrays are being written by another process; nothing
+            is changed on disk, rows appended are only held in memory, and
+            rows without an id are ones not finished yet
+
+        """
+        self.path = Path(path).resolve()
+        if not readonly:
+            self.path.mkdir(parents=True, exist_ok=True)
+        self.keys = tuple(keys)
+        self.readonly = readonly
+        try:
+            with open(self.path / 'layout.json', 'r') as fid:
+                self.widths = json.load(fid)
+        except FileNotFoundError:
+            self.widths = {}
+
+        self.ids = self._load_ids()
+        self.rows = {id_: row for row, id_ in enumerate(self.ids)}
+        self._ids_array = None
+        self._buffers = {}  # key: array with room for more rows than there are documents
+        for key, width in self.widths.items():
+            file = self._file(key)
+            values = np.fromfile(file, dtype=np.float64) if file.is_file() else np.empty(0)
+            if values.size > len(self.ids) * width:  # rows of a document whose id was not written
+                values = values[:len(self.ids) * width]
+                if not readonly:
+                    os.truncate(file, values.nbytes)
+            self._buffers[key] = values.reshape((len(self.ids), width))
+
+    def __len__(self):
+        """Number of documents in the index."""
+        return len(self.ids)
+
+    def __contains__(self, id_):
+        """Check if a document is in the index."""
+        return id_ in self.rows
+
+    def _file(self, key):
+        """Path to the array of a key."""
+        return self.path / f'{key}.f64'
+
+    def _load_ids(self):
+        """Read the ids, dropping a line cut short while it was written."""
+        file = self.path / 'ids.txt'
+        try:
+            with open(file, 'r') as fid:
+                text = fid.read()
+        except FileNotFoundError:
+            return []
+
+        complete = text[:text.rfind('\n') + 1]
+        if len(complete) < len(text) and not self.readonly:
+            os.truncate(file, len(complete.encode()))
+        return complete.splitlines()
+
+    def _row(self, key, document):
+        """Vector of a document as a row of the array of key, or None if the key is not materialized yet."""
+        width = self.widths.get(key)
+        value = document.get(key)
+        if value is None:
+            return None if width is None else np.full(width, np.nan)
+
+        value = np.asarray(value, dtype=np.float64).ravel()
+        if width is None:
+            return value
+        if value.size > width:
+            raise ValueError(f'{key} has {value.size} coefficients, the database holds {width}')
+        row = np.full(width, np.nan)
+        row[:value.size] = value
+        return row
+
+    def check(self, document):
+        """Check that the vectors of a document fit in the index.
+
+        Parameters
+        ----------
+        document : `dict`
+            the document
+
+        Raises
+        ------
+        ValueError
+            if a vector has more coefficients than the index holds for its key
+
+        """
+        for key in self.keys:
+            self._row(key, document)
+
+    def append(self, id_, document):
+        """Append the vectors of a document.
+
+        Parameters
+        ----------
+        id_ : `str`
+            string document id
+        document : `dict`
+            the document
+
+        Raises
+        ------
+        ValueError
+            if a vector has more coefficients than the index holds for its key
+
+        """
+        rows = {key: self._row(key, document) for key in self.keys}
+        self.extend([id_], {key: row[np.newaxis] for key, row in rows.items() if row is not None})
+
+    def extend(self, ids, values):
+        """Append the vectors of several documents at once.
+
+        Parameters
+        ----------
+        ids : `list` of `str`
+            string document ids
+        values : `dict`
+            key, array of shape (len(ids), coefficients) pairs; the rows of a
+            key which is not present are NaN
+
+        Raises
+        ------
+        ValueError
+            if the arrays have more coefficients than the index holds for their key
+
+        """
+        m = len(ids)
+        if m == 0:
+            return
+
+        rows = {}
+        for key in self.keys:
+            width = self.widths.get(key)
+            if values.get(key) is None:
+                if width is not None:
+                    rows[key] = np.full((m, width), np.nan)
+                continue
+
+            value = np.asarray(values[key], dtype=np.float64).reshape((m, -1))
+            if width is not None and value.shape[1] != width:
+                if value.shape[1] > width:
+                    raise ValueError(f'{key} has {value.shape[1]} coefficients, the database holds {width}')
+                padded = np.full((m, width), np.nan)
+                padded[:, :value.shape[1]] = value
+                value = padded
+            rows[key] = value
+
+        new = {key: value.shape[1] for key, value in rows.items() if key not in self.widths}
+        if new:
+            for key, width in new.items():
+                # documents before the first with this key have a row of NaN
+                self._buffers[key] = np.full((len(self.ids), width), np.nan)
+                if not self.readonly:
+                    self._buffers[key].tofile(str(self._file(key)))
+            self.widths.update(new)
+            if not self.readonly:
+                tmp = self.path / f'layout.{uuid.uuid4().hex}.tmp'
+                with open(tmp, 'w') as fid:
+                    json.dump(self.widths, fid)
+                os.replace(tmp, self.path / 'layout.json')
+
+        n = len(self.ids)
+        for key, value in rows.items():
+            if not self.readonly:
+                with open(self._file(key), 'ab') as fid:
+                    fid.write(value.tobytes())
+            buffer = self._buffers[key]
+            if buffer.shape[0] < n + m:  # full, double its room so appends are amortized O(1)
+                grown = np.empty((max(2 * n, n + m, 16), buffer.shape[1]))
+                grown[:n] = buffer[:n]
+                self._buffers[key] = buffer = grown
+            buffer[n:n + m] = value
+
+        # written last, so an id on disk always has its rows
+        if not self.readonly:
+            with open(self.path / 'ids.txt', 'a') as fid:
+                fid.write(''.join(id_ + '\n' for id_ in ids))
+        self.rows.update((id_, n + i) for i, id_ in enumerate(ids))
+        self.ids.extend(ids)
+        self._ids_array = None
+
+    def update(self, id_, document):
+        """Replace the vectors of a document in the index.
+
+        Parameters
+        ----------
+        id_ : `str`
+            string document id
+        document : `dict`
+            the document
+
+        """
+        if self.readonly:
+            raise IOError('the index is read-only')
+
+        row = self.rows[id_]
+        for key in self.widths:
+            value = self._row(key, document)
+            with open(self._file(key), 'r+b') as fid:
+                fid.seek(row * value.nbytes)
+                fid.write(value.tobytes())
+            self._buffers[key][row] = value
+
+    def values(self, key):
+        """Array of a key.
+
+        Parameters
+        ----------
+        key : `str`
+            key of the documents, e.g. 'truth_params'
+
+        Returns
+        -------
+        ids : `numpy.ndarray`
+            id of the document of each row
+        values : `numpy.ndarray`
+            array of shape (documents, coefficients)
+
+        """
+        if self._ids_array is None:
+            self._ids_array = np.asarray(self.ids, dtype=object)
+        if key not in self.widths:
+            return self._ids_array, np.empty((len(self.ids), 0))
+        return self._ids_array, self._buffers[key][:len(self.ids)]
+
+    def find(self, key='truth_params', ranges=None, norms=None, radius=None):
+        """Find the documents whose vector satisfies every condition.
+
+        Parameters
+        ----------
+        key : `str`, optional
+            key of the documents, e.g. 'truth_params' or 'result_final'
+        ranges : `dict`, optional
+            index, (low, high) pairs; low <= vector[index] <= high.  Either
+            bound may be None.
+        norms : `dict`, optional
+            indices, (low, high) pairs; low <= norm(vector[indices]) <= high,
+            e.g. {(3, 4): (0.04, 0.06)} for the magnitude of a pair of terms.
+            Either bound may be None.
+        radius : `tuple`, optional
+            (indices, center, radius); norm(vector[indices] - center) <= radius
+
+        Returns
+        -------
+        `numpy.ndarray`
+            ids of the documents, in the order they were appended
+
+        """
+        ids, values = self.values(key)
+        mask = np.ones(len(ids), dtype=bool)
+        for index, (low, high) in (ranges or {}).items():
+            mask &= _within(values[:, index], low, high)
+        for indices, (low, high) in (norms or {}).items():
+            mask &= _within(np.sqrt((values[:, list(indices)] ** 2).sum(axis=1)), low, high)
+        if radius is not None:
+            indices, center, r = radius
+            offset = values[:, list(indices)] - np.asarray(center, dtype=np.float64)
+            mask &= (offset ** 2).sum(axis=1) <= r ** 2
+        return ids[mask]
+
+
+def _within(values, low, high):
+    """Mask of values in [low, high]; either bound may be None."""
+    mask = np.ones(values.shape, dtype=bool)
+    if low is not None:
+        mask &= values >= low
+    if high is not None:
+        mask &= values <= high
+    return mask
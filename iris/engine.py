@@ -0,0 +1,740 @@
+"""Batched forward model which realizes every focal plane in a single stacked FFT."""
+import time
+from functools import lru_cache
+from collections import namedtuple
+
+import numpy as np
+import scipy.fft
+
+from prysm.fringezernike import zcache
+from prysm.geometry import mcache
+from prysm.propagation import prop_pupil_plane_to_psf_plane_units
+from prysm.fttools import forward_ft_unit
+
+# padding factor used by prysm.MTF.from_pupil
+Q = 2
+
+# number of compiled bases kept alive; an optimization uses one or two
+BASIS_CACHE_SIZE = 16
+
+# number of defocus phasors kept alive, one per plane and dtype; an optimization uses one or two per plane
+PHASOR_CACHE_SIZE = 64
+
+# methods available to compute the OTF, see thrufocus_ts_mtf
+OTF_BACKENDS = ('fft', 'mft', 'autocorr')
+
+# complex dtype used by the forward model for each precision
+PRECISIONS = {
+    'double': np.complex128,
+    'single': np.complex64,
+}
+
+# holds the padded array size and the interpolation weights used to extract T/S MTF at cfg.freqs;
+# bins are the only frequency samples the interpolation touches and dft evaluates the FT there
+TSSampling = namedtuple('TSSampling', ['padded_samples', 'idx_lo', 'idx_hi', 'slope_den', 'slope_num',
+                                       'bins', 'dft'])
+
+# holds a set of Zernike polynomials evaluated at the pixels inside the pupil;
+# matrix has shape (pixels, terms), inside holds the flat indices of those pixels
+# in the (samples, samples) grid, and amplitude the value of the mask there
+ZernikeBasis = namedtuple('ZernikeBasis', ['terms', 'samples', 'inside', 'amplitude', 'matrix'])
+
+
+class _ArrayKey(object):
+    """Hashable wrapper around an ndarray mask so it can key the basis cache."""
+
+    def __init__(self, array):
+        self.array = array
+        self._key = (array.shape, array.tobytes())
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __eq__(self, other):
+        return isinstance(other, _ArrayKey) and self._key == other._key
+
+
+@lru_cache(maxsize=BASIS_CACHE_SIZE)
+def _compile_basis(terms, samples, mask, rms_norm):
+    """Evaluate and stack the masked Zernike polynomials for a set of terms.
+
+    Parameters
+    ----------
+    terms : `tuple` of `str`
+        Zernike names, e.g. ('Z4', 'Z9')
+    samples : `int`
+        number of samples across the pupil
+    mask : `str` or `_ArrayKey`
+        mask used to define the pupil
+    rms_norm : `bool`
+        whether the polynomials are normalized to unit RMS
+
+    Returns
+    -------
+    `ZernikeBasis`
+        the compiled basis
+
+    """
+    if isinstance(mask, _ArrayKey):
+        amplitude = mask.array
+    else:
+        amplitude = mcache.get_mask(samples, mask)
+
+    inside = np.flatnonzero(amplitude)
+    matrix = np.empty((len(inside), len(terms)), dtype=np.float64)
+    for idx, term in enumerate(terms):
+        # base 1 names, e.g. Z4, to the base 0 index used by prysm
+        zern = zcache.get_zernike(int(term[1:]) - 1, rms_norm, samples)
+        matrix[:, idx] = zern.ravel()[inside]
+
+    amplitude = amplitude.ravel()[inside]
+    for arr in (inside, amplitude, matrix):
+        arr.flags.writeable = False
+
+    return ZernikeBasis(terms=terms, samples=samples, inside=inside, amplitude=amplitude, matrix=matrix)
+
+
+def zernike_basis(codex, samples, mask='circle', rms_norm=True):
+    """Get the (cached) compiled Zernike basis for a codex.
+
+    Parameters
+    ----------
+    codex : `dict`
+        dict with integer, string key value pairs, e.g. {0: 'Z1', 1: 'Z9'}
+    samples : `int`
+        number of samples across the pupil
+    mask : `str` or `numpy.ndarray`, optional
+        mask used to define the pupil
+    rms_norm : `bool`, optional
+        whether the polynomials are normalized to unit RMS
+
+    Returns
+    -------
+    `ZernikeBasis`
+        the compiled basis
+
+    Notes
+    -----
+    The cache lives for the life of the process and is keyed by the codex
+    values, samples, mask, and normalization.  It holds up to
+    BASIS_CACHE_SIZE entries and evicts the least recently used one.
+
+    """
+    if type(mask) is np.ndarray:
+        mask = _ArrayKey(mask)
+    key = (tuple(codex.values()), samples, mask, rms_norm)
+    try:
+        return _installed_bases[key]
+    except KeyError:
+        return _compile_basis(*key)
+
+
+# bases compiled elsewhere, e.g. in another process and passed through shared memory
+_installed_bases = {}
+
+
+def install_basis(basis, mask='circle', rms_norm=True):
+    """Install a compiled basis so that `zernike_basis` returns it instead of compiling its own.
+
+    Parameters
+    ----------
+    basis : `ZernikeBasis`
+        a compiled basis, e.g. with arrays which are views of shared memory
+    mask : `str` or `numpy.ndarray`, optional
+        mask the basis was compiled with
+    rms_norm : `bool`, optional
+        whether the polynomials of the basis are normalized to unit RMS
+
+    """
+    if type(mask) is np.ndarray:
+        mask = _ArrayKey(mask)
+    _installed_bases[(tuple(basis.terms), basis.samples, mask, rms_norm)] = basis
+
+
+def clear_installed_bases():
+    """Remove all bases installed with `install_basis`."""
+    _installed_bases.clear()
+
+
+def defocus_basis(cfg):
+    """Get the (cached) compiled basis for the defocus term of a simulation config.
+
+    Parameters
+    ----------
+    cfg : `prysm.macros.SimulationConfig`
+        a simulation config
+
+    Returns
+    -------
+    `ZernikeBasis`
+        the compiled basis, with a single term
+
+    """
+    return zernike_basis({0: 'Z4'}, cfg.samples, cfg.mask)
+
+
+def basis_phase(basis, params):
+    """Compute the phase inside the pupil for a parameter vector.
+
+    Parameters
+    ----------
+    basis : `ZernikeBasis`
+        compiled basis
+    params : iterable
+        coefficient for each term of the basis
+
+    Returns
+    -------
+    `numpy.ndarray`
+        1D array of phase at each pixel of basis.inside
+
+    """
+    return basis.matrix @ np.asarray(params, dtype=basis.matrix.dtype)
+
+
+def basis_phase_2d(basis, params):
+    """Compute the phase over the full grid for a parameter vector.
+
+    Parameters
+    ----------
+    basis : `ZernikeBasis`
+        compiled basis
+    params : iterable
+        coefficient for each term of the basis
+
+    Returns
+    -------
+    `numpy.ndarray`
+        2D array of phase, NaN outside the pupil
+
+    """
+    phase = np.full((basis.samples, basis.samples), np.nan)
+    phase.ravel()[basis.inside] = basis_phase(basis, params)
+    return phase
+
+
+def residual_rms(basis, reference, params):
+    """Compute the RMS of the phase difference of many parameter vectors to a reference.
+
+    Parameters
+    ----------
+    basis : `ZernikeBasis`
+        compiled basis
+    reference : iterable
+        reference coefficient for each term of the basis, e.g. the truth
+    params : array_like
+        array of shape (k, len(basis.terms)), a parameter vector in each row
+
+    Returns
+    -------
+    `numpy.ndarray`
+        array of shape (k,), RMS of the phase of reference - params[i] inside the pupil
+
+    Notes
+    -----
+    With d = reference - params[i] and B the basis matrix over the N samples
+    inside the pupil, the mean square of B d is d^T G d, G = B^T B / N the Gram
+    matrix of the masked basis.  All k values are one quadratic form of size
+    len(terms), instead of a pupil for each vector.  G is close to the
+    identity for a normalized basis, but not exactly so once sampled and masked,
+    so it is always used.
+
+    """
+    diff = np.asarray(reference, dtype=np.float64)[np.newaxis, :] - np.atleast_2d(np.asarray(params, dtype=np.float64))
+    gram = basis.matrix.T @ basis.matrix / basis.matrix.shape[0]
+    return np.sqrt(np.maximum(np.einsum('ki,ij,kj->k', diff, gram, diff), 0))
+
+
+@lru_cache(maxsize=32)
+def _ts_sampling(samples, epd, efl, wvl, freqs):
+    """Compute the frequency grid of a propagation and the interpolation weights for the given freqs.
+
+    Parameters
+    ----------
+    samples : `int`
+        number of samples across the pupil
+    epd : `float`
+        entrance pupil diameter, mm
+    efl : `float`
+        effective focal length, mm
+    wvl : `float`
+        wavelength of light, um
+    freqs : `tuple`
+        spatial frequencies to extract, cy/mm
+
+    Returns
+    -------
+    `TSSampling`
+        namedtuple holding the padded samples and the interpolation indices and weights
+
+    Raises
+    ------
+    ValueError
+        if any frequency lies outside the band of the propagation
+
+    """
+    padded = int(samples * Q)
+    pupil_unit = np.linspace(-epd / 2, epd / 2, samples)
+    psf_unit, _ = prop_pupil_plane_to_psf_plane_units(np.empty((samples, samples)),
+                                                      pupil_unit[1] - pupil_unit[0], efl, wvl, Q)
+    # only the nonnegative half of the grid is used; after fftshift it is index [padded//2:],
+    # before fftshift it is index [:padded//2]
+    unit = forward_ft_unit((psf_unit[1] - psf_unit[0]) / 1e3, padded)[padded // 2:]
+    freqs = np.asarray(freqs, dtype=unit.dtype)
+    if freqs.min() < unit[0] or freqs.max() > unit[-1]:
+        raise ValueError('requested frequencies lie outside the band of the propagation.')
+
+    # same arithmetic as scipy.interpolate.interp1d with kind='linear'
+    idx_hi = np.clip(np.searchsorted(unit, freqs), 1, len(unit) - 1)
+    idx_lo = idx_hi - 1
+    bins = np.unique(np.concatenate((idx_lo, idx_hi)))
+    dft = np.exp(-1j * 2 * np.pi * np.outer(np.arange(padded), bins) / padded)
+    return TSSampling(
+        padded_samples=padded,
+        idx_lo=idx_lo,
+        idx_hi=idx_hi,
+        slope_den=unit[idx_hi] - unit[idx_lo],
+        slope_num=freqs - unit[idx_lo],
+        bins=bins,
+        dft=dft)
+
+
+def ts_sampling(cfg):
+    """Get the (cached) T/S sampling for a simulation config.
+
+    Parameters
+    ----------
+    cfg : `prysm.macros.SimulationConfig`
+        a simulation config
+
+    Returns
+    -------
+    `TSSampling`
+        namedtuple holding the padded samples and the interpolation indices and weights
+
+    """
+    return _ts_sampling(cfg.samples, cfg.efl / cfg.fno, cfg.efl, cfg.wvl, tuple(cfg.freqs))
+
+
+def focus_stack(cfg, phase, defocuses, padded=True):
+    """Build the stack of complex pupil functions for each focal plane.
+
+    Parameters
+    ----------
+    cfg : `prysm.macros.SimulationConfig`
+        a simulation config
+    phase : `numpy.ndarray`
+        1D array of the notionally in-focus phase at the pixels inside the pupil, waves
+    defocuses : `numpy.ndarray`
+        defocus for each plane, in the same units as the Zernike coefficients
+    padded : `bool`, optional
+        if True, zero pad the pupils for propagation
+
+    Returns
+    -------
+    `numpy.ndarray`
+        array of shape (planes, samples, samples) holding the wavefunction of
+        each plane.  If padded, samples is the padded sample count and the
+        pupil is in the upper left corner of the array
+
+    """
+    z4 = defocus_basis(cfg)
+    return _focus_stack(cfg, z4.amplitude * np.exp(1j * 2 * np.pi * phase), defocuses, padded)
+
+
+def _focus_stack(cfg, field, defocuses, padded=True):
+    """Build the stack of pupil functions from the in-focus field at the pixels inside the pupil.
+
+    The stack has the dtype of field.
+    """
+    z4 = defocus_basis(cfg)
+    m = ts_sampling(cfg).padded_samples if padded else cfg.samples
+    phasors = defocus_phasors(cfg, defocuses, field.dtype)
+    fcn = np.zeros((len(phasors), m, m), dtype=field.dtype)
+    fcn.reshape(len(phasors), -1)[:, _padded_index(z4.inside, cfg.samples, m)] = field[np.newaxis, :] * phasors
+    return fcn
+
+
+@lru_cache(maxsize=PHASOR_CACHE_SIZE)
+def _compile_defocus_phasor(samples, mask, defocus, dtype):
+    """Evaluate exp(i 2pi defocus Z4) at the pixels inside the pupil."""
+    z4 = _compile_basis(('Z4',), samples, mask, True)
+    phasor = np.exp(1j * 2 * np.pi * defocus * z4.matrix[:, 0]).astype(dtype)
+    phasor.flags.writeable = False
+    return phasor
+
+
+def defocus_phasors(cfg, defocuses, dtype=np.complex128):
+    """Get the (cached) stack of defocus phasors for a simulation config.
+
+    Parameters
+    ----------
+    cfg : `prysm.macros.SimulationConfig`
+        a simulation config
+    defocuses : `numpy.ndarray`
+        defocus for each plane, in the same units as the Zernike coefficients
+    dtype : `numpy.dtype`, optional
+        complex dtype of the phasors
+
+    Returns
+    -------
+    `numpy.ndarray`
+        array of shape (planes, pixels) of exp(i 2pi defocus Z4) at the pixels
+        inside the pupil
+
+    Notes
+    -----
+    Every plane shares the phase of the parameter vector and differs only in
+    defocus, so the pupil of a plane is exp(i 2pi phase) times its phasor and
+    a cost function evaluation needs one complex exponential per pixel instead
+    of one per plane per pixel.  The cache is keyed by samples, mask, and the
+    defocus value and dtype of each plane, and holds up to PHASOR_CACHE_SIZE
+    planes, so the planes of an optimization split into batches over workers
+    in any way are each computed once.
+
+    """
+    mask = cfg.mask
+    if type(mask) is np.ndarray:
+        mask = _ArrayKey(mask)
+    dtype = np.dtype(dtype)
+    phasors = [_compile_defocus_phasor(cfg.samples, mask, float(d), dtype) for d in np.ravel(defocuses)]
+    if len(phasors) == 1:
+        return phasors[0][np.newaxis]
+    return np.stack(phasors)
+
+
+def _fft_module(arr):
+    """Get the FFT implementation for an array; numpy.fft always computes in double precision."""
+    if arr.dtype in (np.complex64, np.float32):
+        return scipy.fft
+    return np.fft
+
+
+def _pupil_field(basis, params, precision):
+    """Compute the complex in-focus pupil at the pixels inside the pupil in the given precision."""
+    try:
+        dtype = PRECISIONS[precision]
+    except KeyError:
+        raise ValueError(f'precision must be one of {tuple(PRECISIONS)}, not {precision}')
+
+    field = basis.amplitude * np.exp(1j * 2 * np.pi * basis_phase(basis, params))
+    return field.astype(dtype, copy=False)
+
+
+def _padded_index(inside, samples, padded_samples):
+    """Map flat indices in a (samples, samples) grid to the upper left of a (padded, padded) grid."""
+    row, col = np.divmod(inside, samples)
+    return row * padded_samples + col
+
+
+def _otf_cuts(cfg, field, defocuses, otf):
+    """Compute the complex OTF along the T and S axes at the frequency bins used for extraction.
+
+    field is the in-focus complex pupil at the pixels inside the pupil.
+    Returns the tangential and sagittal cuts through the OTF at sampling.bins,
+    the value of the OTF at the origin, and a tuple of intermediate data used
+    by the adjoint.
+
+    The fftshifts done by prysm only apply linear phase to the PSF and OTF and
+    are skipped, as is centering the pupil in the padded array.
+
+    - fft computes the full 2D OTF with a real FFT of the PSF.
+    - mft projects the PSF onto each axis and evaluates a matrix DFT of the
+      projections at only the bins used.
+    - autocorr skips the PSF; the OTF along an axis is the autocorrelation of
+      the pupil along that axis, summed over the other.  This is computed from
+      1D FFTs of the pupil and evaluated at only the shifts used.
+
+    All three are exact; they differ only in rounding.  The work is done in
+    the precision of field.
+    """
+    sampling = ts_sampling(cfg)
+    bins = sampling.bins
+    fft = _fft_module(field)
+    if otf == 'autocorr':
+        fcn = _focus_stack(cfg, field, defocuses, padded=False)
+        m = sampling.padded_samples
+        line_t = fft.fft(fcn, n=m, axis=1)
+        line_s = fft.fft(fcn, n=m, axis=2)
+        proj_t = (line_t.real ** 2 + line_t.imag ** 2).sum(axis=2)
+        proj_s = (line_s.real ** 2 + line_s.imag ** 2).sum(axis=1)
+        norm = proj_t.sum(axis=1)
+        return proj_t @ sampling.dft, proj_s @ sampling.dft, norm, (fcn, line_t, line_s)
+
+    fcn = _focus_stack(cfg, field, defocuses)
+    field = fft.fft2(fcn)
+    psf = field.real ** 2 + field.imag ** 2
+    if otf == 'fft':
+        otf_ = fft.rfft2(psf)
+        return otf_[:, bins, 0], otf_[:, 0, bins], abs(otf_[:, 0, 0]), (fcn, field)
+    elif otf == 'mft':
+        proj_t, proj_s = psf.sum(axis=2), psf.sum(axis=1)
+        return proj_t @ sampling.dft, proj_s @ sampling.dft, proj_t.sum(axis=1), (fcn, field)
+    else:
+        raise ValueError(f'otf must be one of {OTF_BACKENDS}, not {otf}')
+
+
+def _otf_cuts_adjoint(g_cut_t, g_cut_s, g_norm, intermediate, sampling, otf):
+    """Adjoint of _otf_cuts, returns the gradient with respect to the pupil functions."""
+    m = sampling.padded_samples
+    fcn = intermediate[0]
+    fft, real = _fft_module(fcn), fcn.real.dtype
+    dft_h = sampling.dft.conj().T
+    g_proj_t = ((g_cut_t @ dft_h).real + g_norm[:, np.newaxis]).astype(real)
+    g_proj_s = (g_cut_s @ dft_h).real.astype(real)
+    if otf == 'autocorr':
+        fcn, line_t, line_s = intermediate
+        n = fcn.shape[1]
+        g_fcn = m * fft.ifft(2 * g_proj_t[:, :, np.newaxis] * line_t, axis=1)[:, :n, :]
+        g_fcn += m * fft.ifft(2 * g_proj_s[:, np.newaxis, :] * line_s, axis=2)[:, :, :n]
+    else:
+        # both the cuts and the origin of the full OTF are sums of the projections of the PSF
+        fcn, field = intermediate
+        g_psf = g_proj_t[:, :, np.newaxis] + g_proj_s[:, np.newaxis, :]
+        g_fcn = (m * m) * fft.ifft2(2 * g_psf * field)
+
+    return fcn, g_fcn
+
+
+def _interp_ts(data, sampling):
+    """Linearly interpolate (planes, frequency) data onto the requested frequencies."""
+    lo, hi = data[:, sampling.idx_lo], data[:, sampling.idx_hi]
+    slope = (hi - lo) / sampling.slope_den
+    return slope * sampling.slope_num + lo
+
+
+def _interp_ts_adjoint(grad, sampling, samples):
+    """Adjoint of _interp_ts; maps a gradient at the requested frequencies to the frequency grid."""
+    weight = sampling.slope_num / sampling.slope_den
+    out = np.zeros((grad.shape[0], samples))
+    np.add.at(out.T, sampling.idx_lo, (grad * (1 - weight)).T)
+    np.add.at(out.T, sampling.idx_hi, (grad * weight).T)
+    return out
+
+
+def _mtf_at_bins(cut, norm, sampling):
+    """Place |cut| / norm on the nonnegative half of the frequency grid."""
+    grid = np.zeros((cut.shape[0], sampling.padded_samples // 2))
+    grid[:, sampling.bins] = abs(cut) / norm[:, np.newaxis]
+    return grid
+
+
+def thrufocus_ts_mtf(cfg, codex, params, defocuses, otf='fft', precision='double'):
+    """Compute the through-focus T/S MTF for a config, codex, and parameter vector.
+
+    Parameters
+    ----------
+    cfg : `prysm.macros.SimulationConfig`
+        a simulation config
+    codex : `dict`
+        dict with integer, string key value pairs, e.g. {0: 'Z1', 1: 'Z9'}
+    params : iterable
+        sequence of optimization parameters
+    defocuses : `numpy.ndarray`
+        defocus for each plane, in the same units as params
+    otf : `str`, optional, {'fft', 'mft', 'autocorr'}
+        method used to compute the OTF.  fft computes the full 2D OTF; mft and
+        autocorr compute it only at the frequencies needed to extract the T/S
+        MTF at cfg.freqs, see `benchmark_otf_backends`
+    precision : `str`, optional, {'double', 'single'}
+        precision of the propagation; single halves the memory traffic of the
+        FFTs at the cost of about 1e-6 relative error in the MTF
+
+    Returns
+    -------
+    tan : `numpy.ndarray`
+        array of shape (planes, freqs) of tangential MTF
+    sag : `numpy.ndarray`
+        array of shape (planes, freqs) of sagittal MTF
+
+    """
+    basis = zernike_basis(codex, cfg.samples, cfg.mask)
+    sampling = ts_sampling(cfg)
+    field = _pupil_field(basis, params, precision)
+    return _ts_mtf_from_field(cfg, field, defocuses, otf, sampling)
+
+
+def _ts_mtf_from_field(cfg, field, defocuses, otf, sampling):
+    """Propagate the in-focus field at the pixels inside the pupil to T/S MTF."""
+    cut_t, cut_s, norm, _ = _otf_cuts(cfg, field, defocuses, otf)
+    return (_interp_ts(_mtf_at_bins(cut_t, norm, sampling), sampling),
+            _interp_ts(_mtf_at_bins(cut_s, norm, sampling), sampling))
+
+
+def thrufocus_ts_mtf_probes(cfg, codex, params, steps, defocuses, otf='fft', precision='double', probes=None):
+    """Compute the through-focus T/S MTF at a parameter vector and with each parameter perturbed.
+
+    Parameters
+    ----------
+    cfg : `prysm.macros.SimulationConfig`
+        a simulation config
+    codex : `dict`
+        dict with integer, string key value pairs, e.g. {0: 'Z1', 1: 'Z9'}
+    params : iterable
+        sequence of optimization parameters
+    steps : iterable
+        perturbation of each parameter, in the same units as params
+    defocuses : `numpy.ndarray`
+        defocus for each plane, in the same units as params
+    otf : `str`, optional, {'fft', 'mft', 'autocorr'}
+        method used to compute the OTF, see `thrufocus_ts_mtf`
+    precision : `str`, optional, {'double', 'single'}
+        precision of the propagation, see `thrufocus_ts_mtf`
+    probes : iterable of `int`, optional
+        which probes to compute, 0 for params and j + 1 for params[j]
+        perturbed; if None, all len(params) + 1 probes
+
+    Returns
+    -------
+    tan : `numpy.ndarray`
+        array of shape (len(probes), planes, freqs) of tangential MTF;
+        with probes=None, the first element is at params, element j + 1 at
+        params with params[j] increased by steps[j]
+    sag : `numpy.ndarray`
+        array of shape (len(probes), planes, freqs) of sagittal MTF
+
+    Notes
+    -----
+    The probes share the field at params; each is that field times
+    exp(i 2pi step Zj) for its term, so the phase of the pupil is not
+    rebuilt for each probe.
+
+    """
+    basis = zernike_basis(codex, cfg.samples, cfg.mask)
+    sampling = ts_sampling(cfg)
+    base = _pupil_field(basis, params, precision)
+    if probes is None:
+        probes = range(len(steps) + 1)
+
+    tan, sag = [], []
+    for field in _probe_fields(basis, base, steps, probes):
+        t, s = _ts_mtf_from_field(cfg, field, defocuses, otf, sampling)
+        tan.append(t)
+        sag.append(s)
+
+    return np.asarray(tan), np.asarray(sag)
+
+
+def _probe_fields(basis, base, steps, probes):
+    """Yield the field of each probe; probe 0 is the base field, probe j + 1 has term j perturbed by its step."""
+    for probe in probes:
+        if probe == 0:
+            yield base
+        else:
+            idx = probe - 1
+            yield base * np.exp(1j * 2 * np.pi * steps[idx] * basis.matrix[:, idx]).astype(base.dtype)
+
+
+def thrufocus_ts_mtf_vjp(cfg, codex, params, defocuses, otf='fft', precision='double'):
+    """Compute the through-focus T/S MTF and a function giving its vector-Jacobian product.
+
+    Parameters
+    ----------
+    cfg : `prysm.macros.SimulationConfig`
+        a simulation config
+    codex : `dict`
+        dict with integer, string key value pairs, e.g. {0: 'Z1', 1: 'Z9'}
+    params : iterable
+        sequence of optimization parameters
+    defocuses : `numpy.ndarray`
+        defocus for each plane, in the same units as params
+    otf : `str`, optional, {'fft', 'mft', 'autocorr'}
+        method used to compute the OTF, see `thrufocus_ts_mtf`
+    precision : `str`, optional, {'double', 'single'}
+        precision of the propagation, see `thrufocus_ts_mtf`
+
+    Returns
+    -------
+    tan : `numpy.ndarray`
+        array of shape (planes, freqs) of tangential MTF
+    sag : `numpy.ndarray`
+        array of shape (planes, freqs) of sagittal MTF
+    vjp : callable
+        function of (grad_tan, grad_sag), each of shape (planes, freqs), which
+        returns the gradient with respect to params for each plane, shape (planes, len(params))
+
+    Notes
+    -----
+    The gradient is exact, computed in reverse through pupil -> PSF -> OTF ->
+    T/S extraction.  Evaluating it costs about one more propagation, regardless
+    of the number of parameters.
+
+    """
+    basis = zernike_basis(codex, cfg.samples, cfg.mask)
+    sampling = ts_sampling(cfg)
+    field = _pupil_field(basis, params, precision)
+    cut_t, cut_s, norm, intermediate = _otf_cuts(cfg, field, defocuses, otf)
+    tan = _interp_ts(_mtf_at_bins(cut_t, norm, sampling), sampling)
+    sag = _interp_ts(_mtf_at_bins(cut_s, norm, sampling), sampling)
+
+    def vjp(grad_tan, grad_sag):
+        half, bins = sampling.padded_samples // 2, sampling.bins
+        # interpolation -> MTF at the frequency bins
+        g_mtf_t = _interp_ts_adjoint(np.asarray(grad_tan), sampling, half)[:, bins]
+        g_mtf_s = _interp_ts_adjoint(np.asarray(grad_sag), sampling, half)[:, bins]
+
+        # MTF = |OTF| / OTF(0)
+        abs_t, abs_s, n = abs(cut_t), abs(cut_s), norm[:, np.newaxis]
+        g_norm = -((g_mtf_t * abs_t).sum(axis=1) + (g_mtf_s * abs_s).sum(axis=1)) / norm ** 2
+        g_cut_t = g_mtf_t * cut_t / (np.where(abs_t == 0, 1, abs_t) * n)
+        g_cut_s = g_mtf_s * cut_s / (np.where(abs_s == 0, 1, abs_s) * n)
+        fcn, g_fcn = _otf_cuts_adjoint(g_cut_t, g_cut_s, g_norm, intermediate, sampling, otf)
+
+        # fcn = A exp(i 2pi phase), phase = basis @ params + defocus * Z4
+        idx = _padded_index(basis.inside, cfg.samples, fcn.shape[1])
+        planes = fcn.shape[0]
+        f_in, g_in = fcn.reshape(planes, -1)[:, idx], g_fcn.reshape(planes, -1)[:, idx]
+        g_phase = -2 * np.pi * (f_in * g_in.conj()).imag
+        return g_phase @ basis.matrix
+
+    return tan, sag, vjp
+
+
+def benchmark_otf_backends(cfg, codex, params, defocuses, backends=OTF_BACKENDS, samples=None, repeat=5):
+    """Time the OTF backends against each other.
+
+    Parameters
+    ----------
+    cfg : `prysm.macros.SimulationConfig`
+        a simulation config
+    codex : `dict`
+        dict with integer, string key value pairs, e.g. {0: 'Z1', 1: 'Z9'}
+    params : iterable
+        sequence of optimization parameters
+    defocuses : `numpy.ndarray`
+        defocus for each plane, in the same units as params
+    backends : iterable of `str`, optional
+        backends to time, see `thrufocus_ts_mtf`
+    samples : iterable of `int`, optional
+        pupil sample counts to time at, if None use cfg.samples
+    repeat : `int`, optional
+        number of times to run each backend; the fastest is reported
+
+    Returns
+    -------
+    `dict`
+        dict with keys of (samples, backend) and values of dicts with keys
+        time, the best time in seconds, and error, the largest absolute
+        difference of the MTF to the fft backend
+
+    """
+    if samples is None:
+        samples = (cfg.samples,)
+
+    out = {}
+    for n in samples:
+        cfg_ = cfg._replace(samples=n)
+        ref = np.asarray(thrufocus_ts_mtf(cfg_, codex, params, defocuses, 'fft'))
+        for backend in backends:
+            times = []
+            for _ in range(repeat):
+                t_start = time.perf_counter()
+                mtf = thrufocus_ts_mtf(cfg_, codex, params, defocuses, backend)
+                times.append(time.perf_counter() - t_start)
+
+            out[(n, backend)] = {
+                'time': min(times),
+                'error': abs(np.asarray(mtf) - ref).max(),
+            }
+
+    return out
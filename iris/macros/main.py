@@ -7,8 +7,10 @@ from iris.utilities import (
     prepare_document_local,
     prepare_document_global,
 )
-from iris.recipes import opt_routine_lbfgsb, opt_routine_basinhopping
+from iris.recipes import opt_routine_lbfgsb, opt_routine_basinhopping, opt_routine_multistart, grab_axial_data
+from iris.data import truth_key
 from iris.core import config_codex_params_to_pupil
+from iris.engine import zernike_basis, residual_rms
 from iris.rings import W1
 
 efl, fno, lambda_ = 50, 2, 0.55
@@ -27,7 +29,8 @@ DEFAULT_CONFIG = make_focus_range_realistic_number_of_microns(DEFAULT_CONFIG, 5)
 
 
 def run_simulation(truth=(0, 0.125, 0, 0), guess=(0, 0.0, 0, 0), cfg=None, solver='global',
-                   decoder_ring=None, solver_opts=None, core_opts=None):
+                   decoder_ring=None, solver_opts=None, core_opts=None, precision='double', pool=None,
+                   truth_cache=None):
     """Run a complete simulation generating and retrieving azimuthal order zero terms.
 
     Parameters
@@ -38,8 +41,9 @@ def run_simulation(truth=(0, 0.125, 0, 0), guess=(0, 0.0, 0, 0), cfg=None, solve
         guess coefficients, in waves RMS
     cfg : `prysm.macros.SimulationConfig`, optional
         simulation configuration; if None, use a built in default
-    solver : `str`, optional
-        whether to use a local or a global optimizer
+    solver : `str`, optional, {'global', 'local', 'multistart'}
+        whether to use a local or a global optimizer; 'multistart' is a global
+        optimizer which descends from several starting points at once
     decoder_ring : `dict`, optional
         a decoder ring, a dictionary that looks like {0: 'Z1', 1: 'Z2' ...}, if None defaults to
         W1 from iris/rings.py if guess is of length 4, and W2 if guess is of length 16
@@ -47,6 +51,15 @@ def run_simulation(truth=(0, 0.125, 0, 0), guess=(0, 0.0, 0, 0), cfg=None, solve
         kwd:value pairs to pass to solver, if None defaults are chosen by the solver function
     core_opts : `dict` or None, optional
         kwd:value pairs to pass to optimization core, if None defaults chosen by the optimization core
+    precision : `str`, optional, {'double', 'single'}
+        precision of the forward model used by the solver; single precision
+        solutions are polished in double precision and the difference between
+        the two is reported in the document
+    pool : `iris.shared.PersistentPool`, optional
+        long-lived pool to run the solver on, reused across simulations
+    truth_cache : `iris.data.TruthCache`, optional
+        cache of truth MTF data; the truth is looked up before it is
+        computed, and stored if it is not found
 
     Returns
     -------
@@ -65,33 +78,36 @@ def run_simulation(truth=(0, 0.125, 0, 0), guess=(0, 0.0, 0, 0), cfg=None, solve
 
     if solver.lower() == 'local':
         solver, prepare_document, flag = opt_routine_lbfgsb, prepare_document_local, 'local'
+    elif solver.lower() == 'multistart':
+        solver, prepare_document, flag = opt_routine_multistart, prepare_document_global, 'global'
     else:
         solver, prepare_document, flag = opt_routine_basinhopping, prepare_document_global, 'global'
 
     pupil = config_codex_params_to_pupil(cfg, decoder_ring, truth)
-    truth_df = thrufocus_mtf_from_wavefront(pupil, cfg)
-    if solver_opts is not None and core_opts is not None:
-        sim_result = solver(cfg, truth_df, decoder_ring, guess, **{**solver_opts, 'core_opts': core_opts})
-    elif solver_opts is not None:
-        sim_result = solver(cfg, truth_df, decoder_ring, guess, **solver_opts)
-    elif core_opts is not None:
-        sim_result = solver(cfg, truth_df, decoder_ring, guess, **{'core_opts': core_opts})
+    if truth_cache is None:
+        truth_df = thrufocus_mtf_from_wavefront(pupil, cfg)
     else:
-        sim_result = solver(cfg, truth_df, decoder_ring, guess)
+        key = truth_key(cfg, decoder_ring, truth)
+        truth_df = truth_cache.get(key)
+        if truth_df is None:
+            truth_df = grab_axial_data(cfg, thrufocus_mtf_from_wavefront(pupil, cfg))
+            truth_cache.put(key, *truth_df)
 
+    solver_kwargs = {'precision': precision}
+    if solver_opts is not None:
+        solver_kwargs.update(solver_opts)
+    if core_opts is not None:
+        solver_kwargs['core_opts'] = core_opts
+    if pool is not None:
+        solver_kwargs['pool'] = pool
+    sim_result = solver(cfg, truth_df, decoder_ring, guess, **solver_kwargs)
+
+    # residual RMS WFE of every iterate from the basis instead of a pupil per iterate
+    basis = zernike_basis(decoder_ring, cfg.samples, cfg.mask)
     if flag == 'local':
-        residuals = []
-        for coefs in sim_result.x_iter:
-            p2 = config_codex_params_to_pupil(cfg, decoder_ring, coefs)
-            residuals.append((pupil - p2).rms)
+        residuals = list(residual_rms(basis, truth, sim_result.x_iter))
     else:
-        residuals = [[]]
-        for idx, iteration in enumerate(sim_result.x_iter):
-            for coefs in iteration:
-                p2 = config_codex_params_to_pupil(cfg, decoder_ring, coefs)
-                residuals[idx].append((pupil - p2).rms)
-            residuals.append([])
-        del residuals[-1]  # clean up trailing list
+        residuals = [list(residual_rms(basis, truth, iteration)) for iteration in sim_result.x_iter]
 
     res = prepare_document(
         sim_params=cfg,
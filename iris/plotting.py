@@ -502,8 +502,7 @@ def _get_idxs(other):
 def _get_cost_rmswfe_rrmswfe_coma_or_ast_angle(db, doc_ids, other='coma'):
     cost, rmswfe, rrmswfe, angle = [], [], [], []
     xidx, yidx = _get_idxs(other)
-    for did in doc_ids:
-        doc = db.get_document(did)
+    for doc in db.get_documents(doc_ids):
         tp = doc['truth_params']
         cost.append(doc['cost_final'])
         rmswfe.append(doc['truth_rmswfe'])
@@ -520,19 +519,10 @@ def _get_cost_rmswfe_rrmswfe_coma_or_ast_angle(db, doc_ids, other='coma'):
 def _filter_db_for_sph_and_coma_or_ast_mags(db, other='coma', sph_target=0.05, other_target=0.05):
     xidx, yidx = _get_idxs(other)
     tolerance = 0.01
-    ids = db.doc_ids
-    out_ids = []
-    for id_ in ids:
-        doc = db.get_document(id_)
-        tp = doc['truth_params']
-        sph_mag = tp[5]
-        other_mag = np.sqrt(tp[xidx]**2 + tp[yidx]**2)
-        sph_diff = abs(sph_target - sph_mag)
-        other_diff = abs(other_target - other_mag)
-        if sph_diff < tolerance and other_diff < tolerance:
-            out_ids.append(id_)
-
-    return out_ids
+    out_ids = db.find('truth_params',
+                      ranges={5: (sph_target - tolerance, sph_target + tolerance)},
+                      norms={(xidx, yidx): (other_target - tolerance, other_target + tolerance)})
+    return list(out_ids)
 
 
 def _render_rrmswfe_vs_angle_plot(db, sph_amount, other='coma', fig=None, ax=None):
@@ -5,10 +5,12 @@ from iris.recipes.axis import (
 from iris.recipes.main import (
     opt_routine_lbfgsb,
     opt_routine_basinhopping,
+    opt_routine_multistart,
 )
 
 __all__ = [
     'grab_axial_data',
     'opt_routine_lbfgsb',
     'opt_routine_basinhopping',
+    'opt_routine_multistart',
 ]
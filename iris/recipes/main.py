@@ -1,14 +1,31 @@
 """Main recipe."""
 import time
-from multiprocessing import Pool, cpu_count
+import threading
+from functools import partial
+from multiprocessing import Pool, Manager, cpu_count
+from multiprocessing.pool import ThreadPool
 from collections import namedtuple
+from types import SimpleNamespace
 
 import numpy as np
-from scipy.optimize import minimize, basinhopping
-
-from iris.core import prepare_globals, optfcn
-from iris.forcefully_redirect_stdout import forcefully_redirect_stdout
-from iris.utilities import parse_cost_by_iter_lbfgsb, split_lbfgsb_iters
+from scipy.optimize import minimize, basinhopping, OptimizeResult
+
+from iris.core import (
+    OptimizationContext,
+    worker_context,
+    prepare_globals,
+    share_context_arrays,
+    optfcn,
+    optfcn_and_grad,
+    optfcn_and_fd_grad,
+    optfcn_and_parallel_fd_grad,
+    optfcn_and_hybrid_fd_grad,
+    precision_error,
+    MemoizedObjective,
+    FD_EPS,
+)
+from iris.engine import OTF_BACKENDS
+from iris.shared import shared_memory_available
 from iris.recipes.axis import grab_axial_data
 
 from prysm.otf import diffraction_limited_mtf
@@ -16,17 +33,31 @@ from prysm.otf import diffraction_limited_mtf
 # make a namedtuple that holds optimization setup variables
 OptSetup = namedtuple('OptSetup', ['focus_diversity', 't_true', 's_true', 'diffraction'])
 
+# the state shared by the descents of a multistart optimization; best.value is the lowest cost
+# at an iteration of any descent, guarded by lock, and done is set once a descent reaches ftol
+MultistartStatus = namedtuple('MultistartStatus', ['best', 'lock', 'done'])
+
+# number of consecutive iterations a descent of a multistart optimization may spend above
+# prune_ratio times the best cost before it is stopped
+PRUNE_PATIENCE = 5
+
+# the outcome of one local descent of a multistart optimization
+Descent = namedtuple('Descent', ['x_iter', 'fun_iter', 'x', 'fun', 'nit', 'nfev', 'memo_hits', 'memo_misses',
+                                 'pruned'])
+
 
 def opt_routine_lbfgsb(sys_parameters, truth_dataframe, codex, guess=(0, 0, 0, 0),
-                       ftol=1e-7, parallel=False, nthreads=None, core_opts=None):
+                       ftol=1e-7, parallel=False, nthreads=None, core_opts=None, jac=None, otf_backend='fft',
+                       precision='double', polish=True, memo_size=1024, pool=None, backend='processes'):
     """Retrieve spherical aberration-related coefficients from axial MTF data.
 
     Parameters
     ----------
     sys_parameters : `dict`
         dictionary with keys efl, fno, wavelength, samples, focus_planes, focus_range_waves, freqs, freq_step
-    truth_dataframe : `pandas.DataFrame`
-        a dataframe containing truth values
+    truth_dataframe : `pandas.DataFrame` or `tuple`
+        a dataframe containing truth values, or the (focus diversity, tangential
+        MTF, sagittal MTF) already extracted from one, see `grab_axial_data`
     codex : dict
         dictionary of key, value pairs where keys are ints and values are strings.  Maps parameter
         numbers to zernike numbers, e.g. {0: 'Z1', 1: 'Z9'} maps (10, 11) to {'Z1': 10, 'Z9': 11}
@@ -40,6 +71,32 @@ def opt_routine_lbfgsb(sys_parameters, truth_dataframe, codex, guess=(0, 0, 0, 0
         number of threads to use for parallel optimization; if None, defaults to number of logical threads - 1
     core_otps: `tuple` or None, optional
         options to pass to the optimizaiton core
+    jac : `str` or None, optional, {None, 'analytic', 'incremental', 'parallel', 'hybrid'}
+        how to compute the gradient of the cost function; if None, it is
+        estimated with finite differences by the optimizer.  If 'analytic', the
+        exact gradient is computed, see `iris.core.optfcn_and_grad`.  If
+        'incremental', the finite differences are computed with the same steps
+        by updating the pupil for each probe, and the results agree to rounding,
+        see `iris.core.optfcn_and_fd_grad`.  If
+        'parallel' or 'hybrid', the probes, or each (probe, plane) pair, are
+        spread over the pool, see `iris.core.optfcn_and_parallel_fd_grad`
+        and `iris.core.optfcn_and_hybrid_fd_grad`
+    otf_backend : `str`, optional, {'fft', 'mft', 'autocorr'}
+        method used to compute the OTF, see `iris.engine.thrufocus_ts_mtf`
+    precision : `str`, optional, {'double', 'single'}
+        precision of the forward model, see `iris.engine.thrufocus_ts_mtf`
+    polish : `bool`, optional
+        if True and precision is single, refine the result with the forward
+        model in double precision, see `polish_double`
+    memo_size : `int`, optional
+        number of cost function evaluations to memoize, see
+        `iris.core.MemoizedObjective`; if 0, every evaluation is computed
+    pool : `iris.shared.PersistentPool`, optional
+        pool to run the optimization on; if given, parallel and nthreads are
+        ignored and the pool is left open for the next optimization
+    backend : `str`, optional, {'processes', 'threads'}
+        if parallel, whether the pool is of processes or of threads of this
+        process, see `prep_context`
 
     Returns
     -------
@@ -55,62 +112,69 @@ def opt_routine_lbfgsb(sys_parameters, truth_dataframe, codex, guess=(0, 0, 0, 0
             - cost_final, float
             - cost_iter, list
             - time, float
+            - precision, str
+            - precision_error, dict or None
+            - memo_hits, int
+            - memo_misses, int
 
     """
+    fun, use_jac = get_objective(jac)
     setup_data = prep_data(sys_parameters, truth_dataframe)
-    pool = prep_globals(setup_data, sys_parameters, codex, parallel, nthreads)
-
-    parameter_vectors = []
-
-    def callback(x):
-        parameter_vectors.append(x.copy())
+    ctx = prep_context(setup_data, sys_parameters, codex, parallel, nthreads, otf_backend, pool, backend)
+    fun = MemoizedObjective(partial(fun, ctx=ctx), memo_size)
+    recorder = IterationRecorder(fun, use_jac)
 
     if core_opts is None:
-        args = (None, None)
+        args = (None, None, precision)
     else:
-        args = core_opts
+        args = (*core_opts, precision)
 
     try:
-        parameter_vectors.append(np.asarray(guess))
         t_start = time.perf_counter()
-        # do the optimization and capture the per-iteration information from stdout
-        with forcefully_redirect_stdout() as out:
-            result = minimize(
-                fun=optfcn,
-                x0=guess,
-                method='L-BFGS-B',
-                options={
-                    'disp': True,
-                    'ftol': ftol,
-                    'maxiter': 50,
-                },
-                args=args,
-                callback=callback)
+        result = minimize(
+            fun=recorder,
+            x0=guess,
+            jac=use_jac,
+            method=recorder.lbfgsb,
+            options=lbfgsb_options(ftol, use_jac, precision),
+            args=args,
+            callback=recorder.callback)
+
+        # put the extra data on the optimizationresult
+        parameter_vectors, cost_by_iter = recorder.x_iter[0], recorder.fun_iter[0]
+        if precision == 'single' and polish:
+            # the first polish iterate is the single precision solution, which is already logged
+            polished, x_iter, fun_iter = polish_double(fun, use_jac, result.x, args, ftol)
+            parameter_vectors += x_iter[1:]
+            cost_by_iter += fun_iter[1:]
+            result = merge_polish(result, polished)
 
         t_end = time.perf_counter()
-        # grab the extra data and put everything on the optimizationresult
-        cost_by_iter = parse_cost_by_iter_lbfgsb(out['txt'])
         result.x_iter = parameter_vectors
         result.fun_iter = cost_by_iter
         result.time = t_end - t_start
+        result.precision = precision
+        result.precision_error = precision_error(result.x, *args[:2], ctx=ctx) if precision == 'single' else None
+        result.memo_hits = fun.hits
+        result.memo_misses = fun.misses
         return result
     finally:
-        if pool is not None:
-            pool.close()
-            pool.join()
+        release_context(ctx, close_pool=pool is None)
 
 
 def opt_routine_basinhopping(sys_parameters, truth_dataframe, codex, guess=(0, 0, 0, 0),
                              ftol=1e-7, step=0.05, temp=0.05, max_starts=25,
-                             parallel=False, nthreads=None, core_opts=None):
+                             parallel=False, nthreads=None, core_opts=None, jac=None, otf_backend='fft',
+                             precision='double', polish=True, memo_size=1024, pool=None, backend='processes'):
     """Pseudoglobal basin-hopping based optimization routine.
 
     Parameters
     ----------
     sys_parameters : `dict`
         dictionary with keys efl, fno, wavelength, samples, focus_planes, focus_range_waves, freqs, freq_step
-    truth_dataframe : `pandas.DataFrame`
-        a dataframe containing truth values
+    truth_dataframe : `pandas.DataFrame` or `tuple`
+        a dataframe containing truth values, or the (focus diversity, tangential
+        MTF, sagittal MTF) already extracted from one, see `grab_axial_data`
     codex : dict
         dictionary of key, value pairs where keys are ints and values are strings.  Maps parameter
         numbers to zernike numbers, e.g. {0: 'Z1', 1: 'Z9'} maps (10, 11) to {'Z1': 10, 'Z9': 11}
@@ -130,6 +194,32 @@ def opt_routine_basinhopping(sys_parameters, truth_dataframe, codex, guess=(0, 0
         number of threads to use for parallel optimization; if None, defaults to number of logical threads - 1
     core_otps: `tuple` or None, optional
         options to pass to the optimizaiton core
+    jac : `str` or None, optional, {None, 'analytic', 'incremental', 'parallel', 'hybrid'}
+        how to compute the gradient of the cost function; if None, it is
+        estimated with finite differences by the optimizer.  If 'analytic', the
+        exact gradient is computed, see `iris.core.optfcn_and_grad`.  If
+        'incremental', the finite differences are computed with the same steps
+        by updating the pupil for each probe, and the results agree to rounding,
+        see `iris.core.optfcn_and_fd_grad`.  If
+        'parallel' or 'hybrid', the probes, or each (probe, plane) pair, are
+        spread over the pool, see `iris.core.optfcn_and_parallel_fd_grad`
+        and `iris.core.optfcn_and_hybrid_fd_grad`
+    otf_backend : `str`, optional, {'fft', 'mft', 'autocorr'}
+        method used to compute the OTF, see `iris.engine.thrufocus_ts_mtf`
+    precision : `str`, optional, {'double', 'single'}
+        precision of the forward model, see `iris.engine.thrufocus_ts_mtf`
+    polish : `bool`, optional
+        if True and precision is single, refine the result with the forward
+        model in double precision, see `polish_double`
+    memo_size : `int`, optional
+        number of cost function evaluations to memoize, see
+        `iris.core.MemoizedObjective`; if 0, every evaluation is computed
+    pool : `iris.shared.PersistentPool`, optional
+        pool to run the optimization on; if given, parallel and nthreads are
+        ignored and the pool is left open for the next optimization
+    backend : `str`, optional, {'processes', 'threads'}
+        if parallel, whether the pool is of processes or of threads of this
+        process, see `prep_context`
 
     Returns
     -------
@@ -145,117 +235,519 @@ def opt_routine_basinhopping(sys_parameters, truth_dataframe, codex, guess=(0, 0
             - cost_final, float
             - cost_iter, list
             - time, float
+            - precision, str
+            - precision_error, dict or None
+            - memo_hits, int
+            - memo_misses, int
 
     """
     max_starts -= 1  # scipy bug, does n+1 iters
-    # extract data and prepare the global variables
+    fun, use_jac = get_objective(jac)
+    # extract data and prepare the context of the optimization
     setup_data = prep_data(sys_parameters, truth_dataframe)
-    pool = prep_globals(setup_data, sys_parameters, codex, parallel, nthreads)
+    ctx = prep_context(setup_data, sys_parameters, codex, parallel, nthreads, otf_backend, pool, backend)
+    fun = MemoizedObjective(partial(fun, ctx=ctx), memo_size)
 
     # prepare args (optimization subroutine) for optimizer, defaults if not given
     if core_opts is None:
-        args = (None, None)
+        args = (None, None, precision)
     else:
-        args = core_opts
+        args = (*core_opts, precision)
 
-    # prepare for the logging callbacks
-    global nbasinit
+    # the recorder logs each local optimization; the global callback exits the optimization
+    # if a sufficiently low minimum is found or the maximum number of starts is reached
+    recorder = IterationRecorder(fun, use_jac)
     nbasinit = 1
-    parameters_certain = [[]]
-    parameters_uncertain = [[]]
 
-    # global callback exits optimization is sufficiently low minimum found, prepares iter for local
-    # local callback logs parameter vectors
     def cb_global(x, f, accept):
-        global nbasinit  # declare nit as global
+        nonlocal nbasinit
         if f < ftol:     # if the cost function is small enough, declare success
             return True
         elif nbasinit >= max_starts:  # if there have been the maximum number of starts, stop
             return True
-        nbasinit += 1    # if not, increment the counter and make a new parameter history list
-        parameters_certain.append([])
-        parameters_uncertain.append([])
-
-    def cb_local(x):
-        global nbasinit
-        parameters_certain[nbasinit - 1].append(x.copy())
-
-    def optwrapper(x, *args):
-        global nbasinit
-        parameters_uncertain[nbasinit - 1].append(x.copy())
-        return optfcn(x, *args)
+        nbasinit += 1
 
     try:
         t_start = time.perf_counter()
-        # do the optimization and capture the per-iteration information from stdout
-        with forcefully_redirect_stdout() as out:
-            result = basinhopping(
-                func=optwrapper,
-                x0=guess,
-                minimizer_kwargs={
-                    'args': args,
-                    'method': 'L-BFGS-B',
-                    'options': {
-                        'disp': True,
-                        'ftol': ftol,
-                        'maxiter': 50,
-                    },
-                    'callback': cb_local,
-                },
-                callback=cb_global,
-                stepsize=step,
-                T=temp,
-                interval=3,
-                seed=1234)
+        result = basinhopping(
+            func=recorder,
+            x0=guess,
+            minimizer_kwargs={
+                'args': args,
+                'jac': use_jac,
+                'method': recorder.lbfgsb,
+                'options': lbfgsb_options(ftol, use_jac, precision),
+                'callback': recorder.callback,
+            },
+            callback=cb_global,
+            stepsize=step,
+            T=temp,
+            interval=3,
+            seed=1234)
 
         t_end = time.perf_counter()
-        txt = out['txt']
-
-        # extract the cost function history from L-BFGS-B output
-        iter_outs = split_lbfgsb_iters(txt)
-        cost_iters = [parse_cost_by_iter_lbfgsb(txtbuffer) for txtbuffer in iter_outs]
-
-        # if too many basins have been hopped, the final parameter set will be empty and needs to be removed
-        if 'requested number of basinhopping iterations completed successfully' in result.message:
-            del parameters_certain[-1]
-            del parameters_uncertain[-1]
-
-        # add the guess to the front of the certain values
-        parameters_uncertain[0].insert(0, np.asarray(guess))
-
-        # take the first call from the uncertain parameter histories and append it to the certain ones
-        for pc, pu in zip(parameters_certain, parameters_uncertain):
-            pc.insert(0, pu[0])
-
-        # now use the first cost function history (which is properly broken up)
-        # to know where to cut the parameter vectors
-        # take the length of the first cost function iteration, and break the
-        # first set of parameter vectors there
-        max_length = len(cost_iters[0])
-        pc1, pu1 = parameters_certain[0], parameters_uncertain[0]
-        cfirst, csecond = pc1[:max_length], pc1[max_length:]
-        usecond = pu1[max_length:]
-
-        # because the uncertain parameter vector has an element for each function call, we don't know the index of the element
-        # for the onset of the second iteration.
-        # use minimization to find the true parameters
-        tmp_costs, real_cost = np.asarray([optfcn(x) for x in usecond]), cost_iters[1][0]
-        diff = abs(tmp_costs - real_cost)
-        second_iteration_first = usecond[np.argmin(diff)]
-
-        parameters_certain.insert(0, cfirst)
-        parameters_certain[1] = csecond
-        parameters_certain[1].insert(0, np.asarray(second_iteration_first))
+        parameters_certain, cost_iters = recorder.x_iter, recorder.fun_iter
+
+        # the polish is logged as one more local optimization, starting from the best minimum
+        if precision == 'single' and polish:
+            polished, x_iter, fun_iter = polish_double(fun, use_jac, result.x, args, ftol)
+            parameters_certain.append(x_iter)
+            cost_iters.append(fun_iter)
+            result = merge_polish(result, polished)
+            t_end = time.perf_counter()
 
         # store things on the optimization result object
         result.x_iter = parameters_certain
         result.fun_iter = cost_iters
         result.time = t_end - t_start
+        result.precision = precision
+        result.precision_error = precision_error(result.x, *args[:2], ctx=ctx) if precision == 'single' else None
+        result.memo_hits = fun.hits
+        result.memo_misses = fun.misses
         return result
     finally:
-        if pool is not None:
-            pool.close()
-            pool.join()
+        release_context(ctx, close_pool=pool is None)
+
+
+def opt_routine_multistart(sys_parameters, truth_dataframe, codex, guess=(0, 0, 0, 0),
+                           ftol=1e-7, step=0.05, max_starts=25, seed=1234,
+                           parallel=False, nthreads=None, core_opts=None, jac=None, otf_backend='fft',
+                           precision='double', polish=True, memo_size=1024, pool=None, backend='processes',
+                           prune_ratio=100):
+    """Pseudoglobal optimization routine with concurrent local descents from random starting points.
+
+    Parameters
+    ----------
+    sys_parameters : `dict`
+        dictionary with keys efl, fno, wavelength, samples, focus_planes, focus_range_waves, freqs, freq_step
+    truth_dataframe : `pandas.DataFrame` or `tuple`
+        a dataframe containing truth values, or the (focus diversity, tangential
+        MTF, sagittal MTF) already extracted from one, see `grab_axial_data`
+    codex : dict
+        dictionary of key, value pairs where keys are ints and values are strings.  Maps parameter
+        numbers to zernike numbers, e.g. {0: 'Z1', 1: 'Z9'} maps (10, 11) to {'Z1': 10, 'Z9': 11}
+    guess : iterable, optional
+        guess coefficients for the wavefront; the first starting point
+    ftol : `float`, optional
+        cost function tolerance; the search stops when any descent reaches it
+    step : `float`, optional
+        the other starting points are the guess displaced by up to step in each coefficient
+    max_starts : `int`, optional
+        maximum number of starting points
+    seed : `int`, optional
+        seed of the generator of starting points
+    parallel : `bool`, optional
+        whether to run the descents concurrently, one per process
+    nthreads : `int`, optional
+        number of processes to use; if None, defaults to number of logical threads - 1
+    core_otps: `tuple` or None, optional
+        options to pass to the optimizaiton core
+    jac : `str` or None, optional, {None, 'analytic', 'incremental', 'parallel', 'hybrid'}
+        how to compute the gradient of the cost function, see `get_objective`.
+        Each descent runs in a single process, so 'parallel' and 'hybrid' are
+        the same as 'incremental'
+    otf_backend : `str`, optional, {'fft', 'mft', 'autocorr'}
+        method used to compute the OTF, see `iris.engine.thrufocus_ts_mtf`
+    precision : `str`, optional, {'double', 'single'}
+        precision of the forward model, see `iris.engine.thrufocus_ts_mtf`
+    polish : `bool`, optional
+        if True and precision is single, refine the result with the forward
+        model in double precision, see `polish_double`
+    memo_size : `int`, optional
+        number of cost function evaluations to memoize in each descent, see
+        `iris.core.MemoizedObjective`; if 0, every evaluation is computed
+    pool : `iris.shared.PersistentPool`, optional
+        pool to run the descents on; if given, parallel and nthreads are
+        ignored and the pool is left open for the next optimization
+    backend : `str`, optional, {'processes', 'threads'}
+        if parallel, whether the descents run in processes or in threads of
+        this process, see `prep_context`
+    prune_ratio : `float` or None, optional
+        a descent whose cost stays above prune_ratio times the lowest cost of
+        any descent for PRUNE_PATIENCE iterations is stopped; if None, no
+        descent is stopped this way
+
+    Returns
+    -------
+    `scipy.optimize.OptimizeResult`
+        result with the same attributes as `opt_routine_basinhopping`; x_iter
+        and fun_iter hold one list for each descent which was started, in
+        the order of the starting points.  pruned is the number of descents
+        stopped by prune_ratio
+
+    Notes
+    -----
+    Unlike `opt_routine_basinhopping`, which descends from one starting
+    point after another, the descents run at the same time and share the
+    lowest cost found so far.  Once one reaches ftol, the others stop at
+    their next iteration and those not yet started are skipped, so the time
+    to a solution is that of the luckiest start rather than the sum of all.
+    Descents far above the lowest cost are stopped early, freeing their
+    workers for the starts which have not run yet.  The shared cost is read
+    and updated once per iteration of each descent.
+
+    """
+    objective, use_jac = get_objective(jac)
+    setup_data = prep_data(sys_parameters, truth_dataframe)
+    ctx = prep_context(setup_data, sys_parameters, codex, parallel, nthreads, otf_backend, pool, backend)
+
+    if core_opts is None:
+        args = (None, None, precision)
+    else:
+        args = (*core_opts, precision)
+
+    guess = np.asarray(guess, dtype=np.float64)
+    rng = np.random.RandomState(seed)
+    starts = [guess] + [guess + rng.uniform(-step, step, guess.shape) for _ in range(max_starts - 1)]
+
+    manager = None
+    try:
+        t_start = time.perf_counter()
+        if ctx.pool is None:
+            status = MultistartStatus(best=SimpleNamespace(value=np.inf), lock=threading.Lock(),
+                                      done=threading.Event())
+            descents = [_descend(objective, use_jac, x0, args, ftol, memo_size, status, ctx, prune_ratio)
+                        for x0 in starts]
+        elif ctx.backend == 'threads':
+            # each descent is serial; the pool is busy running the descents themselves
+            status = MultistartStatus(best=SimpleNamespace(value=np.inf), lock=threading.Lock(),
+                                      done=threading.Event())
+            descend = partial(_descend, objective, use_jac, args=args, ftol=ftol, memo_size=memo_size,
+                              status=status, ctx=ctx._replace(pool=None, nworkers=1), prune_ratio=prune_ratio)
+            descents = ctx.pool.map(descend, starts, chunksize=1)
+        else:
+            # the descents run whole in the workers, each on the context held in its globals
+            manager = Manager()
+            status = MultistartStatus(best=manager.Value('d', np.inf), lock=manager.Lock(), done=manager.Event())
+            handle = None if ctx.shared is None else ctx.shared.handle
+            descend_mp = partial(_descend_in_worker, handle, objective, use_jac, args=args, ftol=ftol,
+                                 memo_size=memo_size, status=status, prune_ratio=prune_ratio)
+            descents = ctx.pool.map(descend_mp, starts, chunksize=1)
+
+        descents = [d for d in descents if d is not None]
+        x_iter = [d.x_iter for d in descents]
+        fun_iter = [d.fun_iter for d in descents]
+        best = min(descents, key=lambda d: d.fun)
+        result = OptimizeResult(
+            x=best.x,
+            fun=best.fun,
+            nit=sum(d.nit for d in descents),
+            nfev=sum(d.nfev for d in descents),
+            success=best.fun < ftol,
+            message='a descent reached ftol' if best.fun < ftol else 'all starting points descended')
+        memo_hits = sum(d.memo_hits for d in descents)
+        memo_misses = sum(d.memo_misses for d in descents)
+
+        # the polish is logged as one more local optimization, starting from the best minimum
+        fun = MemoizedObjective(partial(objective, ctx=ctx), memo_size)
+        if precision == 'single' and polish:
+            polished, polish_x, polish_fun = polish_double(fun, use_jac, result.x, args, ftol)
+            x_iter.append(polish_x)
+            fun_iter.append(polish_fun)
+            result = merge_polish(result, polished)
+
+        t_end = time.perf_counter()
+        result.x_iter = x_iter
+        result.fun_iter = fun_iter
+        result.time = t_end - t_start
+        result.precision = precision
+        result.precision_error = precision_error(result.x, *args[:2], ctx=ctx) if precision == 'single' else None
+        result.memo_hits = memo_hits + fun.hits
+        result.memo_misses = memo_misses + fun.misses
+        result.pruned = sum(d.pruned for d in descents)
+        return result
+    finally:
+        if manager is not None:
+            manager.shutdown()
+        release_context(ctx, close_pool=pool is None)
+
+
+class _Cancelled(Exception):
+    """Raised inside a descent of a multistart optimization to stop it."""
+
+
+class _Pruned(Exception):
+    """Raised inside a descent of a multistart optimization to stop it for being far above the best cost."""
+
+
+def _descend(objective, use_jac, x0, args, ftol, memo_size, status, ctx, prune_ratio=None):
+    """Run one local descent of a multistart optimization.
+
+    Returns a `Descent`, or None if another descent reached ftol before this one started.
+    The descent is stopped if its cost stays above prune_ratio times the best cost of any
+    descent for PRUNE_PATIENCE iterations.
+    """
+    if status.done.is_set():
+        return None
+
+    fun = MemoizedObjective(partial(objective, ctx=ctx), memo_size)
+    reached = False
+
+    def shared_fun(x, *args):
+        nonlocal reached
+        value = fun(x, *args)
+        cost = value[0] if use_jac else value
+        if cost < ftol and not reached:
+            reached = True
+            status.done.set()
+        return value
+
+    recorder = IterationRecorder(shared_fun, use_jac)
+    above = 0
+
+    def callback(x):
+        nonlocal above
+        recorder.callback(x)
+        if not reached and status.done.is_set():
+            raise _Cancelled
+
+        cost = recorder.fun_iter[0][-1]
+        best = status.best.value
+        if cost < best:
+            with status.lock:
+                if cost < status.best.value:
+                    status.best.value = cost
+            best = cost
+        if prune_ratio is not None and cost > prune_ratio * best:
+            above += 1
+            if above >= PRUNE_PATIENCE:
+                raise _Pruned
+        else:
+            above = 0
+
+    nit = nfev = 0
+    pruned = False
+    try:
+        result = minimize(
+            fun=recorder,
+            x0=x0,
+            jac=use_jac,
+            method=recorder.lbfgsb,
+            options=lbfgsb_options(ftol, use_jac, precision=args[-1]),
+            args=args,
+            callback=callback)
+        nit, nfev = result.nit, result.nfev
+    except (_Cancelled, _Pruned) as e:
+        nit, nfev = len(recorder.x_iter[0]) - 1, fun.hits + fun.misses
+        pruned = isinstance(e, _Pruned)
+
+    x_iter, fun_iter = recorder.x_iter[0], recorder.fun_iter[0]
+    idx = int(np.argmin(fun_iter))
+    return Descent(x_iter=x_iter, fun_iter=fun_iter, x=x_iter[idx], fun=fun_iter[idx], nit=nit, nfev=nfev,
+                   memo_hits=fun.hits, memo_misses=fun.misses, pruned=pruned)
+
+
+def _descend_in_worker(handle, objective, use_jac, x0, args, ftol, memo_size, status, prune_ratio=None):
+    """Run one local descent of a multistart optimization; runs in pool workers."""
+    return _descend(objective, use_jac, x0, args, ftol, memo_size, status, worker_context(handle), prune_ratio)
+
+
+class IterationRecorder(object):
+    """Record the iterations of L-BFGS-B runs from the objective function and callback.
+
+    Use an instance as the objective function, recorder.lbfgsb as the method,
+    and recorder.callback as the callback of scipy.optimize.minimize, directly
+    or through scipy.optimize.basinhopping.  Each call of recorder.lbfgsb
+    starts a new run.
+
+    Attributes
+    ----------
+    x_iter : `list`
+        for each run, a list of the parameter vector of each iteration, starting with x0
+    fun_iter : `list`
+        for each run, a list of the cost function of each iteration, starting with x0
+
+    """
+
+    def __init__(self, fun, use_jac):
+        """Create a new IterationRecorder.
+
+        Parameters
+        ----------
+        fun : callable
+            objective function, see `get_objective`
+        use_jac : `bool`
+            True if fun returns (cost, gradient)
+
+        """
+        self.fun = fun
+        self.use_jac = use_jac
+        self.x_iter = []
+        self.fun_iter = []
+        self._args = ()
+        self._costs = {}
+
+    def __call__(self, x, *args):
+        """Evaluate the objective function and remember the cost at x."""
+        value = self.fun(x, *args)
+        cost = value[0] if self.use_jac else value
+        self._args = args
+        if not self.x_iter[-1]:  # the first evaluation of a run is at its starting point
+            self.x_iter[-1].append(np.array(x, dtype=np.float64))
+            self.fun_iter[-1].append(float(cost))
+        else:
+            self._costs[np.asarray(x, dtype=np.float64).tobytes()] = float(cost)
+        return value
+
+    def callback(self, x):
+        """Record an iteration of the current run."""
+        x = np.array(x, dtype=np.float64)
+        cost = self._costs.get(x.tobytes())
+        if cost is None:  # not expected from L-BFGS-B, which accepts only points it has evaluated
+            value = self.fun(x, *self._args)
+            cost = value[0] if self.use_jac else value
+
+        self.x_iter[-1].append(x)
+        self.fun_iter[-1].append(float(cost))
+        # later iterates are always points evaluated after this one
+        self._costs = {}
+
+    def lbfgsb(self, fun, x0, args=(), jac=None, hess=None, hessp=None, bounds=None, constraints=(),
+               callback=None, **options):
+        """Start a new run and minimize with L-BFGS-B; a custom method for scipy.optimize.minimize."""
+        self.x_iter.append([])
+        self.fun_iter.append([])
+        self._costs = {}
+        return minimize(fun=fun, x0=x0, args=args, jac=jac, method='L-BFGS-B', bounds=bounds,
+                        callback=callback, options=options)
+
+
+def get_objective(jac):
+    """Get the objective function and the jac argument for scipy.optimize.minimize.
+
+    Parameters
+    ----------
+    jac : `str` or None, {None, 'analytic', 'incremental', 'parallel', 'hybrid'}
+        how to compute the gradient of the cost function
+
+    Returns
+    -------
+    fun : callable
+        objective function
+    use_jac : `bool`
+        True if fun returns (cost, gradient)
+
+    Raises
+    ------
+    ValueError
+        invalid jac
+
+    """
+    if jac is None:
+        return optfcn, False
+    elif jac == 'analytic':
+        return optfcn_and_grad, True
+    elif jac == 'incremental':
+        return optfcn_and_fd_grad, True
+    elif jac == 'parallel':
+        return optfcn_and_parallel_fd_grad, True
+    elif jac == 'hybrid':
+        return optfcn_and_hybrid_fd_grad, True
+    else:
+        raise ValueError(f'jac must be None, analytic, incremental, parallel, or hybrid, not {jac}')
+
+
+def lbfgsb_options(ftol, use_jac, precision):
+    """Get the options dict for L-BFGS-B.
+
+    Parameters
+    ----------
+    ftol : `float`
+        cost function tolerance
+    use_jac : `bool`
+        True if the objective returns its gradient
+    precision : `str`, {'double', 'single'}
+        precision of the forward model
+
+    Returns
+    -------
+    `dict`
+        options for scipy.optimize.minimize
+
+    Notes
+    -----
+    The finite difference step is taken from `iris.core.FD_EPS`, as it is by
+    the objectives that compute their own finite differences.  The
+    default step of L-BFGS-B is lost in the rounding error of a single
+    precision cost function, so a larger one is used there.
+
+    """
+    options = {
+        'ftol': ftol,
+        'maxiter': 50,
+    }
+    if not use_jac:
+        options['eps'] = FD_EPS[precision]
+    return options
+
+
+def polish_double(fun, use_jac, x0, args, ftol):
+    """Refine a solution with L-BFGS-B and the forward model in double precision.
+
+    Parameters
+    ----------
+    fun : callable
+        objective function, see `get_objective`
+    use_jac : `bool`
+        True if fun returns (cost, gradient)
+    x0 : `numpy.ndarray`
+        starting point, usually the solution found in single precision
+    args : `tuple`
+        arguments to fun after the parameter vector; the last is the precision and is replaced
+    ftol : `float`
+        cost function tolerance, relative to the cost at x0
+
+    Returns
+    -------
+    result : `scipy.optimize.OptimizeResult`
+        result of the refinement
+    x_iter : `list`
+        parameter vector of each iteration, starting with x0
+    fun_iter : `list`
+        cost function of each iteration, starting with x0
+
+    """
+    # L-BFGS-B stops when the cost changes by less than ftol * max(cost, 1), which
+    # is met immediately when the cost is already small
+    args = (*args[:-1], 'double')
+    f0 = fun(x0, *args)
+    if use_jac:
+        f0 = f0[0]
+
+    recorder = IterationRecorder(fun, use_jac)
+    result = minimize(
+        fun=recorder,
+        x0=x0,
+        jac=use_jac,
+        method=recorder.lbfgsb,
+        options=lbfgsb_options(ftol * min(f0, 1), use_jac, 'double'),
+        args=args,
+        callback=recorder.callback)
+
+    return result, recorder.x_iter[0], recorder.fun_iter[0]
+
+
+def merge_polish(result, polished):
+    """Move the solution of a polish onto the result of an optimization.
+
+    Parameters
+    ----------
+    result : `scipy.optimize.OptimizeResult`
+        result of the optimization
+    polished : `scipy.optimize.OptimizeResult`
+        result of `polish_double`
+
+    Returns
+    -------
+    `scipy.optimize.OptimizeResult`
+        result, with x and fun of polished and its iterations and function evaluations added
+
+    """
+    result.x = polished.x
+    result.fun = polished.fun
+    result.nit += polished.nit
+    result.nfev += polished.nfev
+    return result
 
 
 def prep_data(sys_parameters, truth_df):
@@ -265,8 +757,10 @@ def prep_data(sys_parameters, truth_df):
     ----------
     sys_parameters : `prysm.macros.SetupParameters`
         a setupparameters namedtuple
-    truth_df : `pandas.DataFrame`
-        a pandas DF with columns Field, Focus, Azimuth, MTF
+    truth_df : `pandas.DataFrame` or `tuple`
+        a pandas DF with columns Field, Focus, Azimuth, MTF, or the (focus
+        diversity, tangential MTF, sagittal MTF) already extracted from one,
+        e.g. from a `iris.data.TruthCache`
 
     Returns
     -------
@@ -274,7 +768,10 @@ def prep_data(sys_parameters, truth_df):
         optimization setup namedtuple with focus diversity, t and s truth data, and diffraction data
 
     """
-    focus_diversity, ax_t, ax_s = grab_axial_data(sys_parameters, truth_df)
+    if isinstance(truth_df, tuple):
+        focus_diversity, ax_t, ax_s = truth_df
+    else:
+        focus_diversity, ax_t, ax_s = grab_axial_data(sys_parameters, truth_df)
 
     # casting ndarray to list makes it a list of arrays where the first index
     # is the focal plane and the second frequency.
@@ -290,8 +787,9 @@ def prep_data(sys_parameters, truth_df):
         diffraction=diffraction)
 
 
-def prep_globals(setup_data, setup_parameters, codex, parallel, nthreads):
-    """Prepare the global variables used in the optimimzation routine.
+def prep_context(setup_data, setup_parameters, codex, parallel, nthreads, otf_backend='fft', pool=None,
+                 backend='processes'):
+    """Prepare the context of an optimization.
 
     Parameters
     ----------
@@ -306,14 +804,44 @@ def prep_globals(setup_data, setup_parameters, codex, parallel, nthreads):
         whether the optimization is parallel or not
     nthreads : `int`, optional
         number of threads to use for parallel optimization; if None, defaults to number of logical threads - 1
+    otf_backend : `str`, optional, {'fft', 'mft', 'autocorr'}
+        method used to compute the OTF, see `iris.engine.thrufocus_ts_mtf`
+    pool : `iris.shared.PersistentPool`, optional
+        long-lived pool to use; if given, parallel, nthreads, and backend are ignored
+    backend : `str`, optional, {'processes', 'threads'}
+        if parallel, whether the pool is of processes or of threads of this process
 
     Returns
     -------
-    pool : `multiprocessing.Pool`
-        a multiprocessing pool
+    `iris.core.OptimizationContext`
+        context of the optimization.  If parallel, it holds a multiprocessing
+        pool whose workers hold the context in their globals, or a pool of
+        threads given the context itself.  Release it with `release_context`
+        when done
+
+    Raises
+    ------
+    ValueError
+        invalid otf_backend or backend
+
+    Notes
+    -----
+    The globals of this process are not modified, so several optimizations
+    may run at once in threads of one process.
+
+    Where available (python >= 3.8), the arrays of the context and the
+    compiled bases are placed in shared memory once and the workers attach
+    to them without copying when they receive their first task.  Otherwise,
+    the workers are given the context as globals when they start, or, for a
+    `iris.shared.PersistentPool`, before the context is returned.
 
     """
-    # declare some state for this run as global variables to speed up access in multiprocess pool
+    if otf_backend not in OTF_BACKENDS:
+        raise ValueError(f'otf_backend must be one of {OTF_BACKENDS}, not {otf_backend}')
+    if backend not in ('processes', 'threads'):
+        raise ValueError(f'backend must be processes or threads, not {backend}')
+
+    # the workers of a pool hold the state of this run as global variables to speed up access
     _globals = {
         't_true': setup_data.t_true,
         's_true': setup_data.s_true,
@@ -321,14 +849,173 @@ def prep_globals(setup_data, setup_parameters, codex, parallel, nthreads):
         'setup_parameters': setup_parameters,
         'decoder_ring': codex,
         'diffraction': setup_data.diffraction,
+        'otf_backend': otf_backend,
     }
+    ctx = OptimizationContext(**_globals, pool=None, nworkers=1, shared=None, backend='processes')
+    if pool is not None:
+        if shared_memory_available():
+            shared = share_context_arrays(ctx)
+        else:
+            # the workers are already running, so each is sent the globals of this run
+            shared = None
+            pool.broadcast(prepare_globals, _globals)
+        return ctx._replace(pool=pool.pool, nworkers=pool.processes, shared=shared)
+
     if parallel is True:
         if nthreads is None:
             nproc = cpu_count() - 1
         else:
             nproc = nthreads
-        pool = Pool(processes=nproc, initializer=prepare_globals, initargs=[_globals])
-    else:
-        pool = None
-    prepare_globals({**_globals, 'pool': pool})
-    return pool
+
+        if backend == 'threads':
+            # FFTs and large elementwise operations release the GIL; nothing is pickled or copied
+            return ctx._replace(pool=ThreadPool(processes=nproc), nworkers=nproc, backend='threads')
+
+        if shared_memory_available():
+            shared = share_context_arrays(ctx)
+            pool = Pool(processes=nproc)
+        else:
+            shared = None
+            pool = Pool(processes=nproc, initializer=prepare_globals, initargs=[_globals])
+
+        ctx = ctx._replace(pool=pool, nworkers=nproc, shared=shared)
+
+    return ctx
+
+
+def release_context(ctx, close_pool=True):
+    """Close the pool of a context and free its shared memory.
+
+    Parameters
+    ----------
+    ctx : `iris.core.OptimizationContext`
+        context from `prep_context`
+    close_pool : `bool`, optional
+        whether to close the pool; False for a `iris.shared.PersistentPool`
+
+    """
+    if close_pool and ctx.pool is not None:
+        ctx.pool.close()
+        ctx.pool.join()
+    if ctx.shared is not None:
+        ctx.shared.unlink()
+
+
+def benchmark_execution_backends(sys_parameters, truth_dataframe, codex, params, samples=None, nthreads=None,
+                                 jac=None, backends=('serial', 'processes', 'threads'), repeat=5):
+    """Time evaluation of the cost function serially, on a pool of processes, and on a pool of threads.
+
+    Parameters
+    ----------
+    sys_parameters : `prysm.macros.SimulationConfig`
+        a simulation config
+    truth_dataframe : `pandas.DataFrame` or `tuple`
+        a dataframe containing truth values, or the (focus diversity, tangential
+        MTF, sagittal MTF) already extracted from one, see `grab_axial_data`
+    codex : `dict`
+        dictionary of key, value pairs where keys are ints and values are strings.  Maps parameter
+        numbers to zernike numbers, e.g. {0: 'Z1', 1: 'Z9'} maps (10, 11) to {'Z1': 10, 'Z9': 11}
+    params : iterable
+        vector of wavefront coefficients to evaluate the cost function at
+    samples : iterable of `int`, optional
+        pupil sample counts to time at, if None use sys_parameters.samples
+    nthreads : `int`, optional
+        number of processes or threads; if None, defaults to number of logical threads - 1
+    jac : `str` or None, optional
+        objective to time, see `get_objective`
+    backends : iterable of `str`, optional, {'serial', 'processes', 'threads'}
+        backends to time
+    repeat : `int`, optional
+        number of times to evaluate the cost function; the fastest is reported
+
+    Returns
+    -------
+    `dict`
+        dict with keys of (samples, backend) and values of dicts with keys
+        setup, the time in seconds to start the pool and make the first
+        evaluation, time, the best time of the following evaluations, and
+        error, the absolute difference of the cost to that of the first backend
+
+    """
+    if samples is None:
+        samples = (sys_parameters.samples,)
+
+    objective, use_jac = get_objective(jac)
+    setup_data = prep_data(sys_parameters, truth_dataframe)
+    out = {}
+    for n in samples:
+        cfg = sys_parameters._replace(samples=n)
+        reference = None
+        for backend in backends:
+            t_start = time.perf_counter()
+            if backend == 'serial':
+                ctx = prep_context(setup_data, cfg, codex, False, None)
+            else:
+                ctx = prep_context(setup_data, cfg, codex, True, nthreads, backend=backend)
+            try:
+                cost = objective(params, ctx=ctx)
+                setup = time.perf_counter() - t_start
+                times = []
+                for _ in range(repeat):
+                    t_start = time.perf_counter()
+                    objective(params, ctx=ctx)
+                    times.append(time.perf_counter() - t_start)
+            finally:
+                release_context(ctx)
+
+            if use_jac:
+                cost = cost[0]
+            if reference is None:
+                reference = cost
+            out[(n, backend)] = {
+                'setup': setup,
+                'time': min(times),
+                'error': abs(cost - reference),
+            }
+
+    return out
+
+
+def prep_globals(setup_data, setup_parameters, codex, parallel, nthreads, otf_backend='fft'):
+    """Prepare the global variables used in the optimimzation routine.
+
+    Parameters
+    ----------
+    setup_data : `OptSetup`
+        optimization setup namedtuple with focus diversity, t and s truth data, and diffraction data
+    setup_parameters : `prysm.macros.SetupParameters`
+        a setupparameters namedtuple
+    codex : `dict`
+        dictionary of key, value pairs where keys are ints and values are strings.  Maps parameter
+        numbers to zernike numbers, e.g. {0: 'Z1', 1: 'Z9'} maps (10, 11) to {'Z1': 10, 'Z9': 11}
+    parallel : `bool`
+        whether the optimization is parallel or not
+    nthreads : `int`, optional
+        number of threads to use for parallel optimization; if None, defaults to number of logical threads - 1
+    otf_backend : `str`, optional, {'fft', 'mft', 'autocorr'}
+        method used to compute the OTF, see `iris.engine.thrufocus_ts_mtf`
+
+    Returns
+    -------
+    pool : `multiprocessing.Pool`
+        a multiprocessing pool
+
+    Notes
+    -----
+    Sets the globals of iris.core from `prep_context`, for use of the
+    functions there without a context.  The workers of the pool are given
+    the globals when they start; nothing is placed in shared memory, so
+    there is nothing to release but the pool.
+
+    """
+    ctx = prep_context(setup_data, setup_parameters, codex, False, None, otf_backend)
+    if parallel is True:
+        if nthreads is None:
+            nproc = cpu_count() - 1
+        else:
+            nproc = nthreads
+        pool = Pool(processes=nproc, initializer=prepare_globals, initargs=[ctx._asdict()])
+        ctx = ctx._replace(pool=pool, nworkers=nproc)
+
+    prepare_globals(ctx._asdict())
+    return ctx.pool
@@ -0,0 +1,212 @@
+"""Read-only arrays in shared memory and a persistent process pool, for zero-copy transport of state to workers."""
+from functools import partial
+from collections import namedtuple
+from multiprocessing import Pool, Manager, cpu_count
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+    _tracker_register = resource_tracker.register
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+# alignment of each array in the block, bytes
+ALIGNMENT = 64
+
+# describes a block of shared memory; layout holds (key, dtype, shape, offset) for each array.
+# This is all that needs to be sent to another process to attach the arrays.
+SharedArraysHandle = namedtuple('SharedArraysHandle', ['name', 'layout'])
+
+
+def shared_memory_available():
+    """Check if multiprocessing.shared_memory is available (python >= 3.8).
+
+    Returns
+    -------
+    `bool`
+        True if shared memory can be used
+
+    """
+    return shared_memory is not None
+
+
+class SharedArrays(object):
+    """A set of arrays copied once into a single block of shared memory.
+
+    The process which creates the block owns it and must unlink it when done;
+    other processes attach to it with `attach_shared_arrays` and the handle.
+
+    Attributes
+    ----------
+    block : `multiprocessing.shared_memory.SharedMemory`
+        the block of shared memory
+    handle : `SharedArraysHandle`
+        picklable description of the block
+
+    """
+
+    def __init__(self, arrays):
+        """Create a new SharedArrays.
+
+        Parameters
+        ----------
+        arrays : `dict`
+            dict of name, array_like pairs
+
+        Raises
+        ------
+        RuntimeError
+            if shared memory is not available
+
+        """
+        if shared_memory is None:
+            raise RuntimeError('shared memory requires python 3.8 or newer.')
+
+        arrays = {key: np.ascontiguousarray(value) for key, value in arrays.items()}
+        layout, offset = [], 0
+        for key, value in arrays.items():
+            layout.append((key, value.dtype.str, value.shape, offset))
+            offset += -(-value.nbytes // ALIGNMENT) * ALIGNMENT
+
+        self.block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        self.handle = SharedArraysHandle(name=self.block.name, layout=tuple(layout))
+        for key, dtype, shape, offset in layout:
+            # views into the block must not outlive this loop, or the block cannot be closed
+            view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.block.buf, offset=offset)
+            view[...] = arrays[key]
+            del view
+
+    def close(self):
+        """Detach from the block."""
+        self.block.close()
+
+    def unlink(self):
+        """Detach from and destroy the block."""
+        self.close()
+        self.block.unlink()
+
+
+def attach_shared_arrays(handle):
+    """Attach to a block of shared memory made by another process.
+
+    Parameters
+    ----------
+    handle : `SharedArraysHandle`
+        handle of the block, `SharedArrays.handle`
+
+    Returns
+    -------
+    block : `multiprocessing.shared_memory.SharedMemory`
+        the block; a reference must be held for as long as the arrays are used
+    arrays : `dict`
+        read-only views of the arrays in the block, keyed by name
+
+    """
+    # the creator owns the block; if this process registered it with the resource tracker,
+    # the tracker would destroy it or warn of a leak when this process exits
+    try:
+        block = shared_memory.SharedMemory(name=handle.name, track=False)
+    except TypeError:  # python < 3.13
+        register = resource_tracker.register
+        resource_tracker.register = _register_except_shared_memory
+        try:
+            block = shared_memory.SharedMemory(name=handle.name)
+        finally:
+            resource_tracker.register = register
+
+    return block, _views(block, handle.layout)
+
+
+def _register_except_shared_memory(name, rtype):
+    """Stand in for resource_tracker.register which ignores shared memory."""
+    if rtype != 'shared_memory':
+        _tracker_register(name, rtype)
+
+
+def _views(block, layout):
+    """Build read-only ndarray views into a block from its layout."""
+    arrays = {}
+    for key, dtype, shape, offset in layout:
+        view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf, offset=offset)
+        view.flags.writeable = False
+        arrays[key] = view
+    return arrays
+
+
+class PersistentPool(object):
+    """A process pool which outlives the optimizations that use it.
+
+    The workers are started once.  Each optimization places its state in a
+    new block of shared memory and sends the handle of the block with every
+    task; a worker which has not seen that handle attaches to the new state
+    before doing the task.  Starting the processes, the interpreter, and the
+    imports of prysm and scipy is paid once instead of once per job.
+
+    Without shared memory (python < 3.8), each optimization instead sends its
+    state to every worker before it starts, see `PersistentPool.broadcast`,
+    so only one optimization may use the pool at a time.
+
+    Attributes
+    ----------
+    pool : `multiprocessing.Pool`
+        the pool of worker processes
+    processes : `int`
+        number of worker processes
+
+    """
+
+    def __init__(self, processes=None):
+        """Create a new PersistentPool.
+
+        Parameters
+        ----------
+        processes : `int`, optional
+            number of worker processes; if None, defaults to number of logical threads - 1
+
+        """
+        if processes is None:
+            processes = max(cpu_count() - 1, 1)
+
+        self.processes = processes
+        self.pool = Pool(processes=processes)
+
+    def broadcast(self, fcn, *args):
+        """Run a function once in every worker, and wait for them all to finish.
+
+        Parameters
+        ----------
+        fcn : callable
+            picklable function to run
+        *args
+            arguments of fcn
+
+        Notes
+        -----
+        Each worker waits at a barrier after running fcn, so no worker can
+        take a second of the tasks; the workers must not be busy with other
+        tasks, or this waits until they are not.
+
+        """
+        with Manager() as manager:
+            barrier = manager.Barrier(self.processes)
+            self.pool.map(partial(_run_at_barrier, fcn, args, barrier), range(self.processes), chunksize=1)
+
+    def close(self):
+        """Stop the worker processes and wait for them to exit."""
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        """Enter a context, returns self."""
+        return self
+
+    def __exit__(self, *exc):
+        """Exit a context, closes the pool."""
+        self.close()
+
+
+def _run_at_barrier(fcn, args, barrier, _):
+    """Run fcn(*args), then wait for the other workers at a barrier; runs in pool workers."""
+    fcn(*args)
+    barrier.wait()
@@ -1,5 +1,4 @@
 """Misc. utilities."""
-import re
 import io
 from operator import itemgetter
 
@@ -59,57 +58,6 @@ def make_focus_range_realistic_number_of_microns(cfg, round_focus_to=5):
     return SimulationConfig(**cfg_dict)
 
 
-def split_lbfgsb_iters(string):
-    """Split captured output from L-BFGS-B into a sequence of outputs, each containing a single chunk.
-
-    Parameters
-    ----------
-    string : `str`
-        a string output from L-BFGS-B
-
-    Returns
-    -------
-    `list`
-        a list of strings, each is an output from L-BFGS-B
-
-    """
-    starts = [s.start() for s in re.finditer('RUNNING', string)]
-    blobs = []
-    for idx in range(len(starts)):
-        if idx is not len(starts) - 1:
-            s = string[starts[idx]:starts[idx + 1]]
-        else:
-            s = string[starts[idx]:]
-        blobs.append(s)
-    return blobs
-
-
-def parse_cost_by_iter_lbfgsb(string):
-    """Parse the cost function history from L-BFGS-B optimizer print statements.
-
-    Parameters
-    ----------
-    string : `str`
-        A string containing the entire L-BFGS-B output
-
-    Returns
-    -------
-    `list`
-        a list of cost function values by iteration
-
-    """
-    # use regex to find lines that include "at iteration" information.
-    lines_with_cost_function_values = \
-        re.findall(r'At iterate\s*\d*?\s*f=\s*-*?\d*.\d*D[+-]\d*', string)
-
-    # grab the value from each line and convert to python floats
-    fortran_values = [s.split()[-1] for s in lines_with_cost_function_values]
-    # fortran uses "D" to denote double and "raw" exp notation,
-    # fortran value 3.0000000D+02 is equivalent to
-    # python value  3.0000000E+02 with double precision
-    return [float(s.replace('D', 'E')) for s in fortran_values]
-
-
 def prepare_document_local(sim_params, codex, truth_params, truth_rmswfe, rrmswfe_iter, normed, optimization_result):
         """Prepare a document (dict) for insertion into the results database.
 
@@ -153,6 +101,8 @@ def prepare_document_local(sim_params, codex, truth_params, truth_rmswfe, rrmswf
                 - time, `float`
                 - nit, `int`
                 - nfev, `int`
+                - precision, `str`
+                - precision_error, `dict` or None, see `iris.core.precision_error`
 
         """
         x, xiter, f, fiter, t = itemgetter('x', 'x_iter', 'fun', 'fun_iter', 'time')(optimization_result)
@@ -175,6 +125,8 @@ def prepare_document_local(sim_params, codex, truth_params, truth_rmswfe, rrmswf
             'nit': optimization_result.nit,
             'nfev': optimization_result.nfev,
             'nrandomstart': False,
+            'precision': optimization_result.get('precision', 'double'),
+            'precision_error': optimization_result.get('precision_error', None),
         }
 
 
@@ -220,6 +172,8 @@ def prepare_document_global(sim_params, codex, truth_params, truth_rmswfe, rrmsw
                 - rrmswfe_final, `float`
                 - time, `float`
                 - nit, `int`
+                - precision, `str`
+                - precision_error, `dict` or None, see `iris.core.precision_error`
 
         Notes
         -----
@@ -272,6 +226,8 @@ def prepare_document_global(sim_params, codex, truth_params, truth_rmswfe, rrmsw
             'time': t,
             'nrandomstart': nstart,
             'nit': nit,
+            'precision': optimization_result.get('precision', 'double'),
+            'precision_error': optimization_result.get('precision_error', None),
         }
 
 
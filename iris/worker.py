@@ -1,20 +1,28 @@
-"""A worker that works for a period of time or number of jobs."""
+"""Workers that work for a period of time or number of jobs."""
 import time
+import queue
+from multiprocessing import Pool, cpu_count
 
 from iris.macros import run_simulation
+from iris.shared import PersistentPool, shared_memory_available
+from iris.data import job_fingerprint
+
+# options which change how a job is run but not its result; they are not part of its fingerprint
+NON_RESULT_OPTIONS = ('parallel', 'nthreads', 'backend', 'pool', 'memo_size', 'truth_cache')
 
 
 class Worker(object):
     """A worker."""
 
-    def __init__(self, queue, database, optmode='local', simopts=None, optopts=None, optcoreopts=None, work_time=None, work_jobs=None):
+    def __init__(self, queue, database, optmode='local', simopts=None, optopts=None, optcoreopts=None, work_time=None, work_jobs=None,
+                 pool=None):
         """Create a new worker.
 
         Parameters
         ----------
         queue : `iris.data.PersistentQueue`
             a persistent queue object
-        database : `iris.data.Database`
+        database : `iris.data.Database` or `iris.data.SharedDatabase`
             a database object
         optmode : `str`, optional, {'local', 'global'}
             optimization mode; local or global
@@ -27,6 +35,9 @@ class Worker(object):
             time to work for, minutes
         work_jobs : `int`, optional
             number of jobs to complete
+        pool : `iris.shared.PersistentPool`, optional
+            long-lived pool shared by every job this worker does; the worker
+            does not close it
 
         Raises
         ------
@@ -52,6 +63,7 @@ class Worker(object):
         self.optmode = optmode
         self.optopts = optopts
         self.optcoreopts = optcoreopts
+        self.pool = pool
 
         self.q = queue
         self.db = database
@@ -61,7 +73,7 @@ class Worker(object):
         self.last_result = None
 
     def do_job(self):
-        """Do a job."""
+        """Do a job, or skip it if its result is already in the database."""
         try:
             item = self.q.peek()
         except IndexError:
@@ -69,6 +81,12 @@ class Worker(object):
             self.end()
             return
 
+        fingerprint = self.fingerprint(item)
+        if self.db.has_job(fingerprint):
+            print('skipping - job already in database')
+            self.q.mark_done()
+            return
+
         try:
             if self.simopts is not None:
                 so = self.simopts
@@ -79,13 +97,30 @@ class Worker(object):
                 solver=self.optmode,
                 solver_opts=self.optopts,
                 core_opts=self.optcoreopts,
+                pool=self.pool,
                 **so)
-            self.db.append(self.last_result)
+            self.db.append(self.last_result, fingerprint)
             self.q.mark_done()
         except (KeyError, IndexError) as e:
             print(e)
             pass  # weird glitch inside of optimization, just skip this run, it will be immediately rerun
 
+    def fingerprint(self, item):
+        """Compute the fingerprint of the job for a queue item.
+
+        Parameters
+        ----------
+        item : object
+            truth of the job, an item on the queue
+
+        Returns
+        -------
+        `str`
+            fingerprint of the job, see `iris.data.job_fingerprint`
+
+        """
+        return _fingerprint(item, self.optmode, self.simopts, self.optopts, self.optcoreopts)
+
     def start(self):
         """Begin working and block."""
         self.status = 'working'
@@ -109,3 +144,237 @@ class Worker(object):
         self.status = 'stopped'
         if self.mode == 'jobs':
             self.current_job = 0
+
+
+class WorkerPool(object):
+    """A set of workers which drain one queue into one database, a job per process."""
+
+    def __init__(self, queue, database, nworkers=None, optmode='local', simopts=None, optopts=None,
+                 optcoreopts=None, work_time=None, work_jobs=None, parallelism='auto'):
+        """Create a new worker pool.
+
+        Parameters
+        ----------
+        queue : `iris.data.PersistentQueue`
+            a persistent queue object
+        database : `iris.data.Database` or `iris.data.SharedDatabase`
+            a database object
+        nworkers : `int`, optional
+            number of worker processes; if None, defaults to number of logical threads - 1
+        optmode : `str`, optional, {'local', 'global', 'multistart'}
+            optimization mode, see `iris.macros.run_simulation`
+        simopts : `dict`, optional
+            options passed to run_simulation
+        optopts : `dict`, optional
+            options passed to the optimiser; parallel and nthreads are chosen by the pool
+        optcoreopts : `dict`, optional
+            options passed to the core of the optimizer
+        work_time : numeric, optional
+            time to work for, minutes
+        work_jobs : `int`, optional
+            number of jobs to complete
+        parallelism : `str`, optional, {'auto', 'jobs', 'planes'}
+            how to use the workers.  'jobs' runs one job per worker, each on a
+            single core.  'planes' runs one job at a time with its focal planes
+            spread over the workers.  'auto' runs one job per worker while jobs
+            remain to be started, and the last job with its planes spread over
+            the workers which are not running one of the jobs still in progress
+
+        Raises
+        ------
+        ValueError
+            if work_time and work_jobs are both None, or parallelism is invalid
+
+        Notes
+        -----
+        Only this process touches the queue and database; the workers are sent
+        the truth of each job and return its document.  Jobs are leased from the
+        queue and removed from it once their documents are in the database, so
+        jobs in progress when the process dies are done again when the queue is
+        next loaded.
+
+        Jobs whose fingerprint is in the database are removed from the queue
+        without being run, see `Worker.fingerprint`.
+
+        """
+        if work_time is None and work_jobs is None:
+            raise ValueError('work time and work jobs cannot both be None')
+        if parallelism not in ('auto', 'jobs', 'planes'):
+            raise ValueError(f'parallelism must be auto, jobs, or planes, not {parallelism}')
+
+        if nworkers is None:
+            nworkers = max(cpu_count() - 1, 1)
+
+        self.nworkers = nworkers
+        self.parallelism = parallelism
+        self.simopts = simopts
+        self.optmode = optmode
+        self.optopts = optopts
+        self.optcoreopts = optcoreopts
+
+        self.q = queue
+        self.db = database
+        self.work_time = work_time
+        self.work_jobs = work_jobs
+        self.status = 'stopped'
+        self.jobs_started = 0
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.jobs_skipped = 0
+        self.elapsed = 0
+
+    @property
+    def jobs_per_hour(self):
+        """Throughput of the last call to start, in jobs per hour."""
+        if self.elapsed == 0:
+            return 0
+        return self.jobs_done / self.elapsed * 3600
+
+    def start(self):
+        """Begin working and block until the queue is empty or the work time or jobs are reached."""
+        self.status = 'working'
+        self.jobs_started = self.jobs_done = self.jobs_failed = self.jobs_skipped = 0
+        t_start = time.monotonic()
+        end_time = None if self.work_time is None else t_start + 60 * self.work_time
+
+        # planes of a job are spread over a persistent pool; without shared memory, only jobs are
+        if shared_memory_available():
+            workers = PersistentPool(self.nworkers)
+            pool = workers.pool
+        else:
+            workers, pool = None, Pool(processes=self.nworkers)
+
+        finished = queue.Queue()
+        in_flight, fingerprints = set(), {}
+        try:
+            while True:
+                while self.status == 'working' and len(in_flight) < self.nworkers:
+                    if (self.work_jobs is not None and self.jobs_started >= self.work_jobs) or \
+                            (end_time is not None and time.monotonic() > end_time):
+                        self.status = 'stopped'
+                        break
+                    try:
+                        token, item = self.q.lease()
+                    except IndexError:
+                        print('stopping - queue exhausted')
+                        self.status = 'stopped'
+                        break
+
+                    fingerprints[token] = self.fingerprint(item)
+                    if self.db.has_job(fingerprints[token]):
+                        self.q.complete(token)
+                        self.jobs_skipped += 1
+                        continue
+
+                    self.jobs_started += 1
+                    if self._spread_planes(workers, in_flight):
+                        try:
+                            self._finish_job(token, self._run_job(item, workers), fingerprints.pop(token))
+                        except Exception as e:
+                            self._finish_job(token, e, fingerprints.pop(token, None))
+                    else:
+                        in_flight.add(token)
+                        pool.apply_async(
+                            _run_job_in_worker,
+                            (item, self.optmode, self.simopts, self.optopts, self.optcoreopts),
+                            callback=_put_with_token(finished, token),
+                            error_callback=_put_with_token(finished, token))
+
+                if not in_flight:
+                    break
+
+                token, result = finished.get()
+                in_flight.remove(token)
+                self._finish_job(token, result, fingerprints.pop(token))
+        except KeyboardInterrupt:
+            print('stopping - user requested')
+            self._abandon(in_flight, pool)
+        except BaseException:
+            self._abandon(in_flight, pool)
+            raise
+        finally:
+            self.status = 'stopped'
+            self.elapsed = time.monotonic() - t_start
+            if workers is not None:
+                workers.close()
+            else:
+                pool.close()
+                pool.join()
+
+    def _abandon(self, in_flight, pool):
+        """Stop the jobs in progress and return them to the queue."""
+        for token in in_flight:
+            self.q.release(token)
+        in_flight.clear()
+        pool.terminate()
+
+    def _spread_planes(self, workers, in_flight):
+        """Whether to run the job being started with its planes spread over the workers."""
+        if workers is None or self.parallelism == 'jobs':
+            return False
+        if self.parallelism == 'planes':
+            return True
+        # no job is left to start, so the workers not running a job would sit idle until the
+        # jobs in progress finish; the planes of the last job are put to them instead
+        last = self.q.available() == 0 or (self.work_jobs is not None and self.jobs_started >= self.work_jobs)
+        return last and len(in_flight) < self.nworkers
+
+    def _run_job(self, item, workers):
+        """Run a job in this process with its planes spread over the workers."""
+        return run_simulation(
+            truth=item,
+            solver=self.optmode,
+            solver_opts=self.optopts,
+            core_opts=self.optcoreopts,
+            pool=workers,
+            **(self.simopts or dict()))
+
+    def fingerprint(self, item):
+        """Compute the fingerprint of the job for a queue item, see `Worker.fingerprint`."""
+        return _fingerprint(item, self.optmode, self.simopts, self.optopts, self.optcoreopts)
+
+    def _finish_job(self, token, result, fingerprint):
+        """Put the document of a job in the database and remove the job from the queue."""
+        if isinstance(result, BaseException):
+            self.q.release(token)
+            if not isinstance(result, (KeyError, IndexError)):
+                raise result
+
+            print(result)
+            self.jobs_failed += 1
+            return  # weird glitch inside of optimization, the job will be rerun
+
+        self.db.append(result, fingerprint)
+        self.q.complete(token)
+        self.jobs_done += 1
+
+    def end(self):
+        """Stop starting jobs; the jobs in progress are finished."""
+        self.status = 'stopped'
+
+
+def _fingerprint(item, optmode, simopts, optopts, optcoreopts):
+    """Fingerprint a job from its truth and the options of the worker which runs it."""
+    def strip(opts):
+        return {k: v for k, v in (opts or dict()).items() if k not in NON_RESULT_OPTIONS}
+
+    return job_fingerprint(item, optmode, strip(simopts), strip(optopts), optcoreopts)
+
+
+def _put_with_token(q, token):
+    """Make a callback which puts (token, result) on a queue.Queue."""
+    def put(result):
+        q.put((token, result))
+    return put
+
+
+def _run_job_in_worker(item, optmode, simopts, optopts, optcoreopts):
+    """Run a job on one core; runs in pool workers."""
+    optopts = {**(optopts or dict()), 'parallel': False}
+    optopts.pop('nthreads', None)
+    return run_simulation(
+        truth=item,
+        solver=optmode,
+        solver_opts=optopts,
+        core_opts=optcoreopts,
+        **(simopts or dict()))